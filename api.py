@@ -1,16 +1,20 @@
 # -*- coding: utf-8 -*-
 #
 from collections import OrderedDict
-from sanic.response import json, text, HTTPResponse
+from sanic.response import text, HTTPResponse
 from sanic.request import Request
 from sanic.exceptions import ServiceUnavailable
 from sanic_restplus import Api, Resource, fields
 import re
 
 
-from functions import check_type, get_linksets, get_datasets, get_dataset_types, get_locations, get_location_is_within, get_location_contains, get_resource, get_location_overlaps_crosswalk, get_location_overlaps, get_at_location, search_location_by_label, find_geometry_by_loci_uri
-from functions_DGGS import find_dggs_by_loci_uri, find_at_dggs_cell
-from functools import reduce 
+from functions import check_types, get_linksets, get_datasets, get_dataset_types, get_locations, get_location_is_within, get_location_contains, get_resource, get_location_overlaps_crosswalk, get_location_overlaps, get_at_location, search_location_by_label, find_geometry_by_loci_uri, iter_pages, iter_at_locations
+from type_registry import get_type_registry, TypeRegistryError
+from hierarchy_index import format_area
+from codec import json
+from streaming import wants_ndjson, ndjson_response, iter_chunks, iter_batches, STREAM_PAGE_SIZE
+from cursors import overlaps_results, START_CURSOR
+from functions_DGGS import find_dggs_by_loci_uri, find_at_dggs_cell, find_dggs_by_loci_uris, find_at_dggs_cells
 
 
 url_prefix = '/v1'
@@ -116,9 +120,12 @@ class Location(Resource):
                     "required": False, "type": "number", "format": "integer", "default": 0}),
     ]), security=None)
     async def get(self, request, *args, **kwargs):
-        """Gets all LOCI Locations"""
+        """Gets all LOCI Locations\n
+        Send Accept: application/x-ndjson to stream the locations, one per line """
         count = int(next(iter(request.args.getlist('count', [1000]))))
         offset = int(next(iter(request.args.getlist('offset', [0]))))
+        if wants_ndjson(request):
+            return ndjson_response(iter_pages(get_locations, count, offset, STREAM_PAGE_SIZE))
         meta, locations = await get_locations(count, offset)
         response = {
             "meta": meta,
@@ -191,10 +198,15 @@ class Contains(Resource):
                     "required": False, "type": "number", "format": "integer", "default": 0}),
     ]), security=None)
     async def get(self, request, *args, **kwargs):
-        """Gets all LOCI Locations that this target LOCI URI contains"""
+        """Gets all LOCI Locations that this target LOCI URI contains\n
+        Send Accept: application/x-ndjson to stream the locations, one per line """
         count = int(next(iter(request.args.getlist('count', [1000]))))
         offset = int(next(iter(request.args.getlist('offset', [0]))))
         target_uri = str(next(iter(request.args.getlist('uri'))))
+        if wants_ndjson(request):
+            async def fetch_page(page_count, page_offset):
+                return await get_location_contains(target_uri, page_count, page_offset)
+            return ndjson_response(iter_pages(fetch_page, count, offset, STREAM_PAGE_SIZE))
         meta, locations = await get_location_contains(target_uri, count, offset)
         response = {
             "meta": meta,
@@ -225,12 +237,31 @@ class Overlaps(Resource):
                    "required": False, "type": "number", "format": "integer", "default": 1000}),
         ("offset", {"description": "Skip number of locations before returning count.",
                     "required": False, "type": "number", "format": "integer", "default": 0}),
+        ("cursor", {"description": "Page through the full result, * for the first page then the nextCursor in the meta of the page before. "
+                                   "count is the page size, offset and the other parameters are ignored after the first page. "
+                                   "A result too big to keep for paging is all in the first page, with no nextCursor",
+                    "required": False, "type": "string"}),
     ]), security=None)
     async def get(self, request, *args, **kwargs):
         """Gets all LOCI Locations that this target LOCI URI overlaps with\n
-        Note: count and offset do not currently work properly on /overlaps """
+        Send Accept: application/x-ndjson to stream the overlaps, one per line\n
+        Note: count and offset do not currently work properly on /overlaps, page with cursor instead """
         count = int(next(iter(request.args.getlist('count', [1000]))))
         offset = int(next(iter(request.args.getlist('offset', [0]))))
+        cursor = next(iter(request.args.getlist('cursor', [None])))
+        if cursor is not None and count < 1:
+            return json({"error": "count must be at least 1 when paging with a cursor"}, status=400)
+        if cursor is not None and cursor != START_CURSOR:
+            # a later page, of a result already computed
+            page = overlaps_results.page(str(cursor), count)
+            if page is None:
+                return json({"error": "Unknown or expired cursor, start again with cursor={}".format(START_CURSOR)}, status=404)
+            meta, overlaps = page
+            return json({"meta": meta, "overlaps": overlaps}, status=200)
+        page_size = count
+        if cursor is not None:
+            # compute the full result, to page through from the result store
+            count, offset = 1000000000, 0
         target_uri = str(next(iter(request.args.getlist('uri'))))
         if 'output_type'  in request.args:
             output_featuretype_uri = str(next(iter(request.args.getlist('output_type'))))
@@ -253,31 +284,16 @@ class Overlaps(Resource):
             if output_featuretype_uri is not None: 
                 resource = await get_resource(target_uri)
                 input_featuretype_uri = resource["http://www.w3.org/1999/02/22-rdf-syntax-ns#type"] 
-                # get all the common base units in loci
-                meta, base_dataset_types = await get_dataset_types(None, None, True, None, None)
-                # place holders for special cases were target_uri or output_featuretype_uri is itself a base unit 
-                output_is_base_type = False 
-                input_is_base_type = False 
-                # iterate through the common base units and look at the hierarchies of things that use those base units
-                # figure out whether both the target_uri type and output_featuretype_uri belong to the same hierarchy
-                # if so note the common_base_dataset_type_uri that joings them
-                for dataset_type in base_dataset_types:
-                    base_dataset_type_uri = dataset_type['uri']
-                    if output_featuretype_uri == base_dataset_type_uri:
-                        output_is_base_type = True
-                    if input_featuretype_uri == base_dataset_type_uri:
-                        input_is_base_type = True
-                    found_input = False
-                    found_output = False 
-                    dataset_type['withinTypes'].append(base_dataset_type_uri)
-                    for withinType in dataset_type['withinTypes']:
-                        if withinType == input_featuretype_uri:
-                            found_input = True
-                        if withinType == output_featuretype_uri:
-                            found_output = True
-                    if found_input and found_output:
-                        common_base_dataset_type_uri = base_dataset_type_uri
-                        break
+                # look up the common base unit that joins the hierarchies of the target_uri type and output_featuretype_uri,
+                # and whether either of them is itself a base unit
+                try:
+                    registry = await get_type_registry()
+                    common_base = registry.common_base(str(input_featuretype_uri), output_featuretype_uri)
+                except TypeRegistryError:
+                    # without the registry the general crosswalk is still possible
+                    common_base = None
+                if common_base is not None:
+                    common_base_dataset_type_uri, input_is_base_type, output_is_base_type = common_base
             # if a common_base_dataset_type_uri was found then we can shortcut search just via base units and contains / within propoerties
             # i.e there are no fundamental overlaps
             if common_base_dataset_type_uri is not None:
@@ -287,12 +303,12 @@ class Overlaps(Resource):
                 if input_is_base_type:
                     # special case is the target_uri was alread a base type so don't need to find them
                     resource = await get_resource(target_uri)
-                    input_uri_area = resource["http://linked.data.gov.au/def/geox#hasAreaM2"]["http://linked.data.gov.au/def/datatype/value"]
+                    input_uri_area = float(resource["http://linked.data.gov.au/def/geox#hasAreaM2"]["http://linked.data.gov.au/def/datatype/value"])
                     input_overlaps_to_base_unit=[{'uri': target_uri, 'featureArea': input_uri_area}]
                 else:
                     # find base unit by searching from target URI for things within it which are of the common_base_dataset_type_uri     
                     meta, input_overlaps_to_base_unit =  await get_location_overlaps(target_uri, None, True, True, False,
-                                                            True, common_base_dataset_type_uri, 1000000000, 0)
+                                                            True, common_base_dataset_type_uri, 1000000000, 0, as_float=True)
                     input_uri_area = meta["featureArea"]
                 for base_result in input_overlaps_to_base_unit:
                     # for all the common base units
@@ -307,7 +323,7 @@ class Overlaps(Resource):
                     else:
                         # look up the hierarchy for everything that contains these base units
                         meta, base_unit_overlaps_to_output = await get_location_overlaps(base_uri, None, True, True, True,
-                                                            False, None, 1000000000, 0, False)
+                                                            False, None, 1000000000, 0, False, as_float=True)
                         for output in base_unit_overlaps_to_output:
                             # note details of things up the hierarchy
                             output_uri = output['uri']
@@ -325,27 +341,35 @@ class Overlaps(Resource):
                     if 'featureArea' in output_detail:
                         output_feature_area  = output_detail['featureArea']
                     # sum up all the base_unit areas that make up this output area 
-                    output['intersection_area'] = reduce(lambda a,b:{'featureArea': float(a['featureArea']) + float(b['featureArea'])}, output_hits[output_uri])['featureArea']
-                    output['forwardPercentage'] = (float(output['intersection_area'])  / float(input_uri_area))  * 100
+                    output['intersection_area'] = sum(base_result['featureArea'] for base_result in output_hits[output_uri])
+                    output['forwardPercentage'] = (output['intersection_area'] / input_uri_area) * 100
                     if output_feature_area is not None:
-                        output['featureArea'] = output_feature_area
-                        output['reversePercentage'] = (float(output['intersection_area'])  / float(output['featureArea'])) * 100
+                        output['featureArea'] = format_area(output_feature_area)
+                        output['reversePercentage'] = (output['intersection_area'] / output_feature_area) * 100
                     outputs.append(output)
                 res_length = len(outputs) 
-                filtered_outputs = []
-                for output in outputs:
-                    # filter outputs to just the target type we want
-                    if await check_type(output['uri'], output_featuretype_uri):
-                        filtered_outputs.append(output)
+                # filter outputs to just the target type we want
+                type_matches = await check_types([output['uri'] for output in outputs], output_featuretype_uri)
+                filtered_outputs = [output for output in outputs if output['uri'] in type_matches]
 
-                meta, overlaps = { 'count' : len(filtered_outputs), 'offset' : 0, 'featureArea' : input_uri_area}, filtered_outputs 
+                meta, overlaps = { 'count' : len(filtered_outputs), 'offset' : 0, 'featureArea' : format_area(input_uri_area)}, filtered_outputs 
             else:
                 meta, overlaps = await get_location_overlaps_crosswalk(target_uri, output_featuretype_uri, include_areas, include_proportion, include_within,
                                                         include_contains, count, offset)
+        elif wants_ndjson(request) and cursor is None:
+            # stream each page of results as soon as it is fetched
+            async def fetch_page(page_count, page_offset):
+                return await get_location_overlaps(target_uri, output_featuretype_uri, include_areas, include_proportion,
+                                                   include_within, include_contains, None, page_count, page_offset)
+            return ndjson_response(iter_pages(fetch_page, count, offset, STREAM_PAGE_SIZE))
         else:
             meta, overlaps = await get_location_overlaps(target_uri, output_featuretype_uri, include_areas, include_proportion, include_within,
                                                         include_contains, None, count, offset)
 
+        if cursor is not None:
+            meta, overlaps = overlaps_results.start(meta, overlaps, page_size)
+        elif wants_ndjson(request):
+            return ndjson_response(iter_chunks(overlaps))
         response = {
             "meta": meta,
             "overlaps": overlaps,
@@ -388,6 +412,73 @@ class find_at_location(Resource):
 
         return json(response, status=200)
 
+    @ns.doc('find_at_locations', params=OrderedDict([
+        ("loci_type", {"description": "Loci location type to query, can be 'any', 'mb' for meshblocks or 'cc' for contracted catchments",
+                 "required": False, "type": "string", "default":"any"}),
+        ("crs", {"crs": "Query points CRS. Default is 4326 (WGS 84)",
+                   "required": False, "type": "number", "format" : "integer", "default": 4326}),
+        ("count", {"description": "Number of locations to return for each point.",
+                   "required": False, "type": "number", "format": "integer", "default": 1000}),
+        ("offset", {"description": "Skip number of locations before returning count.",
+                    "required": False, "type": "number", "format": "integer", "default": 0}),
+    ]), security=None)
+    async def post(self, request, *args, **kwargs):
+        """Finds all LOCI features that intersect with each of many locations\n
+        Request body: {"points": [[lon, lat], ...]} or a GeoJSON MultiPoint {"type": "MultiPoint", "coordinates": [[lon, lat], ...]}\n
+        Send Accept: application/x-ndjson to stream the results, one line per point, in the order of the points """
+        count = int(next(iter(request.args.getlist('count', [1000]))))
+        offset = int(next(iter(request.args.getlist('offset', [0]))))
+        crs = int(next(iter(request.args.getlist('crs', [4326]))))
+        loci_type = str(next(iter(request.args.getlist('loci_type', ['any']))))
+        points = batch_body_points(request)
+        if points is None:
+            return json({"error": "Expected a JSON body with a \"points\" list of [lon, lat] coordinates, or a GeoJSON MultiPoint"},
+                        status=400)
+
+        async def fetch_pages():
+            i = 0
+            async for results in iter_at_locations(points, loci_type, crs, count, offset):
+                page = []
+                for result in results:
+                    lon, lat = points[i]
+                    i += 1
+                    if isinstance(result, tuple):
+                        meta, locations = result
+                        page.append({"point": [lon, lat], "meta": meta, "locations": locations})
+                    else:
+                        # get_at_location returns a bare dict with the error message when GDS fails
+                        page.append({"point": [lon, lat], "error": result.get('errorMessage', None)})
+                yield page
+        if wants_ndjson(request):
+            return ndjson_response(fetch_pages())
+        results = []
+        async for page in fetch_pages():
+            results.extend(page)
+        response = {
+            "meta": {"count": len(results)},
+            "results": results,
+        }
+        return json(response, status=200)
+
+
+def batch_body_points(request):
+    """
+    The (lon, lat) points in the JSON body of a batch find_at_location request, or None if there are not any
+    """
+    body = request.json
+    if not isinstance(body, dict):
+        return None
+    if body.get('type', None) == 'MultiPoint':
+        coordinates = body.get('coordinates', None)
+    else:
+        coordinates = body.get('points', None)
+    if not isinstance(coordinates, list):
+        return None
+    try:
+        return [(float(c[0]), float(c[1])) for c in coordinates]
+    except (TypeError, ValueError, IndexError, KeyError):
+        return None
+
 @ns_loc_func.route('/find-by-label')
 class Search(Resource):
     """Function for finding a LOCI location by label"""
@@ -458,6 +549,16 @@ class to_DGGS(Resource):
         }
         return json(response, status=200)
 
+    @ns.doc('find_dggs_by_loci_uris', security=None)
+    async def post(self, request, *args, **kwargs):
+        """Calls DGGS table to query the DGGS cells of many loci uris at once\n
+        Request body: {"uris": ["http://linked.data.gov.au/dataset/asgs2016/statisticalarealevel1/31503140814", ...]}\n
+        Send Accept: application/x-ndjson to stream the results, one line per uri """
+        uris = batch_body_list(request, 'uris')
+        if uris is None:
+            return json({"error": "Expected a JSON body with a \"uris\" list of strings"}, status=400)
+        return await batch_response(request, find_dggs_by_loci_uris, uris)
+
 @ns_loc_func.route('/find-at-DGGS-cell')
 class find_at_DGGS_cell(Resource):
     """Function for finding an array of Loci-i Features by a DGGS cell ID"""
@@ -479,3 +580,48 @@ class find_at_DGGS_cell(Resource):
             return json(response, status=200)
         else:
             return json({"error": "Wrong DGGS cell"}, status=400)
+
+    @ns.doc('find_at_dggs_cells', security=None)
+    async def post(self, request, *args, **kwargs):
+        """Calls DGGS table to query the loci features of many DGGS cell IDs at once\n
+        Request body: {"dggs_cells": ["S3006887558", ...]}\n
+        Send Accept: application/x-ndjson to stream the results, one line per cell """
+        dggs_cells = batch_body_list(request, 'dggs_cells')
+        if dggs_cells is None:
+            return json({"error": "Expected a JSON body with a \"dggs_cells\" list of strings"}, status=400)
+        p = re.compile('^[N-S][0-9]{10}$')
+        wrong_cells = [dggs_cell for dggs_cell in dggs_cells if not p.match(dggs_cell)]
+        if wrong_cells:
+            return json({"error": "Wrong DGGS cell", "dggs_cells": wrong_cells}, status=400)
+        return await batch_response(request, find_at_dggs_cells, dggs_cells)
+
+
+def batch_body_list(request, key):
+    """
+    The list of strings under key in the JSON body of a batch request, or None if there is not one
+    """
+    body = request.json
+    if not isinstance(body, dict):
+        return None
+    items = body.get(key, None)
+    if not isinstance(items, list) or not all(isinstance(i, str) for i in items):
+        return None
+    return items
+
+
+async def batch_response(request, batch_fn, items):
+    """
+    Respond with the {"meta": ..., "locations": ...} result of each batch item, in the order of the items
+    """
+    def format_results(results):
+        return [{"meta": meta, "locations": locations} for meta, locations in results]
+    if wants_ndjson(request):
+        async def fetch_batch(batch):
+            return format_results(await batch_fn(batch))
+        return ndjson_response(iter_batches(fetch_batch, items))
+    results = format_results(await batch_fn(items))
+    response = {
+        "meta": {"count": len(results)},
+        "results": results,
+    }
+    return json(response, status=200)
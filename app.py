@@ -24,6 +24,12 @@ from spf import SanicPluginsFramework
 from sanic_restplus.restplus import restplus
 from sanic_cors.extension import cors
 from api import api_v1
+from upstream import setup_upstreams
+from type_registry import setup_type_registry
+from functions_DGGS import setup_pg_pool
+from point_index import setup_point_index
+from metrics import setup_metrics
+from profiling import setup_profiling
 HERE_DIR = os.path.dirname(__file__)
 
 import subprocess
@@ -45,6 +51,18 @@ def create_app():
     """.format(gitlabel)
     app.config.SWAGGER_UI_DOC_EXPANSION = 'list'
     app.config.RESPONSE_TIMEOUT = 4800
+    # Pooled client sessions to GraphDB, GDS, ES and the geometry hosts, closed when the server stops
+    setup_upstreams(app)
+    # The LOCI dataset types are loaded once at startup, rather than on every request
+    setup_type_registry(app)
+    # Pooled connections to the DGGS database
+    setup_pg_pool(app)
+    # Local point-in-polygon datasets for find_at_location, if configured
+    setup_point_index(app)
+    # Request and upstream metrics, on /metrics
+    setup_metrics(app)
+    # Upstream call breakdowns for requests with _profile=true
+    setup_profiling(app)
     # Register/Activate Sanic-CORS plugin with allow all origins
     _ = spf.register_plugin(cors, origins=r".*", automatic_options=True)
 
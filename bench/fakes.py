@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+#
+"""
+Local stand-ins for the upstream services, serving a synthetic World:
+a GraphDB SPARQL endpoint, the Geometry Data Service, the geometry hosts, ElasticSearch,
+and an in-process stand-in for the asyncpg pool of the DGGS database.
+
+The SPARQL stand-in does not evaluate SPARQL, it recognises the queries the API sends by their shape
+and answers them from the World, so it has to be kept in step with the queries in functions.py.
+"""
+import asyncio
+import json
+import math
+import re
+import zlib
+from collections import Counter
+from aiohttp import web
+from world import MB16CC
+
+XSD_DECIMAL = "http://www.w3.org/2001/XMLSchema#decimal"
+XSD_BOOLEAN = "http://www.w3.org/2001/XMLSchema#boolean"
+RDF_TYPE = "http://www.w3.org/1999/02/22-rdf-syntax-ns#type"
+HAS_AREA = "http://linked.data.gov.au/def/geox#hasAreaM2"
+DT_VALUE = "http://linked.data.gov.au/def/datatype/value"
+IN_CRS = "http://linked.data.gov.au/def/geox#inCRS"
+EPSG_3577 = "http://www.opengis.net/def/crs/EPSG/0/3577"
+
+_URI = re.compile(r'<([^>]+)>')
+_SUBJECT = re.compile(r'rdf:subject <([^>]+)>')
+_LINKSET = re.compile(r'ipo: <([^>]+)> ;')
+_EXISTS = re.compile(r'EXISTS\{<([^>]+)> rdf:type <([^>]+)>\}')
+_FEATURE = re.compile(r'<([^>]+)> geo:hasGeometry')
+_CHAIN = re.compile(r'<([^>]+)> geo:sf(Within|Contains)\+ \?l')
+
+
+def uri(value):
+    return {'type': 'uri', 'value': value}
+
+
+def decimal(value):
+    return {'type': 'literal', 'datatype': XSD_DECIMAL, 'value': repr(float(value))}
+
+
+def boolean(value):
+    return {'type': 'literal', 'datatype': XSD_BOOLEAN, 'value': 'true' if value else 'false'}
+
+
+def tsv_term(term):
+    """
+    A term of a JSON result row written the way GraphDB writes it in a TSV result, numbers and booleans bare.
+    """
+    if term is None:
+        return ""
+    if term['type'] == 'uri':
+        return "<{}>".format(term['value'])
+    if term['type'] == 'bnode':
+        return "_:" + term['value']
+    if term.get('datatype') in (XSD_DECIMAL, XSD_BOOLEAN):
+        return term['value']
+    value = term['value'].replace('\\', '\\\\').replace('"', '\\"').replace('\t', '\\t').replace('\n', '\\n')
+    if 'datatype' in term:
+        return '"{}"^^<{}>'.format(value, term['datatype'])
+    return '"{}"'.format(value)
+
+
+def tsv_result(variables, rows):
+    lines = ["\t".join("?" + v for v in variables)]
+    lines.extend("\t".join(tsv_term(row.get(v)) for v in variables) for row in rows)
+    return "\n".join(lines) + "\n"
+
+
+class FakeService(object):
+    """
+    Base of the HTTP stand-ins: an aiohttp application on 127.0.0.1, with a fixed latency per request
+    and a count of the requests it has served, by kind.
+    """
+
+    def __init__(self, world, latency=0.0):
+        """
+        :param latency: seconds added to every response
+        :type latency: float
+        """
+        self.world = world
+        self.latency = latency
+        self.calls = Counter()
+        self.runner = None
+        self.port = None
+
+    def routes(self, app):
+        raise NotImplementedError()
+
+    async def start(self, port=0):
+        app = web.Application()
+        self.routes(app)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.port)
+
+    async def delay(self, seconds=0.0):
+        seconds += self.latency
+        if seconds > 0:
+            await asyncio.sleep(seconds)
+
+
+class FakeSparql(FakeService):
+    """
+    GraphDB stand-in, serving POSTs to /repositories/loci-cache.
+    """
+
+    def __init__(self, world, latency=0.0, row_latency=0.0, geometry_url=None, geometries_per_feature=2):
+        """
+        :param row_latency: seconds added per result row, for queries that get slower with their result size
+        :type row_latency: float
+        :param geometry_url: base url of the geometry stand-in, for the geo:hasGeometry of each feature
+        :type geometry_url: str
+        """
+        super(FakeSparql, self).__init__(world, latency)
+        self.row_latency = row_latency
+        self.geometry_url = geometry_url
+        self.geometries_per_feature = geometries_per_feature
+
+    def routes(self, app):
+        app.router.add_post('/repositories/loci-cache', self.handle)
+
+    async def handle(self, request):
+        form = await request.post()
+        query = form['query']
+        limit = int(form.get('limit', 1000))
+        offset = int(form.get('offset', 0))
+        kind, variables, rows = self.answer(query)
+        self.calls[kind] += 1
+        rows = rows[offset:offset + limit]
+        await self.delay(self.row_latency * len(rows))
+        if 'text/tab-separated-values' in request.headers.get('Accept', ''):
+            return web.Response(text=tsv_result(variables, rows), content_type='text/tab-separated-values')
+        return web.json_response({'head': {'vars': variables}, 'results': {'bindings': rows}})
+
+    def answer(self, query):
+        """
+        :return: the kind of the query, its variables and all its result rows
+        :rtype: tuple
+        """
+        w = self.world
+        if 'VALUES ?s {' in query:
+            values = query.split('VALUES ?s {', 1)[1].split('}', 1)[0]
+            rows = [{'s': uri(s), 't': uri(w.types[s])} for s in _URI.findall(values) if s in w.types]
+            return 'types', ['s', 't'], rows
+        if 'BIND(EXISTS{' in query:
+            target, type_uri = _EXISTS.search(query).groups()
+            return 'check_type', ['a'], [{'a': boolean(w.types.get(target) == type_uri)}]
+        if 'geo:hasGeometry' in query:
+            feature = _FEATURE.search(query).group(1)
+            return 'geometry_uris', ['geom'], [{'geom': uri(g)} for g in self.geometry_uris(feature)]
+        if 'SELECT DISTINCT ?p ?o ?p1 ?o1 ?p2 ?o2' in query:
+            return 'resource', ['p', 'o', 'p1', 'o1', 'p2', 'o2'], self.resource_rows(_URI.findall(query)[-1])
+        if 'BIND(true as ?c)' in query:
+            return 'contains', ['c', 'o', 'uarea', 'oarea'], self.relation_rows(query, 'c', w.contains)
+        if 'BIND(true as ?w)' in query:
+            return 'within', ['w', 'o', 'uarea', 'oarea'], self.relation_rows(query, 'w', w.within)
+        if 'geox:transitiveSfOverlap' in query and 'GROUP BY ?o' in query:
+            return 'overlaps', ['o', 'uarea', 'oarea', 'iarea'], self.overlap_rows(query)
+        chain = _CHAIN.search(query)
+        if chain is not None:
+            target, relation = chain.groups()
+            found = w.within(target) if relation == 'Within' else w.contains(target)
+            return relation.lower(), ['l'], [{'l': uri(u)} for u in found]
+        return 'other', [], []
+
+    def geometry_uris(self, feature):
+        if feature not in self.world.types or self.geometry_url is None:
+            return []
+        dataset, feature_id = feature.rstrip('/').rsplit('/', 2)[-2:]
+        return ["{}/geometry/{}/{}/{}".format(self.geometry_url, dataset, feature_id, g)
+                for g in range(self.geometries_per_feature)]
+
+    def resource_rows(self, target):
+        w = self.world
+        if target not in w.types:
+            return []
+        rows = [{'p': uri(RDF_TYPE), 'o': uri(w.types[target])}]
+        if target in w.areas:
+            area = {'type': 'bnode', 'value': 'area-' + target.rsplit('/', 1)[-1]}
+            rows.append({'p': uri(HAS_AREA), 'o': area, 'p1': uri(IN_CRS), 'o1': uri(EPSG_3577)})
+            rows.append({'p': uri(HAS_AREA), 'o': area, 'p1': uri(DT_VALUE), 'o1': decimal(w.areas[target])})
+        for parent in w.within(target)[:1]:
+            rows.append({'p': uri("http://www.opengis.net/ont/geosparql#sfWithin"), 'o': uri(parent)})
+        return rows
+
+    def _area_columns(self, query, target, other):
+        columns = {}
+        if '?uarea' in query:
+            columns['uarea'] = decimal(self.world.areas[target])
+            columns['oarea'] = decimal(self.world.areas[other])
+        return columns
+
+    def relation_rows(self, query, flag, relation):
+        target = _SUBJECT.search(query).group(1)
+        if target not in self.world.types:
+            return []
+        rows = []
+        for other in relation(target):
+            row = {flag: boolean(True), 'o': uri(other)}
+            row.update(self._area_columns(query, target, other))
+            rows.append(row)
+        return rows
+
+    def overlap_rows(self, query):
+        target = _SUBJECT.search(query).group(1)
+        linkset = _LINKSET.search(query)
+        # the overlaps are all in the mb16cc linkset, so any other linkset filter matches none of them
+        if target not in self.world.types or (linkset is not None and linkset.group(1) != MB16CC):
+            return []
+        rows = []
+        for other, intersection in self.world.overlaps.get(target, []):
+            row = {'o': uri(other)}
+            row.update(self._area_columns(query, target, other))
+            if '?iarea' in query:
+                row['iarea'] = decimal(intersection)
+            rows.append(row)
+        return rows
+
+
+class FakeGeometryService(FakeService):
+    """
+    Geometry Data Service stand-in, for /search/latlng point lookups, and the host of the geometry uris.
+    Every geometry is a GeoJSON polygon of the configured number of vertices.
+    """
+
+    def __init__(self, world, latency=0.0, vertices=500):
+        super(FakeGeometryService, self).__init__(world, latency)
+        self.vertices = vertices
+
+    def routes(self, app):
+        app.router.add_get('/search/latlng/{point}', self.search)
+        app.router.add_get('/search/latlng/{point}/dataset/{dataset}', self.search)
+        app.router.add_get('/geometry/{dataset}/{id}/{n}', self.geometry)
+
+    async def search(self, request):
+        self.calls['search'] += 1
+        await self.delay()
+        lon, lat = (float(v) for v in request.match_info['point'].split(','))
+        dataset = request.match_info.get('dataset', None)
+        res = []
+        mb = self.world.mb_at(lon, lat)
+        if mb is not None:
+            found = [('mb', mb)] + [('cc', cc) for cc, a in self.world.overlaps[mb]]
+            for name, feature in found:
+                if dataset is None or dataset == name:
+                    res.append({'dataset': name, 'id': feature.rsplit('/', 1)[-1], 'feature': feature})
+        return web.json_response({'count': len(res), 'res': res})
+
+    async def geometry(self, request):
+        self.calls['geometry'] += 1
+        await self.delay()
+        n = int(request.match_info['n'])
+        x = 145.0 + (zlib.crc32(request.match_info['id'].encode('utf-8')) % 1000) / 1000.0
+        y = -38.0 + n / 1000.0
+        ring = [[round(x + 0.001 * math.cos(2 * math.pi * i / self.vertices), 7),
+                 round(y + 0.001 * math.sin(2 * math.pi * i / self.vertices), 7)] for i in range(self.vertices)]
+        ring.append(ring[0])
+        body = {'type': 'Polygon', 'coordinates': [ring]}
+        return web.Response(text=json.dumps(body), content_type='application/json')
+
+
+class FakeElasticSearch(FakeService):
+    """
+    ElasticSearch stand-in, for the /_search?q= label search, matching labels by substring.
+    """
+
+    def routes(self, app):
+        app.router.add_get('/_search', self.search)
+
+    async def search(self, request):
+        self.calls['search'] += 1
+        await self.delay()
+        q = request.query.get('q', '').lower()
+        hits = []
+        for feature in self.world.sa1s + self.world.sa2s + self.world.rrs:
+            label = "{} {}".format(self.world.types[feature].rsplit('#', 1)[-1], feature.rsplit('/', 1)[-1])
+            if q in label.lower():
+                hits.append({'_index': 'loci', '_id': feature, '_score': 1.0,
+                             '_source': {'uri': feature, 'label': label}})
+        return web.json_response({'took': 1, 'timed_out': False,
+                                  'hits': {'total': {'value': len(hits), 'relation': 'eq'},
+                                           'max_score': 1.0 if hits else None, 'hits': hits[:10]}})
+
+
+class _Parameter(object):
+    __slots__ = ("name",)
+
+    def __init__(self, name):
+        self.name = name
+
+
+class FakePgStatement(object):
+    """
+    A prepared statement of the DGGS table queries in functions_DGGS.
+    """
+    _WHERE = re.compile(r'where (\w+) ?= ?(ANY\()?\$1', re.IGNORECASE)
+    _SELECT = re.compile(r'select\s+(.*?)\s+from', re.IGNORECASE | re.DOTALL)
+
+    def __init__(self, pool, sql):
+        self.pool = pool
+        column, is_array = self._WHERE.search(sql).groups()
+        self.column = column
+        self.is_array = is_array is not None
+        self.columns = [c.strip() for c in self._SELECT.search(sql).group(1).split(',')]
+
+    def get_parameters(self):
+        return (_Parameter('_varchar' if self.is_array else 'varchar'),)
+
+    def _rows(self, values):
+        world = self.pool.world
+        rows = []
+        if self.column == 'auspix_dggs':
+            for value in values:
+                if value in world.dggs_rows:
+                    rows.append(dict(zip(('sa1_main16', 'sa2_main16', 'sa3_code16', 'lga_code19', 'ssc_code16'),
+                                         world.dggs_rows[value]), auspix_dggs=value))
+        else:
+            position = ('sa1_main16', 'sa2_main16', 'sa3_code16', 'lga_code19', 'ssc_code16').index(self.column)
+            wanted = set(values)
+            for cell_id, codes in world.dggs_rows.items():
+                if codes[position] in wanted:
+                    rows.append(dict(zip(('sa1_main16', 'sa2_main16', 'sa3_code16', 'lga_code19', 'ssc_code16'),
+                                         codes), auspix_dggs=cell_id))
+        return [tuple(row[c] for c in self.columns) for row in rows]
+
+    async def fetch(self, value):
+        self.pool.calls['fetch'] += 1
+        await self.pool.delay()
+        return self._rows(value if self.is_array else [value])
+
+    async def fetchrow(self, value):
+        self.pool.calls['fetchrow'] += 1
+        await self.pool.delay()
+        rows = self._rows([value])
+        return rows[0] if rows else None
+
+
+class FakePgConnection(object):
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def prepare(self, sql):
+        return FakePgStatement(self.pool, sql)
+
+
+class _Acquire(object):
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def __aenter__(self):
+        await self.pool.semaphore.acquire()
+        return FakePgConnection(self.pool)
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.pool.semaphore.release()
+        return False
+
+
+class FakePgPool(object):
+    """
+    In-process stand-in for the asyncpg pool of the DGGS database, with the pool's connection limit and a fixed
+    latency per statement execution.
+    """
+
+    def __init__(self, world, latency=0.0, max_size=10):
+        self.world = world
+        self.latency = latency
+        self.max_size = max_size
+        self.calls = Counter()
+        self._semaphore = None
+
+    @property
+    def semaphore(self):
+        # created on first use, so it belongs to the running event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_size)
+        return self._semaphore
+
+    def acquire(self):
+        return _Acquire(self)
+
+    async def delay(self):
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+
+    async def close(self):
+        pass
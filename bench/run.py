@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+#
+"""
+Benchmark the API offline, against local stand-ins of its upstream services (see fakes.py), eg
+    python bench/run.py --requests 200 --concurrency 10 --sparql-latency 0.005 --json before.json
+    python bench/run.py --requests 200 --concurrency 10 --sparql-latency 0.005 --compare before.json
+
+The stand-ins and the API run in this one process and event loop, and the API is driven through its HTTP routes.
+Every scenario reports its throughput, p50 and p99 latency, the requests the stand-ins served while it ran
+and the peak memory of the process.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import os
+import socket
+import sys
+import time
+import tracemalloc
+from collections import Counter, OrderedDict
+from functools import partial
+
+HERE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(1, os.path.dirname(HERE_DIR))
+
+import aiohttp
+from world import World, CONTRACTED_CATCHMENT, RIVER_REGION, SA1
+from fakes import FakeSparql, FakeGeometryService, FakeElasticSearch, FakePgPool
+
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+
+
+def _overlaps(uri, **args):
+    params = {'uri': uri, 'areas': 'true', 'proportion': 'true'}
+    params.update(args)
+    return 'GET', '/api/v1/location/overlaps', params, None
+
+
+# name -> function of (world, request number) returning the method, path, query args and JSON body of a request
+SCENARIOS = OrderedDict([
+    ('overlaps', lambda w, i: _overlaps(w.mbs[i % len(w.mbs)])),
+    ('overlaps_contains_within', lambda w, i: _overlaps(w.sa1s[i % len(w.sa1s)], contains='true', within='true')),
+    ('crosswalk', lambda w, i: _overlaps(w.sa1s[i % len(w.sa1s)], crosswalk='true', output_type=CONTRACTED_CATCHMENT)),
+    # up the other hierarchy from its base units, so through their parents
+    ('crosswalk_to_parent', lambda w, i: _overlaps(w.sa1s[i % len(w.sa1s)], crosswalk='true', output_type=RIVER_REGION)),
+    ('crosswalk_common_base', lambda w, i: _overlaps(w.sa2s[i % len(w.sa2s)], crosswalk='true', output_type=SA1)),
+    ('resource', lambda w, i: ('GET', '/api/v1/resource', {'uri': w.mbs[i % len(w.mbs)]}, None)),
+    ('geometry', lambda w, i: ('GET', '/api/v1/location/geometry',
+                               {'uri': w.mbs[i % len(w.mbs)], 'view': 'geometryview'}, None)),
+    ('find_at_location', lambda w, i: ('GET', '/api/v1/location/find_at_location',
+                                       dict(zip(('lon', 'lat'), w.mb_point(i)), loci_type='mb'), None)),
+    ('find_by_label', lambda w, i: ('GET', '/api/v1/location/find-by-label',
+                                    {'query': w.sa1s[i % len(w.sa1s)].rsplit('/', 1)[-1]}, None)),
+    ('to_dggs', lambda w, i: ('GET', '/api/v1/location/to-DGGS', {'uri': w.sa1s[i % len(w.sa1s)]}, None)),
+    ('to_dggs_batch', lambda w, i: ('POST', '/api/v1/location/to-DGGS', None,
+                                    {'uris': [w.sa1s[(i + k) % len(w.sa1s)] for k in range(20)]})),
+    ('find_at_dggs_cell', lambda w, i: ('GET', '/api/v1/location/find-at-DGGS-cell',
+                                        {'dggs_cell': sorted(w.dggs_rows)[i % len(w.dggs_rows)]}, None)),
+    ('find_at_dggs_cell_batch', lambda w, i: ('POST', '/api/v1/location/find-at-DGGS-cell', None,
+                                              {'dggs_cells': [sorted(w.dggs_rows)[(i * 20 + k) % len(w.dggs_rows)]
+                                                              for k in range(20)]})),
+])
+
+
+def percentile(sorted_values, p):
+    """
+    Nearest-rank percentile of an ascending list
+    """
+    if not sorted_values:
+        return float('nan')
+    rank = max(1, int(-(-p * len(sorted_values) // 100)))
+    return sorted_values[rank - 1]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+class Upstreams(object):
+    """
+    The running stand-ins, and the counts of the requests they have served.
+    """
+
+    def __init__(self, world, args):
+        self.geometry = FakeGeometryService(world, args.gds_latency, args.geometry_vertices)
+        self.sparql = FakeSparql(world, args.sparql_latency, args.sparql_row_latency,
+                                 geometries_per_feature=args.geometries_per_feature)
+        self.es = FakeElasticSearch(world, args.es_latency)
+        self.pg = FakePgPool(world, args.pg_latency, args.pg_pool_size)
+
+    async def start(self):
+        await self.geometry.start()
+        self.sparql.geometry_url = self.geometry.url
+        await self.sparql.start()
+        await self.es.start()
+
+    async def stop(self):
+        for service in (self.sparql, self.geometry, self.es):
+            await service.stop()
+
+    def configure(self):
+        """
+        Point the API settings at the stand-ins. Must be done before the API modules are imported.
+        """
+        os.environ['TRIPLESTORE_CACHE_URL'] = "http://127.0.0.1"
+        os.environ['TRIPLESTORE_CACHE_PORT'] = str(self.sparql.port)
+        os.environ['GEOM_DATA_SVC_ENDPOINT'] = self.geometry.url
+        os.environ['ES_URL'] = "http://127.0.0.1"
+        os.environ['ES_PORT'] = str(self.es.port)
+        os.environ['USE_LOCAL_LOCI_DATATYPES_STATIC_JSON'] = "true"
+        os.environ.setdefault('PG_TABLE', "dggs")
+
+    def counts(self):
+        counts = Counter()
+        for name, calls in (('sparql', self.sparql.calls), ('gds', self.geometry.calls), ('es', self.es.calls),
+                            ('postgres', self.pg.calls)):
+            for kind, n in calls.items():
+                counts["{}.{}".format(name, kind)] += n
+        return counts
+
+
+async def drive(session, base_url, world, scenario, requests, concurrency, first=0):
+    """
+    Send requests of a scenario, at most concurrency at a time.
+    :return: the latency of each request in seconds, the number of failed requests, and the wall time
+    :rtype: tuple
+    """
+    make_request = SCENARIOS[scenario]
+    latencies = []
+    errors = 0
+    next_request = iter(range(first, first + requests))
+
+    async def worker():
+        nonlocal errors
+        for i in next_request:
+            method, path, params, body = make_request(world, i)
+            started = time.perf_counter()
+            try:
+                async with session.request(method, base_url + path, params=params, json=body) as resp:
+                    await resp.read()
+                    if resp.status != 200:
+                        errors += 1
+            except aiohttp.ClientError:
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return latencies, errors, time.perf_counter() - started
+
+
+async def trigger_listeners(app, event):
+    """
+    Run the app's listeners of a server event, as app.run would
+    """
+    listeners = app.listeners[event]
+    if event.endswith('_stop'):
+        listeners = reversed(listeners)
+    await app.trigger_events([partial(listener, app) for listener in listeners], asyncio.get_event_loop())
+
+
+async def run(args):
+    world = World(sa2s=args.sa2s, sa1s_per_sa2=args.sa1s_per_sa2, mbs_per_sa1=args.mbs_per_sa1,
+                  mbs_per_cc=args.mbs_per_cc)
+    upstreams = Upstreams(world, args)
+    await upstreams.start()
+    upstreams.configure()
+    # the API reads its settings when it is imported, so only import it now the stand-ins are listening
+    import functions_DGGS
+    from app import create_app
+    functions_DGGS.pg_pool = upstreams.pg
+    app = create_app()
+    port = args.port or free_port()
+    # create_server starts listening, the other server listeners are left to us
+    server = await app.create_server(host='127.0.0.1', port=port, return_asyncio_server=True, access_log=False)
+    await trigger_listeners(app, 'after_server_start')
+    base_url = "http://127.0.0.1:{}".format(port)
+
+    results = OrderedDict()
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        for scenario in args.scenario or SCENARIOS.keys():
+            await drive(session, base_url, world, scenario, args.warmup, min(args.concurrency, max(args.warmup, 1)))
+            gc.collect()
+            if args.tracemalloc:
+                tracemalloc.start()
+            before = upstreams.counts()
+            latencies, errors, wall = await drive(session, base_url, world, scenario, args.requests,
+                                                  args.concurrency, first=args.warmup)
+            calls = upstreams.counts() - before
+            latencies.sort()
+            result = OrderedDict([
+                ('requests', len(latencies)),
+                ('errors', errors),
+                ('requestsPerSecond', round(len(latencies) / wall, 2)),
+                ('p50Ms', round(percentile(latencies, 50) * 1000, 2)),
+                ('p99Ms', round(percentile(latencies, 99) * 1000, 2)),
+                ('upstreamCalls', sum(calls.values())),
+                ('upstreamCallsByKind', OrderedDict(sorted(calls.items()))),
+                ('peakRssMb', peak_rss_mb()),
+            ])
+            if args.tracemalloc:
+                result['peakTracedMb'] = round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 1)
+                tracemalloc.stop()
+            results[scenario] = result
+            print_result(scenario, result)
+
+    await trigger_listeners(app, 'before_server_stop')
+    await server.close()
+    await trigger_listeners(app, 'after_server_stop')
+    await upstreams.stop()
+    return results
+
+
+HEADER = "{:<26} {:>8} {:>6} {:>9} {:>9} {:>9} {:>9} {:>9}".format(
+    "scenario", "requests", "errors", "req/s", "p50 ms", "p99 ms", "upstream", "rss MB")
+
+
+def print_result(scenario, result):
+    if print_result.first:
+        print(HEADER)
+        print_result.first = False
+    print("{:<26} {:>8} {:>6} {:>9} {:>9} {:>9} {:>9} {:>9}".format(
+        scenario, result['requests'], result['errors'], result['requestsPerSecond'], result['p50Ms'],
+        result['p99Ms'], result['upstreamCalls'], result['peakRssMb'] if result['peakRssMb'] is not None else '-'))
+    details = ["{}={}".format(k, v) for k, v in result['upstreamCallsByKind'].items()]
+    if 'peakTracedMb' in result:
+        details.append("traced_peak_mb={}".format(result['peakTracedMb']))
+    print("    " + " ".join(details))
+
+
+print_result.first = True
+
+
+def print_comparison(previous, results):
+    """
+    Print the change in throughput, latency and upstream calls of each scenario since a previous run
+    """
+    print()
+    print("{:<26} {:>10} {:>10} {:>10} {:>10}".format("change since previous", "req/s", "p50", "p99", "upstream"))
+    for scenario, result in results.items():
+        before = previous.get('results', {}).get(scenario, None)
+        if before is None:
+            continue
+        changes = []
+        for key in ('requestsPerSecond', 'p50Ms', 'p99Ms', 'upstreamCalls'):
+            if before[key]:
+                changes.append("{:+.1f}%".format((result[key] - before[key]) * 100.0 / before[key]))
+            else:
+                changes.append("-")
+        print("{:<26} {:>10} {:>10} {:>10} {:>10}".format(scenario, *changes))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the API against local stand-in upstream services.")
+    parser.add_argument('--scenario', action='append', choices=list(SCENARIOS.keys()),
+                        help="scenario to run, repeat for several, all of them by default")
+    parser.add_argument('--requests', type=int, default=200, help="measured requests per scenario")
+    parser.add_argument('--warmup', type=int, default=10, help="unmeasured requests before each scenario")
+    parser.add_argument('--concurrency', type=int, default=10, help="requests in flight at a time")
+    parser.add_argument('--timeout', type=float, default=300, help="seconds allowed for each request")
+    parser.add_argument('--port', type=int, default=0, help="port of the API, any free port by default")
+    parser.add_argument('--sparql-latency', type=float, default=0.0, help="seconds added to every SPARQL query")
+    parser.add_argument('--sparql-row-latency', type=float, default=0.0,
+                        help="seconds added to a SPARQL query per result row")
+    parser.add_argument('--gds-latency', type=float, default=0.0,
+                        help="seconds added to every geometry data service and geometry request")
+    parser.add_argument('--es-latency', type=float, default=0.0, help="seconds added to every label search")
+    parser.add_argument('--pg-latency', type=float, default=0.0, help="seconds added to every DGGS database query")
+    parser.add_argument('--pg-pool-size', type=int, default=10, help="connections of the stand-in DGGS pool")
+    parser.add_argument('--geometry-vertices', type=int, default=500, help="vertices of every geometry")
+    parser.add_argument('--geometries-per-feature', type=int, default=2, help="geometries of every feature")
+    parser.add_argument('--sa2s', type=int, default=4, help="SA2s in the synthetic data")
+    parser.add_argument('--sa1s-per-sa2', type=int, default=5, help="SA1s in each SA2")
+    parser.add_argument('--mbs-per-sa1', type=int, default=20, help="meshblocks in each SA1")
+    parser.add_argument('--mbs-per-cc', type=int, default=7, help="meshblocks overlapping each contracted catchment")
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help="also report the peak memory allocated by Python during each scenario (slow)")
+    parser.add_argument('--json', help="write the results to this file")
+    parser.add_argument('--compare', help="compare the results with those of a previous run written with --json")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.ERROR)
+    loop = asyncio.get_event_loop()
+    results = loop.run_until_complete(run(args))
+    settings = OrderedDict((k, v) for k, v in sorted(vars(args).items()) if k not in ('json', 'compare'))
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(json.load(f), results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(OrderedDict([('settings', settings), ('results', results)]), f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
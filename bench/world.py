@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+#
+"""
+A small synthetic LOCI cache for the benchmarks: two spatial hierarchies with different base units.
+
+    ASGS 2016:  MeshBlock within SA1 within SA2
+    Geofabric:  ContractedCatchment within RiverRegion
+
+The meshblocks and contracted catchments overlap through the mb16cc linkset. The meshblocks are laid out in a row,
+each catchment covers a run of them, and the last meshblock of each run is split between two catchments.
+Everything is derived from the size settings and a seed, so two runs with the same settings see the same data.
+"""
+import random
+
+ASGS = "http://linked.data.gov.au/dataset/asgs2016/"
+GEOFABRIC = "http://linked.data.gov.au/dataset/geofabric/"
+MB16CC = "http://linked.data.gov.au/dataset/mb16cc"
+
+MESHBLOCK = "http://linked.data.gov.au/def/asgs#MeshBlock"
+SA1 = "http://linked.data.gov.au/def/asgs#StatisticalAreaLevel1"
+SA2 = "http://linked.data.gov.au/def/asgs#StatisticalAreaLevel2"
+CONTRACTED_CATCHMENT = "http://linked.data.gov.au/def/geofabric#ContractedCatchment"
+RIVER_REGION = "http://linked.data.gov.au/def/geofabric#RiverRegion"
+
+# Meshblocks are laid out on a grid of cells this many degrees wide, from this corner
+GRID_ORIGIN = (145.0, -38.0)
+GRID_CELL = 0.001
+GRID_COLUMNS = 100
+
+
+class World(object):
+    """
+    The features of the synthetic cache, their areas and the relations between them.
+    """
+
+    def __init__(self, sa2s=4, sa1s_per_sa2=5, mbs_per_sa1=20, mbs_per_cc=7, ccs_per_rr=5, dggs_cells_per_sa1=8, seed=1):
+        rng = random.Random(seed)
+        self.types = {}
+        self.areas = {}
+        self.parent = {}
+        self.children = {}
+        # uri -> [(other uri, intersection area)] through the mb16cc linkset
+        self.overlaps = {}
+        self.sa2s, self.sa1s, self.mbs, self.ccs, self.rrs = [], [], [], [], []
+        # DGGS cell id -> (sa1, sa2, sa3, lga, ssc) codes, and the cells of each SA1 code
+        self.dggs_rows = {}
+        self.dggs_cells = {}
+
+        cell = 0
+        for i in range(sa2s):
+            sa2 = self._add(ASGS + "statisticalarealevel2/{}".format(201011000 + i), SA2)
+            self.sa2s.append(sa2)
+            for j in range(sa1s_per_sa2):
+                code = "2{:04d}{:02d}".format(1100 + i, j)
+                sa1 = self._add(ASGS + "statisticalarealevel1/{}".format(code), SA1, sa2)
+                self.sa1s.append(sa1)
+                for k in range(mbs_per_sa1):
+                    mb = self._add(ASGS + "meshblock/{}".format(20000000000 + len(self.mbs)), MESHBLOCK, sa1)
+                    self.areas[mb] = round(rng.uniform(1e4, 1e6), 4)
+                    self.mbs.append(mb)
+                cells = []
+                for k in range(dggs_cells_per_sa1):
+                    cell_id = "R{:010d}".format(7000000000 + cell)
+                    cell += 1
+                    cells.append(cell_id)
+                    self.dggs_rows[cell_id] = (code, str(201011000 + i), str(20101 + i // 4),
+                                               str(10050 + i % 3), str(10001 + i))
+                self.dggs_cells[code] = cells
+
+        for n, mb in enumerate(self.mbs):
+            c = n // mbs_per_cc
+            if c == len(self.ccs):
+                if c % ccs_per_rr == 0:
+                    self.rrs.append(self._add(GEOFABRIC + "riverregion/{}".format(9400000 + len(self.rrs)), RIVER_REGION))
+                self.ccs.append(self._add(GEOFABRIC + "contractedcatchment/{}".format(12100000 + c),
+                                          CONTRACTED_CATCHMENT, self.rrs[-1]))
+            cc = self.ccs[c]
+            area = self.areas[mb]
+            last_of_run = n % mbs_per_cc == mbs_per_cc - 1 and n + 1 < len(self.mbs)
+            if last_of_run:
+                # split between this catchment and the next one
+                share = round(area * rng.uniform(0.2, 0.8), 4)
+                self._overlap(mb, cc, share)
+                self._overlap(mb, "next", round(area - share, 4))
+            else:
+                self._overlap(mb, cc, area)
+        # resolve the second halves of the split meshblocks, now that every catchment exists
+        for n, mb in enumerate(self.mbs):
+            self.overlaps[mb] = [(self.ccs[n // mbs_per_cc + 1] if other == "next" else other, a)
+                                 for other, a in self.overlaps[mb]]
+        for mb in self.mbs:
+            for cc, a in self.overlaps[mb]:
+                self.overlaps.setdefault(cc, []).append((mb, a))
+
+        # parent areas are the sums of their parts
+        for cc in self.ccs:
+            self.areas[cc] = round(sum(a for mb, a in self.overlaps[cc]), 4)
+        for parents in (self.sa1s, self.sa2s, self.rrs):
+            for uri in parents:
+                self.areas[uri] = round(sum(self.areas[c] for c in self.children[uri]), 4)
+
+    def _add(self, uri, type_uri, parent=None):
+        self.types[uri] = type_uri
+        self.children[uri] = []
+        if parent is not None:
+            self.parent[uri] = parent
+            self.children[parent].append(uri)
+        return uri
+
+    def _overlap(self, mb, cc, area):
+        self.overlaps.setdefault(mb, []).append((cc, area))
+
+    def within(self, uri):
+        """
+        :return: everything uri is (transitively) within
+        """
+        found = []
+        while uri in self.parent:
+            uri = self.parent[uri]
+            found.append(uri)
+        return found
+
+    def contains(self, uri):
+        """
+        :return: everything uri (transitively) contains
+        """
+        found = []
+        stack = list(reversed(self.children.get(uri, [])))
+        while stack:
+            child = stack.pop()
+            found.append(child)
+            stack.extend(reversed(self.children.get(child, [])))
+        return found
+
+    def mb_at(self, lon, lat):
+        """
+        :return: the meshblock whose grid cell holds the point, or None
+        """
+        col = int((lon - GRID_ORIGIN[0]) // GRID_CELL)
+        row = int((lat - GRID_ORIGIN[1]) // GRID_CELL)
+        n = row * GRID_COLUMNS + col
+        if col < 0 or col >= GRID_COLUMNS or row < 0 or n >= len(self.mbs):
+            return None
+        return self.mbs[n]
+
+    def mb_point(self, n):
+        """
+        :return: (lon, lat) of the centre of the grid cell of meshblock n
+        """
+        n = n % len(self.mbs)
+        return (GRID_ORIGIN[0] + (n % GRID_COLUMNS + 0.5) * GRID_CELL,
+                GRID_ORIGIN[1] + (n // GRID_COLUMNS + 0.5) * GRID_CELL)
+
+    def dggs_code(self, sa1_uri):
+        return sa1_uri.rsplit('/', 1)[-1]
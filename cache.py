@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+#
+"""
+In-process caches for upstream results.
+"""
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    A least-recently-used cache, bounded by number of entries and by approximate size in bytes,
+    with optional expiry of entries after ttl seconds.
+    Not thread safe, it is intended to be used from the event loop only.
+    """
+    __slots__ = ("max_entries", "max_bytes", "ttl", "size_of", "on_evict", "_entries", "_bytes",
+                 "hits", "misses", "evictions", "expirations")
+
+    def __init__(self, max_entries=1024, max_bytes=None, ttl=None, size_of=len, on_evict=None):
+        """
+        :param max_entries: maximum number of entries, None for no limit
+        :type max_entries: int
+        :param max_bytes: maximum total size of the values, None for no limit
+        :type max_bytes: int
+        :param ttl: seconds after which an entry expires, None for never
+        :type ttl: float
+        :param size_of: function giving the approximate size in bytes of a value
+        :param on_evict: function called with (key, value) of each entry evicted to make room
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size_of = size_of
+        self.on_evict = on_evict
+        # key -> (value, size, expires_at)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        entry = self._entries.get(key, None)
+        return entry is not None and (entry[2] is None or entry[2] > time.monotonic())
+
+    @property
+    def total_bytes(self):
+        return self._bytes
+
+    def get(self, key, default=None):
+        try:
+            value, size, expires_at = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        if expires_at is not None and expires_at <= time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Add or replace an entry. Values bigger than max_bytes are not stored.
+        :return: whether the value was stored
+        :rtype: bool
+        """
+        size = self.size_of(value) if self.max_bytes is not None else 0
+        if key in self._entries:
+            self._remove(key)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return False
+        if ttl is None:
+            ttl = self.ttl
+        expires_at = None if ttl is None else time.monotonic() + ttl
+        self._entries[key] = (value, size, expires_at)
+        self._bytes += size
+        self._evict()
+        return True
+
+    def pop(self, key, default=None):
+        try:
+            value = self._entries[key][0]
+        except KeyError:
+            return default
+        self._remove(key)
+        return value
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'bytes': self._bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hitRatio': (self.hits / lookups) if lookups else 0.0,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+    def _remove(self, key):
+        value, size, expires_at = self._entries.pop(key)
+        self._bytes -= size
+
+    def _evict(self):
+        while (self.max_entries is not None and len(self._entries) > self.max_entries) or \
+                (self.max_bytes is not None and self._bytes > self.max_bytes):
+            key, (value, size, expires_at) = self._entries.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+            if self.on_evict is not None:
+                self.on_evict(key, value)
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+#
+"""
+The JSON codec used for upstream responses and API responses.
+orjson is used when it is installed, it parses response bytes without decoding them to str first and
+serializes straight to bytes. Set JSON_CODEC=json to use the standard library json module instead.
+"""
+import json as stdlib_json
+from decimal import Decimal
+from sanic.response import json as sanic_json
+from config import JSON_CODEC
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Raised by loads for invalid JSON, orjson's error is a subclass of it
+JSONDecodeError = stdlib_json.JSONDecodeError
+
+
+def _default(obj):
+    if isinstance(obj, Decimal):
+        return float(obj)
+    raise TypeError("Object of type {} is not JSON serializable".format(type(obj).__name__))
+
+
+if orjson is not None and JSON_CODEC == 'orjson':
+    CODEC = 'orjson'
+    _OPTIONS = orjson.OPT_NON_STR_KEYS
+
+    def loads(data):
+        """
+        :param data: JSON text, as bytes or str
+        """
+        return orjson.loads(data)
+
+    def dumps(obj, **kwargs):
+        """
+        :return: the JSON text of obj, as utf-8 bytes
+        :rtype: bytes
+        """
+        return orjson.dumps(obj, default=_default, option=_OPTIONS)
+else:
+    CODEC = 'json'
+
+    def loads(data):
+        """
+        :param data: JSON text, as bytes or str
+        """
+        return stdlib_json.loads(data)
+
+    def dumps(obj, **kwargs):
+        """
+        :return: the JSON text of obj, as utf-8 bytes
+        :rtype: bytes
+        """
+        return stdlib_json.dumps(obj, default=_default, separators=(',', ':')).encode('utf-8')
+
+
+def json(body, status=200, headers=None, **kwargs):
+    """
+    sanic.response.json, serialized with this codec
+    """
+    return sanic_json(body, status=status, headers=headers, dumps=dumps, **kwargs)
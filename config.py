@@ -14,8 +14,12 @@ if TRIPLESTORE_CACHE_PORT is None or TRIPLESTORE_CACHE_PORT == '':
 TRIPLESTORE_CACHE_SPARQL_ENDPOINT = CONFIG["TRIPLESTORE_CACHE_SPARQL_ENDPOINT"] = \
     "{}:{}/repositories/loci-cache".format(TRIPLESTORE_CACHE_URL, TRIPLESTORE_CACHE_PORT)
 
-ES_URL = CONFIG["ES_URL"] = "http://elasticsearch"
-ES_PORT = CONFIG["ES_ENDPOINT"] = "9200"
+ES_URL = os.environ.get('ES_URL')
+if ES_URL is None or ES_URL == '':
+    ES_URL = CONFIG["ES_URL"] = "http://elasticsearch"
+ES_PORT = os.environ.get('ES_PORT')
+if ES_PORT is None or ES_PORT == '':
+    ES_PORT = CONFIG["ES_PORT"] = "9200"
 ES_ENDPOINT = CONFIG["ES_ENDPOINT"] = \
     "{}:{}/_search".format(ES_URL, ES_PORT)
 
@@ -37,8 +41,6 @@ if USE_LOCAL_LOCI_DATATYPES_STATIC_JSON is not None:
 else:
    USE_LOCAL_LOCI_DATATYPES_STATIC_JSON = CONFIG["USE_LOCAL_LOCI_DATATYPES_STATIC_JSON"] = False
 
-  
-
 PG_HOST = os.environ.get('PG_HOST')
 PG_PORT = os.environ.get('PG_PORT')
 PG_DB_NAME = os.environ.get('PG_DB_NAME')
@@ -46,4 +48,122 @@ PG_USER = os.environ.get('PG_USER')
 PG_PASSWORD = os.environ.get('PG_PASSWORD')
 PG_TABLE = os.environ.get('PG_TABLE')
 
-PG_ENDPOINT = f'host={PG_HOST} port={PG_PORT} dbname={PG_DB_NAME} user={PG_USER} password={PG_PASSWORD}'
+def env_number(name, default, cast=int):
+    """
+    Read a numeric setting from the environment, using default when it is unset or empty.
+    """
+    value = os.environ.get(name)
+    if value is None or value == '':
+        value = default
+    elif value.lower() == 'none':
+        value = None
+    else:
+        value = cast(value)
+    CONFIG[name] = value
+    return value
+
+# Upstream HTTP connection pools, one per upstream service.
+# <NAME>_MAX_CONNECTIONS is the pool size, <NAME>_MAX_CONNECTIONS_PER_HOST of 0 means no per-host limit,
+# timeouts are in seconds, a timeout of "none" disables it. The connect timeout is for opening a connection
+# only, a request waiting for a free connection of a full pool is not timed out.
+UPSTREAM_DNS_CACHE_TTL = env_number('UPSTREAM_DNS_CACHE_TTL', 300)
+UPSTREAM_KEEPALIVE_TIMEOUT = env_number('UPSTREAM_KEEPALIVE_TIMEOUT', 30, float)
+UPSTREAM_POOLS = CONFIG["UPSTREAM_POOLS"] = {
+    # GraphDB, the LOCI cache triplestore
+    'graphdb': {
+        'limit': env_number('GRAPHDB_MAX_CONNECTIONS', 100),
+        'limit_per_host': env_number('GRAPHDB_MAX_CONNECTIONS_PER_HOST', 0),
+        'connect_timeout': env_number('GRAPHDB_CONNECT_TIMEOUT', 10, float),
+        'read_timeout': env_number('GRAPHDB_READ_TIMEOUT', 900, float),
+    },
+    # Geometry Data Service
+    'gds': {
+        'limit': env_number('GDS_MAX_CONNECTIONS', 50),
+        'limit_per_host': env_number('GDS_MAX_CONNECTIONS_PER_HOST', 0),
+        'connect_timeout': env_number('GDS_CONNECT_TIMEOUT', 10, float),
+        'read_timeout': env_number('GDS_READ_TIMEOUT', 60, float),
+    },
+    # ElasticSearch label search
+    'es': {
+        'limit': env_number('ES_MAX_CONNECTIONS', 20),
+        'limit_per_host': env_number('ES_MAX_CONNECTIONS_PER_HOST', 0),
+        'connect_timeout': env_number('ES_CONNECT_TIMEOUT', 5, float),
+        'read_timeout': env_number('ES_READ_TIMEOUT', 30, float),
+    },
+    # Hosts serving the geometry uris of LOCI features
+    'geometry': {
+        'limit': env_number('GEOMETRY_MAX_CONNECTIONS', 100),
+        'limit_per_host': env_number('GEOMETRY_MAX_CONNECTIONS_PER_HOST', 20),
+        'connect_timeout': env_number('GEOMETRY_CONNECT_TIMEOUT', 10, float),
+        'read_timeout': env_number('GEOMETRY_READ_TIMEOUT', 120, float),
+    },
+    # loci.cat static resources, such as the LOCI datatypes json
+    'loci': {
+        'limit': env_number('LOCI_MAX_CONNECTIONS', 10),
+        'limit_per_host': env_number('LOCI_MAX_CONNECTIONS_PER_HOST', 0),
+        'connect_timeout': env_number('LOCI_CONNECT_TIMEOUT', 10, float),
+        'read_timeout': env_number('LOCI_READ_TIMEOUT', 30, float),
+    },
+}
+
+# Connection pool to the DGGS Postgres database, the statement timeout is in seconds, "none" disables it
+PG_POOL_MIN_SIZE = env_number('PG_POOL_MIN_SIZE', 2)
+PG_POOL_MAX_SIZE = env_number('PG_POOL_MAX_SIZE', 10)
+PG_STATEMENT_TIMEOUT = env_number('PG_STATEMENT_TIMEOUT', 30, float)
+
+# Number of geometries of one feature fetched at a time by /location/geometry,
+# and the total time allowed for fetching each of them in seconds, "none" for no limit beyond the pool timeouts
+GEOMETRY_FETCH_CONCURRENCY = env_number('GEOMETRY_FETCH_CONCURRENCY', 8)
+GEOMETRY_REQUEST_TIMEOUT = env_number('GEOMETRY_REQUEST_TIMEOUT', 60, float)
+
+# Cache of geometry service responses, bounded by total compressed size in bytes, 0 to disable it.
+# Set GEOMETRY_CACHE_DIR to also keep them on disk, up to GEOMETRY_CACHE_DISK_MAX_BYTES.
+GEOMETRY_CACHE_MAX_BYTES = env_number('GEOMETRY_CACHE_MAX_BYTES', 256 * 1024 * 1024)
+GEOMETRY_CACHE_DIR = CONFIG["GEOMETRY_CACHE_DIR"] = os.environ.get('GEOMETRY_CACHE_DIR') or None
+GEOMETRY_CACHE_DISK_MAX_BYTES = env_number('GEOMETRY_CACHE_DISK_MAX_BYTES', 4 * 1024 * 1024 * 1024)
+
+# GeoJSON files of the datasets find_at_location answers locally, as "dataset=path;dataset=path", unset to always use GDS
+POINT_INDEX_DATASETS = CONFIG["POINT_INDEX_DATASETS"] = os.environ.get('POINT_INDEX_DATASETS', '')
+
+# Number of concurrent GDS requests made by one batch find_at_location request
+GDS_BATCH_CONCURRENCY = env_number('GDS_BATCH_CONCURRENCY', 10)
+
+# In-process cache of SPARQL results, keyed on the query and its parameters.
+# Off by default, the LOCI cache data only changes when it is reloaded.
+SPARQL_CACHE_ENABLED = os.environ.get('SPARQL_CACHE_ENABLED', '')
+SPARQL_CACHE_ENABLED = CONFIG["SPARQL_CACHE_ENABLED"] = SPARQL_CACHE_ENABLED.lower() in ('true', '1', 'yes')
+SPARQL_CACHE_MAX_ENTRIES = env_number('SPARQL_CACHE_MAX_ENTRIES', 10000)
+SPARQL_CACHE_MAX_BYTES = env_number('SPARQL_CACHE_MAX_BYTES', 256 * 1024 * 1024)
+SPARQL_CACHE_TTL = env_number('SPARQL_CACHE_TTL', 3600, float)
+
+# Number of the base units of a crosswalk source feature worked on at a time
+CROSSWALK_CONCURRENCY = env_number('CROSSWALK_CONCURRENCY', 8)
+
+# Process-wide cache of the parents (with their areas) of the base units crosswalks pass through
+PARENT_CACHE_MAX_ENTRIES = env_number('PARENT_CACHE_MAX_ENTRIES', 100000)
+PARENT_CACHE_TTL = env_number('PARENT_CACHE_TTL', 3600, float)
+
+# Page size of the overlaps queries made by crosswalks, and how many of the following pages are fetched ahead of time
+OVERLAPS_PAGE_SIZE = env_number('OVERLAPS_PAGE_SIZE', 100000)
+OVERLAPS_PAGE_PREFETCH = env_number('OVERLAPS_PAGE_PREFETCH', 1)
+
+# Full /location/overlaps results kept for paging through with a cursor, and for how many seconds after the last page
+OVERLAPS_CURSOR_MAX_ENTRIES = env_number('OVERLAPS_CURSOR_MAX_ENTRIES', 1000)
+OVERLAPS_CURSOR_MAX_BYTES = env_number('OVERLAPS_CURSOR_MAX_BYTES', 256 * 1024 * 1024)
+OVERLAPS_CURSOR_TTL = env_number('OVERLAPS_CURSOR_TTL', 300, float)
+
+# Result format asked of the LOCI cache for list-shaped queries, "tsv" (parsed as it arrives) or "json"
+SPARQL_LIST_RESULTS_FORMAT = CONFIG["SPARQL_LIST_RESULTS_FORMAT"] = \
+    os.environ.get('SPARQL_LIST_RESULTS_FORMAT', '').lower() or 'tsv'
+
+# Seconds between reloads of the LOCI datatypes, 0 to only load them at startup
+LOCI_DATATYPES_REFRESH_INTERVAL = env_number('LOCI_DATATYPES_REFRESH_INTERVAL', 0, float)
+
+# Directory of the containment hierarchy index built by "python hierarchy_index.py build", unset to always use SPARQL
+HIERARCHY_INDEX_PATH = os.environ.get('HIERARCHY_INDEX_PATH')
+if HIERARCHY_INDEX_PATH == '':
+    HIERARCHY_INDEX_PATH = None
+HIERARCHY_INDEX_PATH = CONFIG["HIERARCHY_INDEX_PATH"] = HIERARCHY_INDEX_PATH
+
+# JSON codec for upstream and API responses, "orjson" (used when it is installed) or "json" for the standard library
+JSON_CODEC = CONFIG["JSON_CODEC"] = os.environ.get('JSON_CODEC', '').lower() or 'orjson'
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+#
+"""
+Area aggregation for crosswalks across spatial hierarchies.
+"""
+import math
+from collections import OrderedDict
+import numpy as np
+from hierarchy_index import format_area
+
+
+class CrosswalkAccumulator(object):
+    """
+    Collects how much of the crosswalk source feature reaches each target feature through the base units.
+
+    Every overlap of a source base unit with a base unit of the other hierarchy is a contribution of
+    (incoming area * overlap percentage / 100), which is added to that other base unit and to each of its parents.
+    The contributions and the targets they are added to are kept as arrays, so the target areas are one sparse
+    (target x contribution) matrix times contribution area vector product, rather than many dict updates.
+    """
+    __slots__ = ("_targets", "_feature_areas", "_records", "_unknown",
+                 "_incoming_areas", "_weights", "_edge_targets", "_edge_contributions")
+
+    def __init__(self):
+        # target uri -> target number, in first seen order
+        self._targets = OrderedDict()
+        self._feature_areas = []
+        # target number -> record with preset values, for targets that are not summed
+        self._records = {}
+        # target numbers whose areas are unknown
+        self._unknown = set()
+        # per contribution
+        self._incoming_areas = []
+        self._weights = []
+        # per (target, contribution) edge
+        self._edge_targets = []
+        self._edge_contributions = []
+
+    def __len__(self):
+        return len(self._targets)
+
+    def uris(self):
+        """
+        :return: the target uris, in first seen order
+        :rtype: list
+        """
+        return list(self._targets.keys())
+
+    def _target(self, uri, feature_area):
+        i = self._targets.get(uri, None)
+        if i is None:
+            i = self._targets[uri] = len(self._feature_areas)
+            self._feature_areas.append(feature_area)
+        return i
+
+    def add_contribution(self, area_incoming, percentage):
+        """
+        :param area_incoming: area of the source feature in the source base unit
+        :param percentage: percentage of the source base unit in the other base unit, may be NaN
+        :return: the contribution number, to pass to add
+        :rtype: int
+        """
+        self._incoming_areas.append(float(area_incoming))
+        self._weights.append(float(percentage) / 100)
+        return len(self._weights) - 1
+
+    def add(self, uri, contribution, feature_area=math.nan):
+        """
+        Add a contribution to a target. The feature area is only recorded the first time a target is seen.
+        """
+        self._edge_targets.append(self._target(uri, feature_area))
+        self._edge_contributions.append(contribution)
+
+    def set_record(self, uri, record):
+        """
+        Report a target with the given values instead of summing contributions for it.
+        """
+        i = self._target(uri, record.get("featureArea", math.nan))
+        self._records[i] = record
+        self._unknown.discard(i)
+
+    def set_unknown(self, uri):
+        """
+        Report a target with unknown (NaN) areas and proportions.
+        """
+        i = self._target(uri, math.nan)
+        self._unknown.add(i)
+        self._records.pop(i, None)
+
+    def merge(self, other):
+        """
+        Add everything collected by another accumulator, with the same result as if its calls had been made on this one
+        after the calls made so far. Parts of a crosswalk can be collected into their own accumulators concurrently,
+        then merged in the order the serial crosswalk would have made them, keeping the result the same.
+        """
+        contribution_offset = len(self._weights)
+        self._incoming_areas.extend(other._incoming_areas)
+        self._weights.extend(other._weights)
+        # other's target numbers are in its first seen order, so they index this list of their numbers here
+        targets = [self._target(uri, other._feature_areas[i]) for uri, i in other._targets.items()]
+        self._edge_targets.extend([targets[i] for i in other._edge_targets])
+        self._edge_contributions.extend([c + contribution_offset for c in other._edge_contributions])
+        # a target is in at most one of other's records and unknowns, whichever it was last set to
+        for i, record in other._records.items():
+            self._records[targets[i]] = record
+            self._unknown.discard(targets[i])
+        for i in other._unknown:
+            self._unknown.add(targets[i])
+            self._records.pop(targets[i], None)
+
+    def intersection_areas(self):
+        """
+        :return: the summed area of the source feature in each target, by target number
+        :rtype: np.ndarray
+        """
+        contributions = np.asarray(self._weights, dtype=np.float64) * np.asarray(self._incoming_areas, dtype=np.float64)
+        edge_contributions = np.asarray(self._edge_contributions, dtype=np.int64)
+        return np.bincount(np.asarray(self._edge_targets, dtype=np.int64),
+                           weights=contributions[edge_contributions], minlength=len(self._feature_areas))
+
+    def results(self, area_from_uri, include_areas, include_proportion, uris=None):
+        """
+        :param area_from_uri: area of the source feature
+        :param include_areas:
+        :param include_proportion:
+        :param uris: only report these targets, all targets when None
+        :return: the targets, in first seen order, as dicts formatted for the API
+        :rtype: list
+        """
+        intersection = self.intersection_areas()
+        feature = np.array([_to_float(a) for a in self._feature_areas], dtype=np.float64)
+        area_from_uri = _to_float(area_from_uri)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            forward = intersection / area_from_uri if area_from_uri != 0 else np.full(len(intersection), np.nan)
+            reverse = np.where(feature != 0, intersection / feature, np.nan)
+        # proportions of 1 and above are reported as exactly 100, NaN stays NaN
+        forward_capped = forward >= 1
+        reverse_capped = reverse >= 1
+        forward = forward * 100
+        reverse = reverse * 100
+        results = []
+        for uri, i in self._targets.items():
+            if uris is not None and uri not in uris:
+                continue
+            if i in self._records:
+                result = dict(self._records[i])
+            elif i in self._unknown:
+                result = {"uri": uri, "intersectionArea": math.nan, "featureArea": math.nan,
+                          "forwardPercentage": math.nan, "reversePercentage": math.nan}
+            else:
+                feature_area = self._feature_areas[i]
+                if isinstance(feature_area, float):
+                    feature_area = format_area(feature_area)
+                result = {"uri": uri, "intersectionArea": float(intersection[i]), "featureArea": feature_area}
+            if include_proportion:
+                if "forwardPercentage" not in result:
+                    result["forwardPercentage"] = "100" if forward_capped[i] else str(float(forward[i]))
+                if "reversePercentage" not in result:
+                    result["reversePercentage"] = "100" if reverse_capped[i] else str(float(reverse[i]))
+            else:
+                result.pop("forwardPercentage", None)
+                result.pop("reversePercentage", None)
+            if include_areas:
+                result["intersectionArea"] = str(result["intersectionArea"])
+            else:
+                result.pop("intersectionArea", None)
+                result.pop("featureArea", None)
+            for key, value in result.items():
+                if isinstance(value, float) and math.isnan(value):
+                    result[key] = "nan"
+            results.append(result)
+        return results
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+#
+"""
+Cursor paging of results computed in full on the first request.
+
+The first request (cursor=*) computes the whole ordered result and keeps it in a short-lived store, and is answered
+with its first page. Each page's meta has the nextCursor to ask for the page after it, so later pages are served
+from the store without querying upstream again. Cursors are opaque to clients.
+"""
+import base64
+import binascii
+import secrets
+from codec import dumps
+from cache import LRUCache
+from config import OVERLAPS_CURSOR_MAX_ENTRIES, OVERLAPS_CURSOR_MAX_BYTES, OVERLAPS_CURSOR_TTL
+from metrics import metrics
+
+# The cursor value asking for a result to be computed and paged through
+START_CURSOR = "*"
+
+# Number of results serialized to estimate the size of a whole result
+SIZE_SAMPLE = 100
+
+
+def _result_size(value):
+    meta, results, size = value
+    return size
+
+
+def estimate_size(results):
+    """
+    :return: the approximate serialized size of results, from the size of an evenly spread sample of them
+    :rtype: int
+    """
+    if len(results) <= SIZE_SAMPLE:
+        return len(dumps(results))
+    step = len(results) / SIZE_SAMPLE
+    sample = [results[int(i * step)] for i in range(SIZE_SAMPLE)]
+    return int(len(dumps(sample)) * step)
+
+
+class ResultStore(object):
+    """
+    Full results by id, dropped ttl seconds after they were last paged through,
+    or earlier when the store is over its entry or size limit.
+    """
+    __slots__ = ("results",)
+
+    def __init__(self, max_entries=1000, max_bytes=None, ttl=300):
+        self.results = LRUCache(max_entries=max_entries, max_bytes=max_bytes, ttl=ttl, size_of=_result_size)
+
+    def start(self, meta, results, count):
+        """
+        Keep a full result for paging through.
+        :param meta: the meta of the full result, copied into the meta of each page
+        :type meta: dict
+        :param results:
+        :type results: list
+        :param count: the page size, at least 1
+        :type count: int
+        :return: the first page, as (meta, results). A result bigger than the whole store can not be kept,
+                 so it is all in the first page, with no nextCursor.
+        :rtype: tuple
+        """
+        result_id = secrets.token_urlsafe(12)
+        if not self.results.set(result_id, (meta, results, estimate_size(results))):
+            # bigger than the whole store, so it is all given at once
+            return self._page(None, meta, results, len(results), 0)
+        return self._page(result_id, meta, results, count, 0)
+
+    def page(self, cursor, count):
+        """
+        :param cursor: a nextCursor from the meta of an earlier page
+        :type cursor: str
+        :param count: the page size, at least 1
+        :type count: int
+        :return: the page, as (meta, results), or None when the cursor is invalid, unknown or its result has expired
+        :rtype: tuple
+        """
+        try:
+            result_id, offset = base64.urlsafe_b64decode(cursor.encode('ascii') + b"==").decode('ascii').split(':')
+            offset = int(offset)
+        except (ValueError, UnicodeError, binascii.Error):
+            return None
+        if offset < 0:
+            return None
+        value = self.results.get(result_id)
+        if value is None:
+            return None
+        meta, results, size = value
+        # keep the result for another ttl seconds from now
+        self.results.set(result_id, value)
+        return self._page(result_id, meta, results, count, offset)
+
+    def stats(self):
+        return self.results.stats()
+
+    def _page(self, result_id, meta, results, count, offset):
+        if count < 1:
+            # the next cursor would never move on
+            raise ValueError("The page size must be at least 1")
+        page = results[offset:offset + count]
+        page_meta = dict(meta)
+        page_meta['count'] = len(page)
+        page_meta['offset'] = offset
+        page_meta['total'] = len(results)
+        if result_id is not None and offset + count < len(results):
+            token = "{}:{}".format(result_id, offset + count).encode('ascii')
+            page_meta['nextCursor'] = base64.urlsafe_b64encode(token).decode('ascii').rstrip('=')
+        return page_meta, page
+
+
+overlaps_results = ResultStore(OVERLAPS_CURSOR_MAX_ENTRIES, OVERLAPS_CURSOR_MAX_BYTES, OVERLAPS_CURSOR_TTL)
+metrics.register_cache('overlaps_cursors', overlaps_results.stats)
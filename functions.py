@@ -1,22 +1,37 @@
 import asyncio
 import asyncpg
+from contextlib import asynccontextmanager
 import math
-from decimal import Decimal
-from aiohttp import ClientSession
+from collections import OrderedDict, deque
+from aiohttp import ClientTimeout
 from aiohttp.client_exceptions import ClientConnectorError
 from config import TRIPLESTORE_CACHE_SPARQL_ENDPOINT
 from config import ES_ENDPOINT
 from config import GEOM_DATA_SVC_ENDPOINT
-from config import LOCI_DATATYPES_STATIC_JSON
-from config import USE_LOCAL_LOCI_DATATYPES_STATIC_JSON 
-from json import JSONDecodeError
+from config import GDS_BATCH_CONCURRENCY, GEOMETRY_FETCH_CONCURRENCY, GEOMETRY_REQUEST_TIMEOUT, UPSTREAM_POOLS
+from config import GEOMETRY_CACHE_MAX_BYTES, GEOMETRY_CACHE_DIR, GEOMETRY_CACHE_DISK_MAX_BYTES
+from config import SPARQL_CACHE_ENABLED, SPARQL_CACHE_MAX_ENTRIES, SPARQL_CACHE_MAX_BYTES, SPARQL_CACHE_TTL
+from config import SPARQL_LIST_RESULTS_FORMAT
+from config import OVERLAPS_PAGE_SIZE, OVERLAPS_PAGE_PREFETCH
+from config import PARENT_CACHE_MAX_ENTRIES, PARENT_CACHE_TTL, CROSSWALK_CONCURRENCY
 import logging
 import math
-from json import loads
+from codec import loads, JSONDecodeError
 import os
 import json
 
 from errors import ReportableAPIError
+from cache import LRUCache
+from sparql_tsv import TSVRowParser
+from geometry_cache import GeometryCache
+from singleflight import SingleFlight
+from type_registry import get_type_registry, TypeRegistryError
+from hierarchy_index import get_hierarchy_index, format_area
+from point_index import get_point_index
+from crosswalk import CrosswalkAccumulator
+from upstream import get_session
+from metrics import metrics, time_upstream
+from profiling import profile_call
 
 #Until we have a better way of understanding fundamental units in spatial hierarchies
 prefix_base_unit_lookup = {
@@ -73,23 +88,122 @@ def get_to_base_unit_and_type_prefix(from_uri, query_uri):
                 return base_unit_prefix, resource_type_prefix
     return base_unit_prefix, resource_type_prefix
 
+@asynccontextmanager
+async def aclosing(iterator):
+    """
+    Close an async generator on leaving the block, however it is left, eg
+        async with aclosing(iter_overlap_pages(...)) as pages:
+            async for meta, overlaps in pages:
+                ...
+    """
+    try:
+        yield iterator
+    finally:
+        await iterator.aclose()
+
+async def iter_overlap_pages(target_uri, output_featuretype_uri, linksets_filter, include_areas=True, include_proportion=True, include_contains=True, include_within=True, includes_partial_overlaps=True, page_size=OVERLAPS_PAGE_SIZE, prefetch=OVERLAPS_PAGE_PREFETCH):
+    """
+    All the pages of get_location_overlaps, with the areas and percentages left as floats, as they arrive.
+    Once a full page comes back there may be more, so the following pages are fetched concurrently,
+    up to prefetch pages ahead. The pages fetched ahead past the last one are cancelled, or come back empty.
+    :param page_size:
+    :type page_size: int
+    :param prefetch: the number of pages to have in flight while the caller handles a page
+    :type prefetch: int
+    :return: async iterator of (meta, overlaps) of each page, in order.
+             Use it with aclosing, so the pages fetched ahead are cancelled as soon as the caller stops.
+    """
+    def fetch(offset):
+        return asyncio.ensure_future(get_location_overlaps(target_uri, output_featuretype_uri, include_areas, include_proportion, include_within, include_contains, linksets_filter, count=page_size, offset=offset, includes_partial_overlaps=includes_partial_overlaps, as_float=True))
+    pending = deque([fetch(0)])
+    next_offset = page_size
+    try:
+        while pending:
+            meta, overlaps = await pending.popleft()
+            if meta['count'] < page_size:
+                yield meta, overlaps
+                break
+            while len(pending) < max(prefetch, 1):
+                pending.append(fetch(next_offset))
+                next_offset += page_size
+            yield meta, overlaps
+    finally:
+        for task in pending:
+            task.cancel()
+        # wait for the cancellations to finish, and retrieve any errors, the pages are not wanted
+        await asyncio.gather(*pending, return_exceptions=True)
+
 async def get_all_overlaps(target_uri, output_featuretype_uri, linksets_filter, include_areas=True, include_proportion=True, include_contains=True, include_within=True, includes_partial_overlaps=True):
-    offset = 0
+    """
+    All the pages of get_location_overlaps, with the areas and percentages left as floats
+    :return: the area of target_uri (0 when it is unknown) and the overlaps
+    :rtype: tuple
+    """
+    my_area = None
     all_overlaps = []
-    while True:
-        results = list(await get_location_overlaps(target_uri, output_featuretype_uri, include_areas, include_proportion, include_within, include_contains, linksets_filter, count=100000, offset=offset, includes_partial_overlaps=includes_partial_overlaps))
-        length = results[0]['count']
-        if "featureArea" in results[0].keys():
-            my_area = results[0]['featureArea']
-        else:
-            my_area = 0
-        all_overlaps = all_overlaps + results[1]
-        if length < 100000:
-            break
-        offset += 100000
+    async with aclosing(iter_overlap_pages(target_uri, output_featuretype_uri, linksets_filter, include_areas, include_proportion, include_contains, include_within, includes_partial_overlaps)) as pages:
+        async for meta, overlaps in pages:
+            if my_area is None:
+                my_area = meta.get('featureArea', 0)
+            all_overlaps.extend(overlaps)
     return my_area, all_overlaps
 
-counter = 0
+def _sparql_cache_size(value):
+    # JSON results are cached as their body, TSV results as (body size, rows)
+    return value[0] if isinstance(value, tuple) else len(value)
+
+# Cache of SPARQL results, None when SPARQL result caching is disabled
+if SPARQL_CACHE_ENABLED:
+    sparql_cache = LRUCache(max_entries=SPARQL_CACHE_MAX_ENTRIES, max_bytes=SPARQL_CACHE_MAX_BYTES, ttl=SPARQL_CACHE_TTL,
+                            size_of=_sparql_cache_size)
+    metrics.register_cache('sparql', sparql_cache.stats)
+else:
+    sparql_cache = None
+
+# Results of get_location_parents, by (uri, include_areas). Base units are shared by many crosswalks.
+parent_cache = LRUCache(max_entries=PARENT_CACHE_MAX_ENTRIES, ttl=PARENT_CACHE_TTL)
+metrics.register_cache('parents', parent_cache.stats)
+
+# Geometry service responses, by (geometry uri, view, format)
+if GEOMETRY_CACHE_MAX_BYTES:
+    geometry_cache = GeometryCache(GEOMETRY_CACHE_MAX_BYTES, GEOMETRY_CACHE_DIR, GEOMETRY_CACHE_DISK_MAX_BYTES)
+    metrics.register_cache('geometry', geometry_cache.memory.stats)
+    if geometry_cache.disk is not None:
+        metrics.register_cache('geometry_disk', geometry_cache.disk.stats)
+else:
+    geometry_cache = None
+
+# Total time allowed for fetching one geometry, on top of the geometry pool's connect and read timeouts
+geometry_request_timeout = ClientTimeout(total=GEOMETRY_REQUEST_TIMEOUT,
+                                         sock_connect=UPSTREAM_POOLS['geometry']['connect_timeout'],
+                                         sock_read=UPSTREAM_POOLS['geometry']['read_timeout'])
+
+# Upstream requests currently in flight, shared by identical concurrent requests
+upstream_inflight = SingleFlight()
+
+async def iter_pages(fetch_page, count, offset, page_size):
+    """
+    Page through a paged query, for streaming its results.
+    :param fetch_page: async function taking (count, offset) and returning (meta, results)
+    :param count: the total number of results wanted
+    :type count: int
+    :param offset:
+    :type offset: int
+    :param page_size:
+    :type page_size: int
+    :return: async iterator of lists of results
+    """
+    remaining = count
+    while remaining > 0:
+        page_count = min(page_size, remaining)
+        meta, results = await fetch_page(page_count, offset)
+        yield results
+        # a query result page can be longer than page_count, when it combines several queries
+        if meta['count'] < page_count:
+            break
+        remaining -= page_count
+        offset += page_count
+
 async def query_graphdb_endpoint(sparql, infer=True, same_as=True, limit=1000, offset=0):
     """
     Pass the SPARQL query to the endpoint. The endpoint is specified in the config file.
@@ -107,14 +221,34 @@ async def query_graphdb_endpoint(sparql, infer=True, same_as=True, limit=1000, o
     :return:
     :rtype: dict
     """
-    global counter
-    counter = counter + 1
-    loop = asyncio.get_event_loop()
-    try:
-        session = query_graphdb_endpoint.session_cache[loop]
-    except KeyError:
-        session = ClientSession(loop=loop)
-        query_graphdb_endpoint.session_cache[loop] = session
+    args, key = _graphdb_args(sparql, infer, same_as, limit, offset)
+    with profile_call('graphdb', "{} LIMIT {} OFFSET {}".format(sparql, args['limit'], args['offset'])) as call:
+        resp_content = None
+        if sparql_cache is not None:
+            resp_content = sparql_cache.get(key)
+            call.cache = 'miss' if resp_content is None else 'hit'
+        if resp_content is None:
+            # identical queries already in flight share the one upstream request
+            if ('graphdb',) + key in upstream_inflight:
+                call.cache = 'shared'
+            status, resp_content = await upstream_inflight.do(('graphdb',) + key, _post_graphdb_endpoint, args, key)
+        call.nbytes = len(resp_content)
+        try:
+            # The response body is shared (and cached) rather than the parsed result, because callers modify the result
+            resp = loads(resp_content)
+        except JSONDecodeError as e:
+            logging.error("Bad response querying {0}".format(sparql))
+            raise 
+        if 'results' in resp:
+            rows = call.rows = len(resp['results']['bindings'])
+            metrics.observe_sparql_rows(rows)
+    return resp
+
+def _graphdb_args(sparql, infer, same_as, limit, offset):
+    """
+    :return: the form fields of a GraphDB query, and its key for the cache and for sharing it when in flight
+    :rtype: tuple
+    """
     args = {
         'query': sparql,
         'infer': 'true' if bool(infer) else 'false',
@@ -122,18 +256,117 @@ async def query_graphdb_endpoint(sparql, infer=True, same_as=True, limit=1000, o
         'limit': int(limit),
         'offset': int(offset),
     }
+    # Whitespace is insignificant in our queries, so it is normalized out of the key
+    key = (" ".join(sparql.split()), args['infer'], args['sameAs'], args['limit'], args['offset'])
+    return args, key
+
+async def query_graphdb_rows(sparql, variables, infer=True, same_as=True, limit=1000, offset=0):
+    """
+    Pass a list-shaped SPARQL query to the endpoint, for just the values of its result rows.
+    The results are asked for as tab-separated values and parsed as they arrive, see sparql_tsv,
+    unless SPARQL_LIST_RESULTS_FORMAT is "json".
+
+    :param sparql: the valid SPARQL text
+    :type sparql: str
+    :param variables: the names of the variables wanted, without the "?"
+    :type variables: tuple
+    :param infer:
+    :type infer: bool
+    :param same_as:
+    :type same_as: bool
+    :param limit:
+    :type limit: int
+    :param offset:
+    :type offset: int
+    :return: a tuple of the values of the variables for each result row, with None where a variable is unbound.
+             The list can be shared with other callers, it must not be modified.
+    :rtype: list
+    """
+    if SPARQL_LIST_RESULTS_FORMAT == 'json':
+        resp = await query_graphdb_endpoint(sparql, infer, same_as, limit, offset)
+        if 'results' not in resp:
+            return []
+        return [tuple(b[v]['value'] if v in b else None for v in variables) for b in resp['results']['bindings']]
+    args, key = _graphdb_args(sparql, infer, same_as, limit, offset)
+    key = ('tsv', tuple(variables)) + key
+    with profile_call('graphdb', "{} LIMIT {} OFFSET {}".format(sparql, args['limit'], args['offset'])) as call:
+        result = None
+        if sparql_cache is not None:
+            result = sparql_cache.get(key)
+            call.cache = 'miss' if result is None else 'hit'
+        if result is None:
+            if ('graphdb',) + key in upstream_inflight:
+                call.cache = 'shared'
+            result = await upstream_inflight.do(('graphdb',) + key, _post_graphdb_rows, args, variables, key)
+        nbytes, rows = result
+        call.nbytes = nbytes
+        call.rows = len(rows)
+        metrics.observe_sparql_rows(len(rows))
+    return rows
+
+async def _post_graphdb_rows(args, variables, cache_key):
+    session = get_session('graphdb')
+    headers = {
+        'Accept': "text/tab-separated-values",
+        'Accept-Encoding': "gzip, deflate",
+    }
+    parser = TSVRowParser(variables)
+    with time_upstream('graphdb') as call:
+        async with session.request('POST', TRIPLESTORE_CACHE_SPARQL_ENDPOINT, data=args, headers=headers) as resp:
+            if resp.status != 200:
+                logging.error("Bad response querying {0}".format(args['query']))
+                raise ReportableAPIError("LOCI cache query failed with status {}".format(resp.status))
+            async for chunk in resp.content.iter_any():
+                parser.feed(chunk)
+        rows = parser.close()
+        call.nbytes = parser.nbytes
+    result = (parser.nbytes, rows)
+    if sparql_cache is not None:
+        sparql_cache.set(cache_key, result)
+    return result
+
+async def _post_graphdb_endpoint(args, cache_key):
+    session = get_session('graphdb')
     headers = {
         'Accept': "application/sparql-results+json,*/*;q=0.9",
         'Accept-Encoding': "gzip, deflate",
     }
-    resp = await session.request('POST', TRIPLESTORE_CACHE_SPARQL_ENDPOINT, data=args, headers=headers)
-    resp_content = await resp.text()
-    try:
-        return loads(resp_content)
-    except JSONDecodeError as e:
-        logging.error("Bad response querying {0}".format(sparql))
-        raise 
-query_graphdb_endpoint.session_cache = {}
+    with time_upstream('graphdb') as call:
+        resp = await session.request('POST', TRIPLESTORE_CACHE_SPARQL_ENDPOINT, data=args, headers=headers)
+        # the raw bytes, they are parsed without decoding them to a str first
+        resp_content = await resp.read()
+        call.nbytes = len(resp_content)
+    if sparql_cache is not None and resp.status == 200:
+        sparql_cache.set(cache_key, resp_content)
+    return resp.status, resp_content
+
+async def get_upstream(upstream_name, url, params):
+    """
+    GET a url from the named upstream pool. Identical requests already in flight share the one upstream request.
+    :param upstream_name:
+    :type upstream_name: str
+    :param url:
+    :type url: str
+    :param params:
+    :type params: dict
+    :return: the response status and body bytes
+    :rtype: tuple
+    """
+    key = (upstream_name, url, tuple(sorted((k, str(v)) for k, v in params.items())))
+    with profile_call(upstream_name, url) as call:
+        if key in upstream_inflight:
+            call.cache = 'shared'
+        status, resp_content = await upstream_inflight.do(key, _get_upstream, upstream_name, url, params)
+        call.nbytes = len(resp_content)
+    return status, resp_content
+
+async def _get_upstream(upstream_name, url, params):
+    session = get_session(upstream_name)
+    with time_upstream(upstream_name) as call:
+        resp = await session.request('GET', url, params=params)
+        resp_content = await resp.read()
+        call.nbytes = len(resp_content)
+    return resp.status, resp_content
 
 async def check_type(target_uri, output_featuretype_uri):
     """
@@ -157,12 +390,59 @@ select * where {
     resp = await query_graphdb_endpoint(sparql)
     results = []
     if 'results' not in resp:
-        return locations
+        return False
     bindings = resp['results']['bindings']
     for b in bindings:
         results.append(b['a']['value'])
     return results[0]  == "true"
 
+TYPES_CHUNK_SIZE = 500
+
+async def get_types(target_uris, chunk_size=TYPES_CHUNK_SIZE):
+    """
+    Get the rdf:types of many resources at once, using VALUES-based queries
+    of at most chunk_size uris each, rather than one query per uri.
+    :param target_uris:
+    :type target_uris: iterable
+    :param chunk_size:
+    :type chunk_size: int
+    :return: mapping of each uri to the set of its types
+    :rtype: dict
+    """
+    sparql = """\
+PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
+SELECT DISTINCT ?s ?t WHERE {
+    VALUES ?s { <VALUES> }
+    ?s rdf:type ?t .
+}
+"""
+    unique_uris = list(OrderedDict.fromkeys(str(u) for u in target_uris))
+    types = {u: set() for u in unique_uris}
+    for i in range(0, len(unique_uris), chunk_size):
+        chunk = unique_uris[i:i + chunk_size]
+        values = " ".join("<{}>".format(u) for u in chunk)
+        # The limit must not truncate the result, every uri can have several (inferred) types
+        resp = await query_graphdb_endpoint(sparql.replace("<VALUES>", values), limit=1000000000)
+        if 'results' not in resp:
+            continue
+        for b in resp['results']['bindings']:
+            types[b['s']['value']].add(b['t']['value'])
+    return types
+
+async def check_types(target_uris, output_featuretype_uri):
+    """
+    Batch version of check_type.
+    Find which of target_uris are of type output_featuretype_uri
+    :param target_uris:
+    :type target_uris: iterable
+    :param output_featuretype_uri:
+    :type output_featuretype_uri: str
+    :return: the uris which are of type output_featuretype_uri
+    :rtype: set
+    """
+    types = await get_types(target_uris)
+    return set(u for u, t in types.items() if str(output_featuretype_uri) in t)
+
 async def get_resource(resource_uri):
     """
     :param resource_uri:
@@ -265,13 +545,8 @@ WHERE {
     }
 }
 """
-    resp = await query_graphdb_endpoint(sparql, limit=count, offset=offset)
-    linksets = []
-    if 'results' not in resp:
-        return linksets
-    bindings = resp['results']['bindings']
-    for b in bindings:
-        linksets.append(b['l']['value'])
+    rows = await query_graphdb_rows(sparql, ('l',), limit=count, offset=offset)
+    linksets = [l for (l,) in rows]
     meta = {
         'count': len(linksets),
         'offset': offset,
@@ -332,70 +607,21 @@ async def get_dataset_types(datasetUri, datasetType, baseType, count=1000, offse
     :type offset: int
     :return:
     """
-    loop = asyncio.get_event_loop()
-    try:
-        gdt_session = get_dataset_types.session_cache[loop]
-    except KeyError:
-        gdt_session = ClientSession(loop=loop)
-        get_dataset_types.session_cache[loop] = gdt_session
-    row = {}
-    results = {}
-    counter = 0
-    params = {
-    }
-    formatted_resp = {
-        'ok': False
-    }
     meta = {
         'count': -1,
         'offset': 0
     }
-    formatted_resp = {}
-    if USE_LOCAL_LOCI_DATATYPES_STATIC_JSON == True:
-       #retrieve from file
-       curr_dir = os.path.dirname(__file__) 
-       rel_path = "loci-types.json"
-       abs_file_path = os.path.join(curr_dir, rel_path)
-       #print("Is file {} : {}".format(abs_file_path, os.path.isfile(abs_file_path)))
-       #arr = os.listdir(curr_dir)
-       #print(arr)
-       try:
-          with open(abs_file_path) as f:
-             #print("file opened")
-             formatted_resp = json.load(f)
-       except:
-          formatted_resp['errorMessage'] = "File error: Could not find file {} to load Loc-I Types with.".format(abs_file_path)
-          return meta,formatted_resp
-          
-       
-    else: #retrieve from the web url
-       http_ok = [200]
-       url = LOCI_DATATYPES_STATIC_JSON
-       try:
-           resp = await gdt_session.request('GET', url, params=params)
-           resp_content = await resp.text()
-           if resp.status not in http_ok:
-               formatted_resp['errorMessage'] = "Could not retrieve datatypes at loci.cat. Error code {}".format(resp.status)
-               return meta,formatted_resp
-           formatted_resp = loads(resp_content)
-       except ClientConnectorError:
-           formatted_resp['errorMessage'] = "Could not connect to retrieve datatypes at loci.cat. Connection error thrown."
-           return meta,formatted_resp
-    if(datasetUri is not None):
-       res = list(filter(lambda i: i['datasetUri'] == datasetUri, formatted_resp)) 
-       formatted_resp = res
-    if datasetType is not None:
-       res = list(filter(lambda i: i['uri'] == datasetType, formatted_resp)) 
-       formatted_resp = res
-    if(baseType == True):
-       res = list(filter(lambda i: ('baseType' in i and i['baseType'] == True), formatted_resp)) 
-       formatted_resp = res
+    try:
+        registry = await get_type_registry()
+    except TypeRegistryError as e:
+        return meta, {'errorMessage': str(e)}
+    # copies, so the registry itself cannot be modified by the caller
+    formatted_resp = [dict(t) for t in registry.find(datasetUri, datasetType, baseType)]
     meta = {
         'count': len(formatted_resp),
         'offset': 0
     }
     return meta, formatted_resp
-get_dataset_types.session_cache = {}
 
 async def get_locations(count=1000, offset=0):
     """
@@ -440,13 +666,8 @@ WHERE {
     } .
 }
 """
-    resp = await query_graphdb_endpoint(sparql, limit=count, offset=offset)
-    locations = []
-    if 'results' not in resp:
-        return locations
-    bindings = resp['results']['bindings']
-    for b in bindings:
-        locations.append(b['l']['value'])
+    rows = await query_graphdb_rows(sparql, ('l',), limit=count, offset=offset)
+    locations = [l for (l,) in rows]
     meta = {
         'count': len(locations),
         'offset': offset,
@@ -456,6 +677,8 @@ WHERE {
 
 async def get_location_is_within(target_uri, count=1000, offset=0):
     """
+    The features target_uri is within, in uri order from both the hierarchy index and SPARQL,
+    so the pages are the same with and without the index.
     :param target_uri:
     :type target_uri: str
     :param count:
@@ -465,6 +688,14 @@ async def get_location_is_within(target_uri, count=1000, offset=0):
     :return:
     :rtype: tuple
     """
+    index = get_hierarchy_index()
+    if index is not None and target_uri in index:
+        locations = index.within(target_uri)[offset:offset + count]
+        meta = {
+            'count': len(locations),
+            'offset': offset,
+        }
+        return meta, locations
     sparql = """\
 PREFIX geo: <http://www.opengis.net/ont/geosparql#>
 PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
@@ -478,16 +709,12 @@ WHERE {
     UNION
     { <URI> geo:sfWithin+ ?l }
 }
+ORDER BY ?l
 """
     sparql = sparql.replace("<URI>", "<{}>".format(str(target_uri)))
     #print(sparql)
-    resp = await query_graphdb_endpoint(sparql, limit=count, offset=offset)
-    locations = []
-    if 'results' not in resp:
-        return locations
-    bindings = resp['results']['bindings']
-    for b in bindings:
-        locations.append(b['l']['value'])
+    rows = await query_graphdb_rows(sparql, ('l',), limit=count, offset=offset)
+    locations = [l for (l,) in rows]
     meta = {
         'count': len(locations),
         'offset': offset,
@@ -496,6 +723,8 @@ WHERE {
 
 async def get_location_contains(target_uri, count=1000, offset=0):
     """
+    The features target_uri contains, in uri order from both the hierarchy index and SPARQL,
+    so the pages are the same with and without the index.
     :param target_uri:
     :type target_uri: str
     :param count:
@@ -505,6 +734,14 @@ async def get_location_contains(target_uri, count=1000, offset=0):
     :return:
     :rtype: tuple
     """
+    index = get_hierarchy_index()
+    if index is not None and target_uri in index:
+        locations = index.contains(target_uri)[offset:offset + count]
+        meta = {
+            'count': len(locations),
+            'offset': offset,
+        }
+        return meta, locations
     sparql = """\
 PREFIX geo: <http://www.opengis.net/ont/geosparql#>
 PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
@@ -518,22 +755,21 @@ WHERE {
     UNION
     { <URI> geo:sfContains+ ?l }
 }
+ORDER BY ?l
 """
     sparql = sparql.replace("<URI>", "<{}>".format(str(target_uri)))
     #print(sparql)
-    resp = await query_graphdb_endpoint(sparql, limit=count, offset=offset)
-    locations = []
-    if 'results' not in resp:
-        return locations
-    bindings = resp['results']['bindings']
-    for b in bindings:
-        locations.append(b['l']['value'])
+    rows = await query_graphdb_rows(sparql, ('l',), limit=count, offset=offset)
+    locations = [l for (l,) in rows]
     meta = {
         'count': len(locations),
         'offset': offset,
     }
     return meta, locations
 
+# The variables of the overlaps, contains and within queries of get_location_overlaps, in the order of their rows
+OVERLAP_VARIABLES = ('o', 'uarea', 'oarea', 'iarea', 'w', 'c')
+
 async def query_build_response_bindings(sparql, count, offset, bindings):
     """
     :param sparql:
@@ -542,13 +778,14 @@ async def query_build_response_bindings(sparql, count, offset, bindings):
     :type count: int
     :param offset:
     :type offset: int
+    :param bindings: extended with the result rows, tuples of the values of OVERLAP_VARIABLES
+    :type bindings: list
     :return:
     """
-    resp = await query_graphdb_endpoint(sparql, limit=count, offset=offset)
-    if 'results' in resp and 'bindings' in resp['results']:
-        if len(resp['results']['bindings']) > 0:
-            if len(resp['results']['bindings'][0].keys()) > 0:
-                bindings.extend(resp['results']['bindings'])
+    rows = await query_graphdb_rows(sparql, OVERLAP_VARIABLES, limit=count, offset=offset)
+    if len(rows) > 0:
+        if any(value is not None for value in rows[0]):
+            bindings.extend(rows)
 
 async def get_location_overlaps_crosswalk(from_uri, output_featuretype_uri, include_areas, include_proportion, include_within, include_contains, include_count=1000, offset=0):
     """
@@ -579,73 +816,136 @@ async def get_location_overlaps_crosswalk(from_uri, output_featuretype_uri, incl
     linksets_filter = await get_linkset_uri(from_uri, output_featuretype_uri)
     base_unit_prefix, resource_type_prefix = get_to_base_unit_and_type_prefix("", from_uri)
     # this is a base unit so continue to base unit logic
-    parent_amount = {}
-    # cache of withins, base units in other hierarchary may overlap multiple times so don't need to find parents everytime
-    # just use cache of parents
-    found_parents = {}
+    parent_amount = CrosswalkAccumulator()
     if base_unit_prefix not in from_uri:
         # This must be a parent unit so get everything contained and find base units
-        my_area, all_contained = await get_all_overlaps(from_uri, None, None, include_contains=True, include_within=False)
-        collated_uri_dict = {}
-        for an_contained in all_contained:
-            from_base_uri = an_contained['uri']
-            if base_unit_prefix is None:
-                continue
-            if base_unit_prefix not in from_base_uri:
-                # isn't actually a base uri but record information
-                parent_amount[from_base_uri] = {"uri": from_base_uri, "featureArea": my_area, "forwardPercentage": an_contained["forwardPercentage"], "reversePercentage": an_contained["reversePercentage"], "intersectionArea": an_contained["intersectionArea"]}
-                continue
-            # found a base uri do base uri logic
-            percentage_from_uri_in_from_base_uri = float(an_contained["forwardPercentage"])  # This is the amount this base unit takes up of the parent unit
-            area_parent = float(my_area) * percentage_from_uri_in_from_base_uri / 100
-            await get_location_overlaps_crosswalk_base_uri(found_parents, parent_amount, area_parent, percentage_from_uri_in_from_base_uri, from_base_uri, linksets_filter, output_featuretype_uri)
+        # The base units are worked on by CROSSWALK_CONCURRENCY workers fed from a queue, each into its own accumulator.
+        # The accumulators are merged in the order of the contained features as soon as all the ones before them are
+        # done, so the result is the same as working through them one at a time.
+        queue = asyncio.Queue(maxsize=CROSSWALK_CONCURRENCY)
+        # position of each contained feature -> its accumulator, until it is merged
+        parts = {}
+        done = set()
+        merged = 0
+        failures = []
+
+        def merge_done():
+            nonlocal merged
+            while merged in done:
+                parent_amount.merge(parts.pop(merged))
+                done.discard(merged)
+                merged += 1
+
+        async def worker():
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                if failures:
+                    # keep taking the queued base units, so the feeding of the queue can not block, but skip them
+                    continue
+                position, area_parent, percentage_from_uri_in_from_base_uri, from_base_uri = item
+                try:
+                    await get_location_overlaps_crosswalk_base_uri(parts[position], area_parent, percentage_from_uri_in_from_base_uri, from_base_uri, linksets_filter, output_featuretype_uri)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    failures.append(e)
+                    continue
+                done.add(position)
+                merge_done()
+
+        workers = [asyncio.ensure_future(worker()) for _ in range(max(1, CROSSWALK_CONCURRENCY))]
+        try:
+            # work through the contained features a page at a time, while the next pages are fetched
+            my_area = None
+            position = 0
+            async with aclosing(iter_overlap_pages(from_uri, None, None, include_contains=True, include_within=False)) as pages:
+                async for meta, contained in pages:
+                    if my_area is None:
+                        my_area = meta.get('featureArea', 0)
+                    for an_contained in contained:
+                        from_base_uri = an_contained['uri']
+                        if base_unit_prefix is None:
+                            continue
+                        parts[position] = CrosswalkAccumulator()
+                        if base_unit_prefix not in from_base_uri:
+                            # isn't actually a base uri but record information
+                            parts[position].set_record(from_base_uri, {"uri": from_base_uri, "featureArea": format_area(my_area), "forwardPercentage": format_area(an_contained["forwardPercentage"]), "reversePercentage": format_area(an_contained["reversePercentage"]), "intersectionArea": format_area(an_contained["intersectionArea"])})
+                            done.add(position)
+                            merge_done()
+                        else:
+                            # found a base uri do base uri logic
+                            percentage_from_uri_in_from_base_uri = an_contained["forwardPercentage"]  # This is the amount this base unit takes up of the parent unit
+                            area_parent = my_area * percentage_from_uri_in_from_base_uri / 100
+                            # waits while the workers are all busy
+                            await queue.put((position, area_parent, percentage_from_uri_in_from_base_uri, from_base_uri))
+                        position += 1
+                        if failures:
+                            raise failures[0]
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+            if failures:
+                raise failures[0]
+        finally:
+            # on an error, stop the work on the other base units
+            for task in workers:
+                task.cancel()
     else:
-        my_area = await get_location_overlaps_crosswalk_base_uri(found_parents, parent_amount, None, 100, from_uri, linksets_filter, output_featuretype_uri)
-
-    parents = parent_amount.values()
-    final_parents = []
-    for aparent in parents:
-        if output_featuretype_uri is not None:
-            type_match = await check_type(aparent['uri'], output_featuretype_uri)
-            if not type_match:
-               continue
-        final_parents.append(aparent)
-        area_from_uri = float(my_area)
-        area_parent = float(aparent["featureArea"])
-        area_from_uri_in_parent = aparent["intersectionArea"]
-        if include_proportion and "forwardPercentage" not in aparent.keys():
-            proportion_area_of_from_uri = area_from_uri_in_parent / area_from_uri
-            if proportion_area_of_from_uri >= 1:
-                proportion_area_of_from_uri = 1
-            aparent["forwardPercentage"] = str(proportion_area_of_from_uri * 100)
-        if not include_proportion and "forwardPercentage" in aparent.keys():
-           aparent.pop("forwardPercentage", None)
-        if include_proportion and "reversePercentage" not in aparent.keys():
-            proportion_area_of_parent = area_from_uri_in_parent / area_parent
-            if proportion_area_of_parent >= 1:
-                proportion_area_of_parent = 1
-            aparent["reversePercentage"] = str(proportion_area_of_parent * 100)
-        if not include_proportion and "reversePercentage" in aparent.keys():
-            aparent.pop("reversePercentage", None)
-        if include_areas:
-            aparent["intersectionArea"] = str(aparent["intersectionArea"])
-        else:
-            aparent.pop("intersectionArea", None)
-            aparent.pop("featureArea", None)
-        for key in aparent:
-            value = aparent[key]
-            if isinstance(value, float) and math.isnan(value):
-                aparent[key] = "nan"
+        my_area = await get_location_overlaps_crosswalk_base_uri(parent_amount, None, 100, from_uri, linksets_filter, output_featuretype_uri)
+
+    type_matches = None
+    if output_featuretype_uri is not None:
+        type_matches = await check_types(parent_amount.uris(), output_featuretype_uri)
+    final_parents = parent_amount.results(my_area, include_areas, include_proportion, type_matches)
     meta = {
         'count': len(final_parents),
         'offset': 0,
     }
     if my_area and include_areas:
-        meta['featureArea'] = my_area
-    return meta, list(final_parents)
+        meta['featureArea'] = format_area(my_area)
+    return meta, final_parents
+
+
+async def get_location_parents(target_uri, include_areas=True):
+    """
+    Find everything target_uri is within, from the hierarchy index when there is one, otherwise with SPARQL.
+    :param target_uri:
+    :type target_uri: str
+    :param include_areas:
+    :type include_areas: bool
+    :return: the area of target_uri and the parents, as dicts with uri and (float) featureArea, or just uris without areas
+    :rtype: tuple
+    """
+    index = get_hierarchy_index()
+    if index is not None and target_uri in index:
+        if not include_areas:
+            return 0, index.within(target_uri)
+        parents = [{"uri": uri, "isWithin": True, "featureArea": area}
+                   for uri, area in index.within_with_areas(target_uri)]
+        my_area = index.area(target_uri)
+        return (0 if math.isnan(my_area) else my_area), parents
+    if not include_areas:
+        return await get_all_overlaps(target_uri, None, None, include_areas=False, include_proportion=False, include_contains=False, include_within=True)
+    return await get_all_overlaps(target_uri, None, None, include_contains=False, include_within=True)
+
+
+async def get_cached_location_parents(target_uri, include_areas=True):
+    """
+    get_location_parents, through the process-wide parent cache.
+    The result is shared between requests, it must not be modified.
+    :rtype: tuple
+    """
+    key = (target_uri, bool(include_areas))
+    parents = parent_cache.get(key)
+    if parents is None:
+        parents = await get_location_parents(target_uri, include_areas)
+        parent_cache.set(key, parents)
+    return parents
 
 
-async def get_location_overlaps_crosswalk_base_uri(found_parents, parent_amount, area_incoming, percentage_from_uri_in_from_base_uri, from_base_uri, linksets_filter=None, output_featuretype_uri=None):
+async def get_location_overlaps_crosswalk_base_uri(parent_amount, area_incoming, percentage_from_uri_in_from_base_uri, from_base_uri, linksets_filter=None, output_featuretype_uri=None):
     """
     find location overlaps across to "to" spatial hierarchies given a base uri in a "from" hierarchy
     """
@@ -653,7 +953,15 @@ async def get_location_overlaps_crosswalk_base_uri(found_parents, parent_amount,
     # if there is no area incoming from another higher level object then this is the U shaped query is a L shaped and starts
     # from a base_uri therefore the area is the area of the base_uri
     if area_incoming is None:
-        area_incoming = float(my_area)
+        area_incoming = my_area
+    if output_featuretype_uri is not None:
+        # only the overlapping base units of the other hierarchy need their type checked
+        to_base_uris = []
+        for an_overlap in all_overlaps:
+            base_unit_prefix, resource_type_prefix = get_to_base_unit_and_type_prefix(from_base_uri, an_overlap["uri"])
+            if base_unit_prefix is not None and base_unit_prefix in an_overlap["uri"]:
+                to_base_uris.append(an_overlap["uri"])
+        type_matches = await check_types(to_base_uris, output_featuretype_uri)
     for an_overlap in all_overlaps:
         to_base_uri = an_overlap["uri"]
         base_unit_prefix, resource_type_prefix = get_to_base_unit_and_type_prefix(from_base_uri, to_base_uri)
@@ -666,47 +974,35 @@ async def get_location_overlaps_crosswalk_base_uri(found_parents, parent_amount,
             to_feature_area = an_overlap["featureArea"]
         else:
             to_feature_area = float('nan')
-        if to_base_uri not in parent_amount:
-            parent_amount[to_base_uri] = {"uri": to_base_uri, "intersectionArea": 0, "featureArea": to_feature_area}
-
         if "forwardPercentage" in an_overlap:
             percentage_from_base_uri_in_to_base_uri = an_overlap["forwardPercentage"]
         else:
             percentage_from_base_uri_in_to_base_uri = float('nan')
-        area_from_other_base_uri = (float(percentage_from_base_uri_in_to_base_uri) / 100 * area_incoming)
-        parent_amount[to_base_uri]["intersectionArea"] += area_from_other_base_uri
-        if (output_featuretype_uri is not None) and (await check_type(to_base_uri, output_featuretype_uri)):
+        # the area from the other base uri is percentage_from_base_uri_in_to_base_uri / 100 * area_incoming
+        area_from_other_base_uri = parent_amount.add_contribution(area_incoming, percentage_from_base_uri_in_to_base_uri)
+        parent_amount.add(to_base_uri, area_from_other_base_uri, to_feature_area)
+        if (output_featuretype_uri is not None) and (to_base_uri in type_matches):
             # this is already the target type so it is the "parent"
             continue
-        # find all its parents
-        if to_base_uri not in found_parents.keys():
-            if math.isnan(float(percentage_from_base_uri_in_to_base_uri)):
-                found_parents[to_base_uri] = await get_all_overlaps(to_base_uri, None, None, include_areas=False, include_proportion=False, include_contains=False, include_within=True)
-            else:
-                found_parents[to_base_uri] = await get_all_overlaps(to_base_uri, None, None, include_contains=False, include_within=True)
-        parent_area, all_within = found_parents[to_base_uri]
+        # find all its parents, base units in the other hierarchy may overlap many times so they come from the cache
+        include_parent_areas = not math.isnan(percentage_from_base_uri_in_to_base_uri)
+        parent_area, all_within = await get_cached_location_parents(to_base_uri, include_parent_areas)
         for an_within in all_within:
             if isinstance(an_within, str):
                 within_uri = an_within
                 if resource_type_prefix in within_uri:
-                    parent_amount[within_uri] = {"uri": within_uri, "intersectionArea": float('nan'), "featureArea": float('nan'), "forwardPercentage": float('nan'), "reversePercentage": float('nan')}
+                    parent_amount.set_unknown(within_uri)
                 continue
             within_uri = an_within['uri']
             # exclude things that contain this base unit but aren't in the same spatial hierarchy
-            if resource_type_prefix not in within_uri:
-                continue
-            feature_area = an_within["featureArea"]
-            # how much of this bigger thing is in the thing in the to hierarchy
             if resource_type_prefix not in within_uri:
                 continue
             # this is a parent of the to_base_unit
-            if within_uri not in parent_amount.keys():
-                parent_amount[within_uri] = {"uri": within_uri, "intersectionArea": 0, "featureArea": feature_area}
-            parent_amount[within_uri]["intersectionArea"] += area_from_other_base_uri
+            parent_amount.add(within_uri, area_from_other_base_uri, an_within["featureArea"])
     return my_area
 
 
-async def get_location_overlaps(target_uri, output_featuretype_uri, include_areas, include_proportion, include_within, include_contains, linksets_filter=None, count=1000, offset=0, includes_partial_overlaps=True):
+async def get_location_overlaps(target_uri, output_featuretype_uri, include_areas, include_proportion, include_within, include_contains, linksets_filter=None, count=1000, offset=0, includes_partial_overlaps=True, as_float=False):
     """
     :param target_uri:
     :type target_uri: str
@@ -719,6 +1015,8 @@ async def get_location_overlaps(target_uri, output_featuretype_uri, include_area
     :type count: int
     :param offset:
     :type offset: int
+    :param as_float: leave the areas and percentages as floats, rather than formatting them for the API
+    :type as_float: bool
     :return:
     """
     overlaps_sparql = """\
@@ -856,7 +1154,7 @@ GROUP BY ?o
         extras += iarea_sparql
         use_selects += iarea_selects
     overlaps = []
-    bindings = []
+    sparqls = []
     if includes_partial_overlaps:
         sparql = overlaps_sparql.replace("<SELECTS>", use_selects)
         sparql = sparql.replace("<EXTRAS>", extras)
@@ -869,7 +1167,7 @@ GROUP BY ?o
             sparql = sparql.replace("<LINKSET_FILTER>", "ipo: <{}> ;".format(str(linksets_filter)))
         else:
             sparql = sparql.replace("<LINKSET_FILTER>", "")
-        await query_build_response_bindings(sparql, count, offset, bindings)
+        sparqls.append(sparql)
     extras = ""
     #print(sparql)
     if include_contains:
@@ -884,7 +1182,7 @@ GROUP BY ?o
             sparql = sparql.replace("<LINKSET_FILTER>", "ipo: <{}> ;".format(str(linksets_filter)))
         else:
             sparql = sparql.replace("<LINKSET_FILTER>", "")
-        await query_build_response_bindings(sparql, count, offset, bindings)
+        sparqls.append(sparql)
         extras = ""
     if include_within:
         use_selects = selects
@@ -898,92 +1196,100 @@ GROUP BY ?o
             sparql = sparql.replace("<LINKSET_FILTER>", "ipo: <{}> ;".format(str(linksets_filter)))
         else:
             sparql = sparql.replace("<LINKSET_FILTER>", "")
-        await query_build_response_bindings(sparql, count, offset, bindings)
+        sparqls.append(sparql)
     #print(sparql)
+    # The sub-queries are independent, so run them concurrently, each into its own list.
+    # Merge them in the order overlaps, contains, within so the result order is deterministic.
+    query_bindings = [[] for _ in sparqls]
+    await asyncio.gather(*[query_build_response_bindings(sparql, count, offset, b)
+                           for sparql, b in zip(sparqls, query_bindings)])
+    bindings = []
+    for b in query_bindings:
+        bindings.extend(b)
     if len(bindings) < 1:
         return {'count': 0, 'offset': offset}, overlaps
     if not include_proportion and not include_areas:
         my_area = False
         for b in bindings:
-            overlaps.append(b['o']['value'])
+            overlaps.append(b[0])
     else:
-        d100 = Decimal("100.0")
+        # Areas and percentages are worked out as floats, strings are only made for the API response below
         try:
-            uarea = bindings[0]['uarea']
-        except (LookupError, AttributeError):
-            uarea = {}
-            uarea['value'] = math.nan 
+            my_area = float(bindings[0][1])
+        except TypeError:
+            my_area = math.nan
             logging.warning("Source feature {0} does not have a known geometry area."
                                      "Cannot return areas or calculate proportions.".format(target_uri))
-        my_area = round(Decimal(uarea['value']), 8)
-        for b in bindings:
-            o_dict = {"uri": b['o']['value']}
+        for o, uarea, oarea, iarea, w, c in bindings:
+            o_dict = {"uri": o}
             if include_within:
-                try:
-                    is_w = b['w']
-                except (LookupError, AttributeError):
-                    is_w = False
-                o_dict["isWithin"] = bool(is_w)
+                is_w = w is not None
+                o_dict["isWithin"] = is_w
             if include_contains:
-                try:
-                    has_c = b['c']
-                except (LookupError, AttributeError):
-                    has_c = False
-                o_dict["contains"] = bool(has_c)
+                has_c = c is not None
+                o_dict["contains"] = has_c
 
             overlaps.append(o_dict)
             try:
-                oarea = b['oarea']
-            except (LookupError, AttributeError):
-                b['oarea'] = {}
-                b['oarea']['value'] = math.nan
-                oarea = b['oarea'] 
-            o_area = round(Decimal(oarea['value']), 8)
+                o_area = float(oarea)
+            except TypeError:
+                o_area = math.nan
             if include_areas:
-                o_dict['featureArea'] = str(o_area)
+                o_dict['featureArea'] = o_area
             if include_proportion:
                 if include_within and is_w:
-                    my_proportion = d100
-                    other_proportion = (my_area / o_area) * d100
+                    my_proportion = 100.0
+                    other_proportion = (my_area / o_area) * 100.0
                     i_area = my_area
                 elif include_contains and has_c:
-                    my_proportion = (o_area / my_area) * d100
-                    other_proportion = d100
+                    my_proportion = (o_area / my_area) * 100.0
+                    other_proportion = 100.0
                     i_area = o_area
                 else:
                     try:
-                        i_area = Decimal(b['iarea']['value'])
-                    except (LookupError, AttributeError):
+                        i_area = float(iarea)
+                    except TypeError:
                         continue
-                    my_proportion = (i_area / my_area) * d100
-                    other_proportion = (i_area / o_area) * d100
+                    my_proportion = (i_area / my_area) * 100.0
+                    other_proportion = (i_area / o_area) * 100.0
                 if include_areas:
-                    o_dict['intersectionArea'] = str(round(i_area, 8))
-                my_proportion = round(my_proportion, 8)
-                other_proportion = round(other_proportion, 8)
-                o_dict['forwardPercentage'] = str(my_proportion)
-                o_dict['reversePercentage'] = str(other_proportion)
+                    o_dict['intersectionArea'] = i_area
+                o_dict['forwardPercentage'] = my_proportion
+                o_dict['reversePercentage'] = other_proportion
 
     meta = {
         'count': len(overlaps),
         'offset': offset,
     }
     if my_area and include_areas:
-        meta['featureArea'] = str(my_area)
+        meta['featureArea'] = my_area
     final_overlaps = overlaps
     if output_featuretype_uri is not None:
-        final_overlaps = []
-        for an_overlap in overlaps:
-                if isinstance(an_overlap, str):
-                    uri_to_check = an_overlap
-                else:
-                    uri_to_check = an_overlap['uri']
-                type_match = await check_type(uri_to_check, output_featuretype_uri)
-                if type_match:
-                   final_overlaps.append(an_overlap)
+        uris_to_check = [o if isinstance(o, str) else o['uri'] for o in overlaps]
+        type_matches = await check_types(uris_to_check, output_featuretype_uri)
+        final_overlaps = [o for o, u in zip(overlaps, uris_to_check) if u in type_matches]
+    if not as_float:
+        format_overlaps(meta, final_overlaps)
     return meta, final_overlaps
 
 
+OVERLAP_NUMBER_KEYS = ('featureArea', 'intersectionArea', 'forwardPercentage', 'reversePercentage')
+
+def format_overlaps(meta, overlaps):
+    """
+    Format the float areas and percentages of get_location_overlaps(..., as_float=True) results for the API,
+    in place, as strings rounded to 8 decimal places ("NaN" when unknown).
+    """
+    if 'featureArea' in meta:
+        meta['featureArea'] = format_area(meta['featureArea'])
+    for o_dict in overlaps:
+        if isinstance(o_dict, str):
+            continue
+        for key in OVERLAP_NUMBER_KEYS:
+            if key in o_dict:
+                o_dict[key] = format_area(o_dict[key])
+
+
 async def get_at_location(lat, lon, loci_type="any", crs=4326, count=1000, offset=0):
     """
     :param lat:
@@ -998,12 +1304,6 @@ async def get_at_location(lat, lon, loci_type="any", crs=4326, count=1000, offse
     :type offset: int
     :return:
     """
-    loop = asyncio.get_event_loop()
-    try:
-        gds_session = get_at_location.session_cache[loop]
-    except KeyError:
-        gds_session = ClientSession(loop=loop)
-        get_at_location.session_cache[loop] = gds_session
     row = {}
     results = {}
     counter = 0
@@ -1015,27 +1315,84 @@ async def get_at_location(lat, lon, loci_type="any", crs=4326, count=1000, offse
         'ok': False
     }
     http_ok = [200]
+    point_index = get_point_index()
+    if point_index is not None and point_index.covers(loci_type, crs):
+        formatted_resp = point_index.search(loci_type, lon, lat)
+        formatted_resp['ok'] = True
+        meta = {
+            'count': formatted_resp['count'],
+            'offset': offset,
+        }
+        return meta, formatted_resp
     if loci_type == 'any':
        search_by_latlng_url = GEOM_DATA_SVC_ENDPOINT + "/search/latlng/{},{}".format(lon,lat)
     else:
        search_by_latlng_url = GEOM_DATA_SVC_ENDPOINT + "/search/latlng/{},{}/dataset/{}".format(lon, lat, loci_type)
     try:
-        resp = await gds_session.request('GET', search_by_latlng_url, params=params)
-        resp_content = await resp.text()
-        if resp.status not in http_ok:
-            formatted_resp['errorMessage'] = "Could not connect to the geometry data service at {}. Error code {}".format(GEOM_DATA_SVC_ENDPOINT, resp.status)
+        status, resp_content = await get_upstream('gds', search_by_latlng_url, params)
+        if status not in http_ok:
+            formatted_resp['errorMessage'] = "Could not connect to the geometry data service at {}. Error code {}".format(GEOM_DATA_SVC_ENDPOINT, status)
             return formatted_resp
         formatted_resp = loads(resp_content)
         formatted_resp['ok'] = True
     except ClientConnectorError:
         formatted_resp['errorMessage'] = "Could not connect to the geometry data service at {}. Connection error thrown.".format(GEOM_DATA_SVC_ENDPOINT)
         return formatted_resp
+    except asyncio.TimeoutError:
+        formatted_resp['errorMessage'] = "Timed out querying the geometry data service at {}.".format(GEOM_DATA_SVC_ENDPOINT)
+        return formatted_resp
     meta = {
         'count': formatted_resp['count'],
         'offset': offset,
     }
     return meta, formatted_resp
-get_at_location.session_cache = {}
+
+async def iter_at_locations(points, loci_type="any", crs=4326, count=1000, offset=0, concurrency=GDS_BATCH_CONCURRENCY):
+    """
+    get_at_location for many points, by a pool of concurrency workers taking the points in turn.
+    Each distinct point is only looked up once. A point whose lookup fails gets an error, like those of get_at_location,
+    instead of ending the whole batch.
+    :param points: (lon, lat) of each point
+    :type points: list
+    :return: async iterator of lists of get_at_location results, in the order of points,
+             each list holds the next results that are ready
+    """
+    results = {}
+    ready = asyncio.Condition()
+    # the workers share the one iterator, so each distinct point is taken by one of them
+    distinct = iter(OrderedDict.fromkeys(points))
+
+    async def lookup(lon, lat):
+        try:
+            return await get_at_location(lat, lon, loci_type, crs, count, offset)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.warning("Looking up the point {},{} failed: {!r}".format(lon, lat, e))
+            return {'ok': False, 'errorMessage': "Could not look up the point in the geometry data service at {}. {} thrown.".format(GEOM_DATA_SVC_ENDPOINT, type(e).__name__)}
+
+    async def worker():
+        for point in distinct:
+            result = await lookup(*point)
+            async with ready:
+                results[point] = result
+                ready.notify_all()
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(max(1, min(concurrency, len(points))))]
+    try:
+        i = 0
+        while i < len(points):
+            async with ready:
+                await ready.wait_for(lambda: points[i] in results)
+            page = []
+            while i < len(points) and points[i] in results:
+                page.append(results[points[i]])
+                i += 1
+            yield page
+    finally:
+        # the client may have gone away before the end of the stream
+        for task in workers:
+            task.cancel()
 
 async def query_es_endpoint(query, limit=10, offset=0):
     """
@@ -1050,13 +1407,7 @@ async def query_es_endpoint(query, limit=10, offset=0):
     :return:
     :rtype: dict
     """
-    loop = asyncio.get_event_loop()
     http_ok = [200]
-    try:
-        session = query_es_endpoint.session_cache[loop]
-    except KeyError:
-        session = ClientSession(loop=loop)
-        query_es_endpoint.session_cache[loop] = session
     args = {
         'q': query
 #        'limit': int(limit),
@@ -1067,10 +1418,9 @@ async def query_es_endpoint(query, limit=10, offset=0):
         'ok': False
     }
     try:
-        resp = await session.request('GET', ES_ENDPOINT, params=args)
-        resp_content = await resp.text()
-        if resp.status not in http_ok:
-            formatted_resp['errorMessage'] = "Could not connect to the label search engine. Error code {}".format(resp.status)
+        status, resp_content = await get_upstream('es', ES_ENDPOINT, args)
+        if status not in http_ok:
+            formatted_resp['errorMessage'] = "Could not connect to the label search engine. Error code {}".format(status)
             return formatted_resp
         formatted_resp = loads(resp_content)
         formatted_resp['ok'] = True
@@ -1078,8 +1428,10 @@ async def query_es_endpoint(query, limit=10, offset=0):
     except ClientConnectorError:
         formatted_resp['errorMessage'] = "Could not connect to the label search engine. Connection error thrown."
         return formatted_resp
+    except asyncio.TimeoutError:
+        formatted_resp['errorMessage'] = "Timed out querying the label search engine."
+        return formatted_resp
     return formatted_resp
-query_es_endpoint.session_cache = {}
 
 
 async def search_location_by_label(query):
@@ -1107,6 +1459,45 @@ async def search_location_by_label(query):
     return resp_object
 
 
+async def fetch_geometry(session, semaphore, geom_uri, params, geom_format):
+    """
+    Fetch one geometry, with at most as many fetches at a time as the semaphore allows.
+    Bodies are served from, and added to, the geometry cache.
+
+    :return: (True, geometry) or (False, error entry for meta['geom_response_errors'])
+    :rtype: tuple
+    """
+    http_ok = [200]
+    if(str(geom_uri).startswith("http") != True):
+       return False, geom_uri
+    key = (geom_uri, params['_view'], params['_format'])
+    with profile_call('geometry', geom_uri) as profiled:
+       resp_content = await geometry_cache.get(key) if geometry_cache is not None else None
+       if geometry_cache is not None:
+          profiled.cache = 'miss' if resp_content is None else 'hit'
+       if resp_content is None:
+          async with semaphore:
+             try:
+                 with time_upstream('geometry') as call:
+                     resp = await session.request('GET', geom_uri, params=params, timeout=geometry_request_timeout)
+                     resp_content = await resp.text()
+                     call.nbytes = len(resp_content)
+             except ClientConnectorError:
+                 return False, { 'uri': geom_uri , 'error' : "ClientConnectorError"}
+             except asyncio.TimeoutError:
+                 return False, { 'uri': geom_uri , 'error' : "TimeoutError"}
+          if resp.status not in http_ok:
+             return False, {
+                         'uri': geom_uri ,
+                         'error' : "http status code {}".format(resp.status)
+                       }
+          if geometry_cache is not None:
+             await geometry_cache.set(key, resp_content)
+       profiled.nbytes = len(resp_content)
+    if geom_format == "application/json":
+       return True, loads(resp_content)
+    return True, resp_content
+
 async def find_geometry_by_loci_uri(uri, geom_format, geom_view, uri_only):
     """
     Find the geometry for a given Loc-I Feature URI, including input format and view.
@@ -1120,7 +1511,6 @@ async def find_geometry_by_loci_uri(uri, geom_format, geom_view, uri_only):
     :return:
     :rtype: dict
     """
-    http_ok = [200]
     sparql = """\
 PREFIX geo: <http://www.opengis.net/ont/geosparql#>
 SELECT DISTINCT ?geom where { 
@@ -1142,12 +1532,7 @@ SELECT DISTINCT ?geom where {
     for b in bindings:
         geometry_list.append(b['geom']['value'])
     #get the gds response
-    loop = asyncio.get_event_loop()
-    try:
-        session = find_geometry_by_loci_uri.session_cache[loop]
-    except KeyError:
-        session = ClientSession(loop=loop)
-        find_geometry_by_loci_uri.session_cache[loop] = session
+    session = get_session('geometry')
     if uri_only == True: # return just the geometry uris as a list if this is set
        meta['count'] = len(geometry_list)
        return meta, geometry_list
@@ -1166,27 +1551,15 @@ SELECT DISTINCT ?geom where {
        params['_view'] = geom_view
     if geom_format != None:
        params['_format'] = geom_format
-    for geom_uri in geometry_list:
-       if(str(geom_uri).startswith("http") != True):
-          geom_response_error_list.append(geom_uri)
-          continue 
-       try:
-           resp = await session.request('GET', geom_uri, params=params)
-           resp_content = await resp.text()
-           if resp.status not in http_ok:
-               geom_response_error_list.append({ 
-                           'uri': geom_uri , 
-                           'error' : "http status code {}".format(resp.status)
-                         })
-               continue 
-           if geom_format == "application/json":
-              geom_response_list.append(loads(resp_content))
-           else:
-              geom_response_list.append(resp_content)
-       except ClientConnectorError:
-           geom_response_error_list.append({ 'uri': geom_uri , 'error' : "ClientConnectorError"})
+    semaphore = asyncio.Semaphore(GEOMETRY_FETCH_CONCURRENCY)
+    fetches = [fetch_geometry(session, semaphore, geom_uri, params, geom_format) for geom_uri in geometry_list]
+    # gather keeps the results in the order of geometry_list
+    for ok, result in await asyncio.gather(*fetches):
+       if ok:
+          geom_response_list.append(result)
+       else:
+          geom_response_error_list.append(result)
     if len(geom_response_error_list) > 0:
        meta['geom_response_errors'] = geom_response_error_list
     meta['count'] = len(geom_response_list)
     return meta, geom_response_list
-find_geometry_by_loci_uri.session_cache = {}
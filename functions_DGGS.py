@@ -1,16 +1,14 @@
 import asyncio
 import asyncpg
+import logging
 import math
-import psycopg2
+from collections import OrderedDict
 from decimal import Decimal
-from aiohttp import ClientSession
-from aiohttp.client_exceptions import ClientConnectorError
-from config import TRIPLESTORE_CACHE_SPARQL_ENDPOINT
-from config import ES_ENDPOINT
-from config import GEOM_DATA_SVC_ENDPOINT
-from config import PG_ENDPOINT
-from config import PG_TABLE
-from json import loads
+from config import PG_HOST, PG_PORT, PG_DB_NAME, PG_USER, PG_PASSWORD, PG_TABLE
+from config import PG_POOL_MIN_SIZE, PG_POOL_MAX_SIZE, PG_STATEMENT_TIMEOUT
+from singleflight import SingleFlight
+from metrics import time_upstream
+from profiling import profile_call
 
 # Mapping linked data base uri to loci data type and DGGS columns
 DGGS_COLUMN_LOOKUP = {
@@ -50,25 +48,96 @@ STATE_TO_CODE = {
     "9": ''
 }
 
+pg_pool = None
+# Concurrent first users of the pool wait for the one pool being created
+pg_pool_inflight = SingleFlight()
+
+async def _create_pg_pool():
+    server_settings = {}
+    if PG_STATEMENT_TIMEOUT:
+        # cancel long running statements on the server too, not only on the client side
+        server_settings['statement_timeout'] = str(int(PG_STATEMENT_TIMEOUT * 1000))
+    return await asyncpg.create_pool(host=PG_HOST, port=int(PG_PORT) if PG_PORT else None, database=PG_DB_NAME,
+                                     user=PG_USER, password=PG_PASSWORD,
+                                     min_size=PG_POOL_MIN_SIZE, max_size=PG_POOL_MAX_SIZE,
+                                     command_timeout=PG_STATEMENT_TIMEOUT, server_settings=server_settings)
+
+async def get_pg_pool():
+    """
+    Get the DGGS database connection pool, creating it if that has not been done at startup.
+    :rtype: asyncpg.pool.Pool
+    """
+    global pg_pool
+    if pg_pool is None:
+        pool = await pg_pool_inflight.do('pg_pool', _create_pg_pool)
+        if pg_pool is None:
+            pg_pool = pool
+    return pg_pool
+
+async def open_pg_pool(app, loop):
+    try:
+        await get_pg_pool()
+    except (OSError, asyncio.TimeoutError, asyncpg.PostgresError) as e:
+        # get_pg_pool will try again on first use
+        logging.warning("Could not connect to the DGGS database at startup: {}".format(str(e)))
+
+async def close_pg_pool(app, loop):
+    global pg_pool
+    if pg_pool is not None:
+        pool, pg_pool = pg_pool, None
+        await pool.close()
+
+def setup_pg_pool(app):
+    """
+    Create the DGGS database connection pool when the server starts, and close it when it stops.
+    """
+    app.register_listener(open_pg_pool, 'before_server_start')
+    app.register_listener(close_pg_pool, 'after_server_stop')
+
+_INTEGER_TYPES = ('int2', 'int4', 'int8')
+
+def _parameter_value(statement, value):
+    """
+    Convert a uri or cell id value to the type of the statement's first parameter,
+    so numeric code columns can be compared without casting the column.
+    Returns None when the value can not be of that type, so nothing can match it.
+    """
+    return _convert(statement.get_parameters()[0].name, value)
+
+def _array_parameter_values(statement, values):
+    """
+    Convert values to the element type of the statement's first (array) parameter, dropping any that can not be of it.
+    :return: the converted value of each value, None when it can not be converted
+    :rtype: list
+    """
+    # array type names are the element type name prefixed with an underscore, eg _int4
+    type_name = statement.get_parameters()[0].name.lstrip('_')
+    return [_convert(type_name, value) for value in values]
+
+def _convert(type_name, value):
+    try:
+        if type_name in _INTEGER_TYPES:
+            return int(value)
+        if type_name == 'numeric':
+            return Decimal(value)
+    except (ValueError, ArithmeticError):
+        return None
+    return value
+
 async def find_dggs_by_loci_uri(uri):
     """
     Function for finding an array of DGGS cells by a loci uri, eg: http://linked.data.gov.au/dataset/asgs2016/statisticalarealevel1/31503140814
     """
-    dggs_column = 'sa1_main16'
-    uri_value = ""
-    for lookup_key, lookup_value in DGGS_COLUMN_LOOKUP.items():
-        index = uri.find(lookup_key)
-        if index==0:
-            dggs_column = lookup_value[1]
-            uri_value = uri[(len(lookup_key)+1):len(uri)]
-            break
-    sql = f'select auspix_dggs from {PG_TABLE} where {dggs_column}=\'{uri_value}\''
-    # print(PG_ENDPOINT)
-    conn = psycopg2.connect(PG_ENDPOINT)
-    db_cursor = conn.cursor()
-    res = db_cursor.execute(sql)
-    records = db_cursor.fetchall() 
-    db_cursor.close()
+    dggs_column, uri_value = dggs_column_and_value(uri)
+    # dggs_column always comes from DGGS_COLUMN_LOOKUP, the uri value is only ever passed as a parameter
+    sql = f'select auspix_dggs from {PG_TABLE} where {dggs_column}=$1'
+    pool = await get_pg_pool()
+    async with pool.acquire() as conn:
+        statement = await conn.prepare(sql)
+        value = _parameter_value(statement, uri_value)
+        with time_upstream('postgres'), profile_call('postgres', sql) as call:
+            records = await statement.fetch(value) if value is not None else []
+            call.rows = len(records)
     dggs_cells = []
     for record in records:
         dggs_cells.append(record[0])
@@ -78,68 +147,166 @@ async def find_dggs_by_loci_uri(uri):
     }
     return meta, dggs_cells
 
+def dggs_column_and_value(uri):
+    """
+    The DGGS table column holding the code of a loci uri, and its code
+    """
+    for lookup_key, lookup_value in DGGS_COLUMN_LOOKUP.items():
+        if uri.find(lookup_key) == 0:
+            return lookup_value[1], uri[(len(lookup_key)+1):len(uri)]
+    return 'sa1_main16', ""
+
+async def find_dggs_by_loci_uris(uris):
+    """
+    Batch version of find_dggs_by_loci_uri, with one query per DGGS column rather than one per uri
+    :param uris: loci uris
+    :type uris: list
+    :return: (meta, dggs cells) of each uri, in the order of uris
+    :rtype: list
+    """
+    # column -> uri codes wanted from it
+    by_column = OrderedDict()
+    column_values = [dggs_column_and_value(uri) for uri in uris]
+    for dggs_column, uri_value in column_values:
+        by_column.setdefault(dggs_column, OrderedDict())[uri_value] = None
+    cells = {}
+    pool = await get_pg_pool()
+    async with pool.acquire() as conn:
+        for dggs_column, uri_values in by_column.items():
+            # dggs_column always comes from DGGS_COLUMN_LOOKUP, the uri values are only ever passed as a parameter
+            sql = f'select {dggs_column}, auspix_dggs from {PG_TABLE} where {dggs_column} = ANY($1)'
+            statement = await conn.prepare(sql)
+            uri_values = list(uri_values.keys())
+            values = _array_parameter_values(statement, uri_values)
+            found = {}
+            with time_upstream('postgres'), profile_call('postgres', sql) as call:
+                records = await statement.fetch([v for v in values if v is not None])
+                call.rows = len(records)
+            for record in records:
+                found.setdefault(record[0], []).append(record[1])
+            for uri_value, value in zip(uri_values, values):
+                cells[(dggs_column, uri_value)] = found.get(value, []) if value is not None else []
+    results = []
+    for uri, key in zip(uris, column_values):
+        dggs_cells = cells[key]
+        meta = {
+            'count': len(dggs_cells),
+            'uri': uri
+        }
+        results.append((meta, dggs_cells))
+    return results
+
 def none_to_empty(none):
     if none is None:
         return ''
     return str(none)
+
+def cell_locations(item):
+    """
+    Manully map the selected columns of a DGGS cell row into objects
+    :param item: sa1_main16, sa2_main16, sa3_code16, lga_code19, ssc_code16 of the cell
+    :return: the loci features of the cell
+    :rtype: list
+    """
+    sa1_obj = {}
+    sa1_obj['uri'] = 'http://linked.data.gov.au/dataset/asgs2016/statisticalarealevel1/'+none_to_empty(item[0])
+    sa1_obj['datatypeURI'] = 'http://linked.data.gov.au/def/asgs#StatisticalAreaLevel1'
+    sa1_obj['dataType'] = 'asgs16_sa1'
+
+    sa2_obj = {}
+    sa2_obj['uri'] = 'http://linked.data.gov.au/dataset/asgs2016/statisticalarealevel2/'+none_to_empty(item[1])
+    sa2_obj['datatypeURI'] = 'http://linked.data.gov.au/def/asgs#StatisticalAreaLevel2'
+    sa2_obj['dataType'] = 'asgs16_sa2'
+
+    sa3_obj = {}
+    sa3_obj['uri'] = 'http://linked.data.gov.au/dataset/asgs2016/statisticalarealevel3/'+none_to_empty(item[2])
+    sa3_obj['datatypeURI'] = 'http://linked.data.gov.au/def/asgs#StatisticalAreaLevel3'
+    sa3_obj['dataType'] = 'asgs16_sa3'
+
+    lga_obj = {}
+    lga_obj['uri'] = 'http://linked.data.gov.au/dataset/asgs2016/localgovernmentarea/'+none_to_empty(item[3])
+    lga_obj['datatypeURI'] = 'http://linked.data.gov.au/def/asgs#LocalGovernmentArea'
+    lga_obj['dataType'] = 'asgs16_lga'
+
+    ssc_obj = {}
+    ssc_obj['uri'] = 'http://linked.data.gov.au/dataset/asgs2016/statesuburb/'+none_to_empty(item[4])
+    ssc_obj['datatypeURI'] = 'http://linked.data.gov.au/def/asgs#StateSuburb'
+    ssc_obj['dataType'] = 'asgs16_ssc'
+
+    return [sa1_obj, sa2_obj, sa3_obj, lga_obj, ssc_obj]
+
+DGGS_PREFIX = 'http://ec2-52-63-73-113.ap-southeast-2.compute.amazonaws.com/AusPIX-DGGS-dataset/ausPIX/'
+
+def dggs_cell_id(dggs_cell):
+    """
+    The AusPIX cell id of a cell id or cell uri
+    """
+    if dggs_cell.find(DGGS_PREFIX) == 0:
+        return dggs_cell[len(DGGS_PREFIX):len(dggs_cell)]
+    return dggs_cell
+
 async def find_at_dggs_cell(dggs_cell):
     """
     Function for finding an array of Loci-i features by a DGGS AUxPIX Cell ID, eg "R6810000005"
     """
-    dggs_prefix = 'http://ec2-52-63-73-113.ap-southeast-2.compute.amazonaws.com/AusPIX-DGGS-dataset/ausPIX/'
-    # print(PG_ENDPOINT)
-    index = dggs_cell.find(dggs_prefix)
-    dggs_cell_id = dggs_cell
-    if index==0:
-        dggs_cell_id = dggs_cell[len(dggs_prefix):len(dggs_cell)]
     sql = f'select \
             sa1_main16, \
             sa2_main16, \
             sa3_code16, \
             lga_code19, \
             ssc_code16 \
-            FROM {PG_TABLE} WHERE auspix_dggs=\'{dggs_cell_id}\''
-    # print(sql)
-    conn = psycopg2.connect(PG_ENDPOINT)
-    db_cursor = conn.cursor()
-    res = db_cursor.execute(sql)
-    records = db_cursor.fetchall() 
-    db_cursor.close()
-
-    # For each DGGS cell id, only one row will selected
-    #print(records)
+            FROM {PG_TABLE} WHERE auspix_dggs=$1'
+    pool = await get_pg_pool()
+    async with pool.acquire() as conn:
+        statement = await conn.prepare(sql)
+        # For each DGGS cell id, only one row will selected
+        with time_upstream('postgres'), profile_call('postgres', sql) as call:
+            item = await statement.fetchrow(dggs_cell_id(dggs_cell))
+            call.rows = 0 if item is None else 1
+
     locations = []
-    if records:
-        item = records[0]
-        # Manully mapping the selected columns into objects
-        sa1_obj = {}
-        sa1_obj['uri'] = 'http://linked.data.gov.au/dataset/asgs2016/statisticalarealevel1/'+none_to_empty(item[0])
-        sa1_obj['datatypeURI'] = 'http://linked.data.gov.au/def/asgs#StatisticalAreaLevel1'
-        sa1_obj['dataType'] = 'asgs16_sa1'
-
-        sa2_obj = {}
-        sa2_obj['uri'] = 'http://linked.data.gov.au/dataset/asgs2016/statisticalarealevel2/'+none_to_empty(item[1])
-        sa2_obj['datatypeURI'] = 'http://linked.data.gov.au/def/asgs#StatisticalAreaLevel2'
-        sa2_obj['dataType'] = 'asgs16_sa2'
-
-        sa3_obj = {}
-        sa3_obj['uri'] = 'http://linked.data.gov.au/dataset/asgs2016/statisticalarealevel3/'+none_to_empty(item[2])
-        sa3_obj['datatypeURI'] = 'http://linked.data.gov.au/def/asgs#StatisticalAreaLevel3'
-        sa3_obj['dataType'] = 'asgs16_sa3'
-
-        lga_obj = {}
-        lga_obj['uri'] = 'http://linked.data.gov.au/dataset/asgs2016/localgovernmentarea/'+none_to_empty(item[3])
-        lga_obj['datatypeURI'] = 'http://linked.data.gov.au/def/asgs#LocalGovernmentArea'
-        lga_obj['dataType'] = 'asgs16_lga'
-
-        ssc_obj = {}
-        ssc_obj['uri'] = 'http://linked.data.gov.au/dataset/asgs2016/statesuburb/'+none_to_empty(item[4])
-        ssc_obj['datatypeURI'] = 'http://linked.data.gov.au/def/asgs#StateSuburb'
-        ssc_obj['dataType'] = 'asgs16_ssc'
-
-        locations = [sa1_obj, sa2_obj, sa3_obj, lga_obj, ssc_obj]
+    if item is not None:
+        locations = cell_locations(item)
     meta = {
         'count': len(locations),
         'dggs_cell_id': dggs_cell
     }
     return meta, locations
+
+async def find_at_dggs_cells(dggs_cells):
+    """
+    Batch version of find_at_dggs_cell, with one query for all the cells
+    :param dggs_cells: DGGS AUxPIX Cell IDs
+    :type dggs_cells: list
+    :return: (meta, locations) of each cell, in the order of dggs_cells
+    :rtype: list
+    """
+    cell_ids = [dggs_cell_id(dggs_cell) for dggs_cell in dggs_cells]
+    sql = f'select \
+            auspix_dggs, \
+            sa1_main16, \
+            sa2_main16, \
+            sa3_code16, \
+            lga_code19, \
+            ssc_code16 \
+            FROM {PG_TABLE} WHERE auspix_dggs = ANY($1)'
+    pool = await get_pg_pool()
+    async with pool.acquire() as conn:
+        statement = await conn.prepare(sql)
+        with time_upstream('postgres'), profile_call('postgres', sql) as call:
+            records = await statement.fetch(list(OrderedDict.fromkeys(cell_ids)))
+            call.rows = len(records)
+    rows = {}
+    for record in records:
+        # For each DGGS cell id, only one row will selected
+        rows.setdefault(record[0], tuple(record)[1:])
+    results = []
+    for dggs_cell, cell_id in zip(dggs_cells, cell_ids):
+        item = rows.get(cell_id, None)
+        locations = cell_locations(item) if item is not None else []
+        meta = {
+            'count': len(locations),
+            'dggs_cell_id': dggs_cell
+        }
+        results.append((meta, locations))
+    return results
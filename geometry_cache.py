@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+#
+"""
+A cache of geometry service responses, keyed on (geometry uri, view, format).
+Geometries do not change within a dataset release, and the full views are large, so the bodies are kept
+zlib compressed, in memory and optionally on disk, each tier bounded by its total compressed size.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import zlib
+from cache import LRUCache
+
+# Bodies smaller than this are (de)compressed on the event loop, bigger ones in a worker thread
+INLINE_LIMIT = 64 * 1024
+
+
+class GeometryCache(object):
+    """
+    A two tier LRU cache of geometry bodies. Entries evicted from memory can still be read back from disk.
+    """
+    __slots__ = ("memory", "directory", "disk", "level")
+
+    def __init__(self, max_bytes, directory=None, disk_max_bytes=None, level=6):
+        """
+        :param max_bytes: maximum total compressed size held in memory
+        :type max_bytes: int
+        :param directory: directory of the on-disk tier, None for no disk tier
+        :type directory: str
+        :param disk_max_bytes: maximum total compressed size held on disk, None for no limit
+        :type disk_max_bytes: int
+        :param level: zlib compression level
+        :type level: int
+        """
+        self.memory = LRUCache(max_entries=None, max_bytes=max_bytes)
+        self.directory = directory
+        self.level = level
+        self.disk = None
+        if directory is not None:
+            # the disk index holds the size of each file, by file name
+            self.disk = LRUCache(max_entries=None, max_bytes=disk_max_bytes, size_of=lambda size: size,
+                                 on_evict=self._remove_file)
+            os.makedirs(directory, exist_ok=True)
+            self._load_disk_index()
+
+    def _load_disk_index(self):
+        """
+        Index the files left by a previous run, least recently modified first.
+        """
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".z"):
+                stat = os.stat(os.path.join(self.directory, name))
+                files.append((stat.st_mtime, name, stat.st_size))
+        for mtime, name, size in sorted(files):
+            self.disk.set(name, size)
+
+    @staticmethod
+    def _file_name(key):
+        return hashlib.sha256(json.dumps(key).encode('utf-8')).hexdigest() + ".z"
+
+    def _remove_file(self, name, size):
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except OSError:
+            pass
+
+    def _read_file(self, name):
+        with open(os.path.join(self.directory, name), 'rb') as f:
+            return f.read()
+
+    def _write_file(self, name, compressed):
+        path = os.path.join(self.directory, name)
+        with open(path + ".tmp", 'wb') as f:
+            f.write(compressed)
+        os.replace(path + ".tmp", path)
+
+    async def _run(self, size, fn, *args):
+        if size < INLINE_LIMIT:
+            return fn(*args)
+        return await asyncio.get_event_loop().run_in_executor(None, fn, *args)
+
+    async def get(self, key):
+        """
+        :return: the cached body, or None
+        :rtype: str
+        """
+        compressed = self.memory.get(key)
+        if compressed is None and self.disk is not None:
+            name = self._file_name(key)
+            size = self.disk.get(name)
+            if size is not None:
+                try:
+                    compressed = await self._run(size, self._read_file, name)
+                except OSError as e:
+                    logging.warning("Could not read cached geometry {}: {}".format(name, str(e)))
+                    self.disk.pop(name)
+                else:
+                    self.memory.set(key, compressed)
+        if compressed is None:
+            return None
+        return (await self._run(len(compressed), zlib.decompress, compressed)).decode('utf-8')
+
+    async def set(self, key, body):
+        """
+        Cache a body, in memory and on disk.
+        """
+        data = body.encode('utf-8')
+        compressed = await self._run(len(data), zlib.compress, data, self.level)
+        self.memory.set(key, compressed)
+        if self.disk is not None:
+            name = self._file_name(key)
+            try:
+                await self._run(len(compressed), self._write_file, name, compressed)
+            except OSError as e:
+                logging.warning("Could not write cached geometry {}: {}".format(name, str(e)))
+            else:
+                self.disk.set(name, len(compressed))
+
+    def stats(self):
+        return {
+            'memory': self.memory.stats(),
+            'disk': self.disk.stats() if self.disk is not None else None,
+        }
@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+#
+"""
+An offline-built index of the LOCI containment hierarchy, so sfWithin+ / sfContains+ closures and feature areas
+can be answered in-process instead of with SPARQL property path queries.
+
+Build it from the triplestore with:
+    python hierarchy_index.py build <index directory>
+and point HIERARCHY_INDEX_PATH at the directory to use it.
+
+The index directory holds plain numpy arrays, which are memory mapped when loaded:
+  uris.bin, uri_offsets.npy   the feature uris, utf-8 encoded and sorted, a feature's number is its position
+  area.npy                    geox:hasAreaM2 (EPSG:3577) of each feature, NaN when unknown
+  <edges>_indptr.npy, <edges>_indices.npy
+                              CSR adjacency arrays, the neighbours of feature i are indices[indptr[i]:indptr[i+1]]
+for the edge sets
+  within, contains            geo:sfWithin / geo:sfContains triples, followed transitively
+  linkset_within, linkset_contains
+                              reified geo:sfWithin / geo:sfContains statements from linksets, followed one hop only
+Each edge set holds just the statements of its own predicate, as the SPARQL fallback queries in functions.py follow,
+so an sfContains statement is not also taken as an sfWithin one the other way round. The closures are in uri order,
+as the fallback queries are, so pages of results are the same with and without the index.
+"""
+import asyncio
+import json
+import logging
+import math
+import os
+import sys
+import time
+from decimal import Decimal
+import numpy as np
+from config import HIERARCHY_INDEX_PATH
+
+INDEX_VERSION = 2
+EDGE_SETS = ("within", "contains", "linkset_within", "linkset_contains")
+
+
+class UriTable(object):
+    """
+    A sorted table of uris over a utf-8 byte buffer, looked up by binary search.
+    """
+    __slots__ = ("_data", "_offsets")
+
+    def __init__(self, data, offsets):
+        self._data = data
+        self._offsets = offsets
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def _bytes(self, i):
+        return bytes(self._data[self._offsets[i]:self._offsets[i + 1]])
+
+    def __getitem__(self, i):
+        return self._bytes(i).decode('utf-8')
+
+    def index_of(self, uri):
+        """
+        :return: the position of uri in the table, or -1 when it is not there
+        :rtype: int
+        """
+        key = uri.encode('utf-8')
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._bytes(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self) and self._bytes(lo) == key:
+            return lo
+        return -1
+
+
+class HierarchyIndex(object):
+    """
+    The containment hierarchy, loaded from an index directory.
+    """
+    __slots__ = ("path", "uris", "areas", "edges")
+
+    def __init__(self, path, uris, areas, edges):
+        self.path = path
+        self.uris = uris
+        self.areas = areas
+        self.edges = edges
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        if meta.get('version', None) != INDEX_VERSION:
+            raise ValueError("Hierarchy index at {} is version {}, expected {}"
+                             .format(path, meta.get('version', None), INDEX_VERSION))
+        data = np.memmap(os.path.join(path, "uris.bin"), dtype=np.uint8, mode='r') \
+            if os.path.getsize(os.path.join(path, "uris.bin")) > 0 else np.zeros(0, dtype=np.uint8)
+        offsets = np.load(os.path.join(path, "uri_offsets.npy"), mmap_mode='r')
+        areas = np.load(os.path.join(path, "area.npy"), mmap_mode='r')
+        edges = {}
+        for name in EDGE_SETS:
+            edges[name] = (np.load(os.path.join(path, "{}_indptr.npy".format(name)), mmap_mode='r'),
+                           np.load(os.path.join(path, "{}_indices.npy".format(name)), mmap_mode='r'))
+        return cls(path, UriTable(data, offsets), areas, edges)
+
+    def __contains__(self, uri):
+        return self.uris.index_of(uri) >= 0
+
+    def __len__(self):
+        return len(self.uris)
+
+    def _neighbours(self, edge_set, i):
+        indptr, indices = self.edges[edge_set]
+        return indices[indptr[i]:indptr[i + 1]]
+
+    def _closure(self, uri, edge_set, linkset_edge_set):
+        """
+        All features reachable from uri over edge_set, plus the direct neighbours of uri over linkset_edge_set,
+        in uri order. Like a sfWithin+ path, uri itself is only included when it is on a cycle.
+        """
+        start = self.uris.index_of(uri)
+        if start < 0:
+            return []
+        seen = set()
+        found = []
+        frontier = [start]
+        while frontier:
+            next_frontier = []
+            for i in frontier:
+                for j in self._neighbours(edge_set, i).tolist():
+                    if j not in seen:
+                        seen.add(j)
+                        found.append(j)
+                        next_frontier.append(j)
+            frontier = next_frontier
+        for j in self._neighbours(linkset_edge_set, start).tolist():
+            if j not in seen:
+                seen.add(j)
+                found.append(j)
+        # the uri table is sorted, so the order of the feature numbers is the order of the uris
+        found.sort()
+        return found
+
+    def within(self, uri):
+        """
+        :return: the uris of the features uri is within
+        :rtype: list
+        """
+        return [self.uris[i] for i in self._closure(uri, "within", "linkset_within")]
+
+    def contains(self, uri):
+        """
+        :return: the uris of the features uri contains
+        :rtype: list
+        """
+        return [self.uris[i] for i in self._closure(uri, "contains", "linkset_contains")]
+
+    def within_with_areas(self, uri):
+        """
+        :return: (uri, area) of the features uri is within
+        :rtype: list
+        """
+        return [(self.uris[i], float(self.areas[i])) for i in self._closure(uri, "within", "linkset_within")]
+
+    def area(self, uri):
+        """
+        :return: the area of the feature in m2, NaN when it is unknown or the feature is not in the index
+        :rtype: float
+        """
+        i = self.uris.index_of(uri)
+        if i < 0:
+            return math.nan
+        return float(self.areas[i])
+
+
+def format_area(area):
+    """
+    Format an area the way get_location_overlaps does, ie str(round(Decimal(area), 8))
+    """
+    return str(round(Decimal(repr(float(area))), 8))
+
+
+hierarchy_index = None
+
+
+def get_hierarchy_index():
+    """
+    :return: the hierarchy index at HIERARCHY_INDEX_PATH, or None if there is not one
+    :rtype: HierarchyIndex
+    """
+    global hierarchy_index
+    if hierarchy_index is None and HIERARCHY_INDEX_PATH and not get_hierarchy_index.failed:
+        try:
+            hierarchy_index = HierarchyIndex.load(HIERARCHY_INDEX_PATH)
+        except (OSError, ValueError) as e:
+            logging.warning("Could not load the hierarchy index at {}, using SPARQL instead: {}"
+                            .format(HIERARCHY_INDEX_PATH, str(e)))
+            get_hierarchy_index.failed = True
+    return hierarchy_index
+get_hierarchy_index.failed = False
+
+
+def _csr(n, sources, targets):
+    sources = np.asarray(sources, dtype=np.int64)
+    targets = np.asarray(targets, dtype=np.int32)
+    if len(sources):
+        # drop duplicate edges, and order the neighbours of each feature
+        edges = np.unique(np.stack([sources, targets.astype(np.int64)], axis=1), axis=0)
+        sources, targets = edges[:, 0], edges[:, 1].astype(np.int32)
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=n), out=indptr[1:])
+    return indptr, targets
+
+
+def write_index(path, edges, areas):
+    """
+    Write an index directory.
+    :param path: the index directory, created if needed
+    :param edges: mapping of the name of each of the EDGE_SETS to its (from uri, to uri) pairs,
+    eg (child, parent) pairs for within and (parent, child) pairs for contains, a missing edge set has no edges
+    :param areas: mapping of feature uri to area in m2
+    """
+    edges = {name: list(edges.get(name, ())) for name in EDGE_SETS}
+    all_uris = set(areas.keys())
+    for pairs in edges.values():
+        for a, b in pairs:
+            all_uris.add(a)
+            all_uris.add(b)
+    encoded = sorted(u.encode('utf-8') for u in all_uris)
+    number = {u.decode('utf-8'): i for i, u in enumerate(encoded)}
+    n = len(encoded)
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum([len(u) for u in encoded], out=offsets[1:])
+    area_array = np.full(n, np.nan, dtype=np.float64)
+    for uri, area in areas.items():
+        area_array[number[uri]] = float(area)
+
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, "uris.bin"), 'wb') as f:
+        f.write(b"".join(encoded))
+    np.save(os.path.join(path, "uri_offsets.npy"), offsets)
+    np.save(os.path.join(path, "area.npy"), area_array)
+    for name, pairs in edges.items():
+        indptr, indices = _csr(n, [number[a] for a, b in pairs], [number[b] for a, b in pairs])
+        np.save(os.path.join(path, "{}_indptr.npy".format(name)), indptr)
+        np.save(os.path.join(path, "{}_indices.npy".format(name)), indices)
+    meta = {'version': INDEX_VERSION, 'features': n, 'built': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}
+    meta.update({name: len(pairs) for name, pairs in edges.items()})
+    with open(os.path.join(path, "meta.json"), 'w') as f:
+        json.dump(meta, f)
+
+
+BUILD_PAGE_SIZE = 500000
+
+_PREFIXES = """\
+PREFIX geo: <http://www.opengis.net/ont/geosparql#>
+PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
+PREFIX geox: <http://linked.data.gov.au/def/geox#>
+PREFIX epsg: <http://www.opengis.net/def/crs/EPSG/0/>
+PREFIX dt: <http://linked.data.gov.au/def/datatype/>
+"""
+
+# The pages of each export are ordered, without ORDER BY the triplestore may give the rows of a paged
+# SELECT DISTINCT in a different order for each page, and skip some of them.
+_EDGES_SPARQL = _PREFIXES + """\
+SELECT DISTINCT ?s ?o
+WHERE {
+    ?s <PREDICATE> ?o .
+    FILTER(isIRI(?s) && isIRI(?o))
+}
+ORDER BY ?s ?o
+"""
+
+_LINKSET_EDGES_SPARQL = _PREFIXES + """\
+SELECT DISTINCT ?s ?o
+WHERE {
+    ?st rdf:subject ?s ;
+        rdf:predicate <PREDICATE> ;
+        rdf:object ?o .
+    FILTER(isIRI(?s) && isIRI(?o))
+}
+ORDER BY ?s ?o
+"""
+
+_AREAS_SPARQL = _PREFIXES + """\
+SELECT ?f (MAX(?a) AS ?area)
+WHERE {
+    ?f geox:hasAreaM2 ?ha .
+    ?ha geox:inCRS epsg:3577 .
+    ?ha dt:value ?a .
+}
+GROUP BY ?f
+ORDER BY ?f
+"""
+
+# The sparql and predicate each edge set is exported with, the same statements the fallback queries follow
+_EDGE_EXPORTS = (
+    ("within", _EDGES_SPARQL, "geo:sfWithin"),
+    ("contains", _EDGES_SPARQL, "geo:sfContains"),
+    ("linkset_within", _LINKSET_EDGES_SPARQL, "geo:sfWithin"),
+    ("linkset_contains", _LINKSET_EDGES_SPARQL, "geo:sfContains"),
+)
+
+
+async def _export_pairs(sparql, a, b, page_size=BUILD_PAGE_SIZE):
+    from functions import query_graphdb_endpoint
+    offset = 0
+    pairs = []
+    while True:
+        # the same inference and sameAs expansion as the fallback queries, so the same statements are seen
+        resp = await query_graphdb_endpoint(sparql, limit=page_size, offset=offset)
+        bindings = resp['results']['bindings'] if 'results' in resp else []
+        for row in bindings:
+            if a in row and b in row:
+                pairs.append((row[a]['value'], row[b]['value']))
+        logging.info("Exported {} rows".format(offset + len(bindings)))
+        if len(bindings) < page_size:
+            return pairs
+        offset += page_size
+
+
+async def build_index(path, page_size=BUILD_PAGE_SIZE):
+    """
+    Export the sfWithin / sfContains statements and the feature areas from the triplestore into an index directory.
+    :return: the number of edges of each edge set, and the number of areas
+    :rtype: tuple
+    """
+    edges = {}
+    for name, sparql, predicate in _EDGE_EXPORTS:
+        edges[name] = await _export_pairs(sparql.replace("<PREDICATE>", predicate), 's', 'o', page_size)
+    areas = dict(await _export_pairs(_AREAS_SPARQL, 'f', 'area', page_size))
+    write_index(path, edges, areas)
+    return {name: len(pairs) for name, pairs in edges.items()}, len(areas)
+
+
+async def _main(path):
+    from upstream import upstreams
+    try:
+        edges, areas = await build_index(path)
+    finally:
+        await upstreams.close()
+    print("Wrote hierarchy index to {}: {}, {} areas"
+          .format(path, ", ".join("{} {} edges".format(n, name) for name, n in edges.items()), areas))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) != 3 or sys.argv[1] != "build":
+        print("Usage: python hierarchy_index.py build <index directory>")
+        sys.exit(1)
+    asyncio.get_event_loop().run_until_complete(_main(sys.argv[2]))
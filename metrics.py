@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+#
+"""
+Request and upstream metrics, served in the Prometheus text exposition format on /metrics.
+Metrics are kept per worker process.
+"""
+import time
+from collections import OrderedDict
+from sanic.response import HTTPResponse
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+BYTES_BUCKETS = tuple(256 * 4 ** i for i in range(10))  # 256B to 64MB
+ROWS_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Histogram(object):
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+
+class Metric(object):
+    """
+    A counter or histogram, with one series per label values.
+    """
+    __slots__ = ("name", "kind", "help", "label_names", "buckets", "series")
+
+    def __init__(self, name, kind, help, label_names=(), buckets=None):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.label_names = label_names
+        self.buckets = buckets
+        self.series = OrderedDict()
+
+    def inc(self, *labels, amount=1):
+        self.series[labels] = self.series.get(labels, 0) + amount
+
+    def observe(self, value, *labels):
+        histogram = self.series.get(labels, None)
+        if histogram is None:
+            histogram = self.series[labels] = Histogram(self.buckets)
+        histogram.observe(value)
+
+    def render(self, lines):
+        lines.append("# HELP {} {}".format(self.name, self.help))
+        lines.append("# TYPE {} {}".format(self.name, self.kind))
+        for labels, value in self.series.items():
+            pairs = list(zip(self.label_names, labels))
+            if self.kind != 'histogram':
+                lines.append("{}{} {}".format(self.name, _labels(pairs), _number(value)))
+                continue
+            cumulative = 0
+            for bound, count in zip(value.buckets, value.counts):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(self.name, _labels(pairs + [('le', _number(bound))]), cumulative))
+            lines.append("{}_bucket{} {}".format(self.name, _labels(pairs + [('le', '+Inf')]), value.count))
+            lines.append("{}_sum{} {}".format(self.name, _labels(pairs), _number(value.sum)))
+            lines.append("{}_count{} {}".format(self.name, _labels(pairs), value.count))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(pairs):
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, _escape(v)) for k, v in pairs) + "}"
+
+
+def _number(value):
+    if isinstance(value, float) and value.is_integer():
+        return repr(value)
+    return str(value)
+
+
+class Metrics(object):
+    """
+    The metrics of this process.
+    """
+    def __init__(self):
+        self.requests = Metric("loci_http_requests_total", "counter",
+                               "API requests handled.", ("route", "method", "status"))
+        self.request_seconds = Metric("loci_http_request_duration_seconds", "histogram",
+                                      "Time to produce API responses.", ("route", "method"), LATENCY_BUCKETS)
+        self.upstream_calls = Metric("loci_upstream_requests_total", "counter",
+                                     "Requests made to upstream services.", ("upstream", "outcome"))
+        self.upstream_seconds = Metric("loci_upstream_request_duration_seconds", "histogram",
+                                       "Duration of requests to upstream services.", ("upstream",), LATENCY_BUCKETS)
+        self.upstream_bytes = Metric("loci_upstream_response_bytes", "histogram",
+                                     "Size of upstream service responses.", ("upstream",), BYTES_BUCKETS)
+        self.sparql_rows = Metric("loci_sparql_result_rows", "histogram",
+                                  "Rows in SPARQL query results.", (), ROWS_BUCKETS)
+        # name -> function returning LRUCache style stats, for the cache metrics
+        self.caches = OrderedDict()
+
+    def observe_request(self, route, method, status, seconds):
+        self.requests.inc(route, method, str(status))
+        self.request_seconds.observe(seconds, route, method)
+
+    def observe_upstream(self, upstream, seconds, nbytes=None, error=False):
+        self.upstream_calls.inc(upstream, "error" if error else "ok")
+        self.upstream_seconds.observe(seconds, upstream)
+        if nbytes is not None:
+            self.upstream_bytes.observe(nbytes, upstream)
+
+    def observe_sparql_rows(self, rows):
+        self.sparql_rows.observe(rows)
+
+    def register_cache(self, name, stats):
+        """
+        :param stats: function returning the cache's stats, see LRUCache.stats
+        """
+        self.caches[name] = stats
+
+    def render(self):
+        lines = []
+        for metric in (self.requests, self.request_seconds, self.upstream_calls, self.upstream_seconds,
+                       self.upstream_bytes, self.sparql_rows):
+            metric.render(lines)
+        cache_metrics = (
+            Metric("loci_cache_hits_total", "counter", "Cache lookups that found an entry.", ("cache",)),
+            Metric("loci_cache_misses_total", "counter", "Cache lookups that did not find an entry.", ("cache",)),
+            Metric("loci_cache_hit_ratio", "gauge", "Fraction of cache lookups that found an entry.", ("cache",)),
+            Metric("loci_cache_entries", "gauge", "Entries in the cache.", ("cache",)),
+            Metric("loci_cache_bytes", "gauge", "Approximate size of the cache entries.", ("cache",)),
+            Metric("loci_cache_evictions_total", "counter", "Entries evicted to make room.", ("cache",)),
+        )
+        for name, stats in self.caches.items():
+            s = stats()
+            for metric, key in zip(cache_metrics, ('hits', 'misses', 'hitRatio', 'entries', 'bytes', 'evictions')):
+                metric.inc(name, amount=s[key])
+        for metric in cache_metrics:
+            metric.render(lines)
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+class UpstreamTimer(object):
+    """
+    Times one upstream call, as a context manager. Set nbytes before it exits to record the response size.
+    """
+    __slots__ = ("upstream", "nbytes", "started")
+
+    def __init__(self, upstream):
+        self.upstream = upstream
+        self.nbytes = None
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        metrics.observe_upstream(self.upstream, time.perf_counter() - self.started, self.nbytes,
+                                 error=exc_type is not None)
+        return False
+
+
+def time_upstream(upstream):
+    """
+    Time an upstream call, eg
+        with time_upstream('gds') as call:
+            ...
+            call.nbytes = len(body)
+    """
+    return UpstreamTimer(upstream)
+
+
+async def start_request_timer(request):
+    request.ctx.metrics_started = time.perf_counter()
+
+
+async def observe_request(request, response):
+    started = getattr(request.ctx, 'metrics_started', None)
+    if started is None:
+        return
+    # restplus routes are all registered on the app, so the uri template is the API route
+    route = getattr(request, 'uri_template', None) or "unmatched"
+    status = getattr(response, 'status', 500)
+    metrics.observe_request(route, request.method, status, time.perf_counter() - started)
+
+
+async def metrics_endpoint(request):
+    return HTTPResponse(metrics.render(), status=200, content_type=PROMETHEUS_CONTENT_TYPE)
+
+
+def setup_metrics(app):
+    """
+    Time every request, and serve the metrics on /metrics.
+    """
+    app.register_middleware(start_request_timer, 'request')
+    app.register_middleware(observe_request, 'response')
+    app.add_route(metrics_endpoint, '/metrics', methods=['GET'])
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+#
+"""
+A local point-in-polygon engine for find_at_location, so point lookups in the configured datasets
+are answered in-process instead of with a Geometry Data Service round-trip.
+
+Each dataset is loaded from a GeoJSON FeatureCollection of (ideally simplified) Polygon and MultiPolygon
+features in EPSG:4326. A feature's uri is its "uri" property, or the feature id.
+Point the POINT_INDEX_DATASETS setting at the files, as dataset=path pairs separated by ";", eg
+    POINT_INDEX_DATASETS="mb=/data/asgs16_mb.geojson;cc=/data/geofabric_cc.geojson"
+where the dataset names are the loci_type values the datasets answer.
+
+The polygons are indexed with a bulk-loaded (Sort-Tile-Recursive) R-tree of their bounding boxes,
+and the candidate polygons of a point are refined with a vectorized even-odd ray crossing test.
+"""
+import json
+import logging
+import math
+import numpy as np
+from config import POINT_INDEX_DATASETS
+
+NODE_CAPACITY = 16
+
+
+class STRTree(object):
+    """
+    An R-tree of bounding boxes, bulk-loaded with the Sort-Tile-Recursive algorithm.
+    Each level is an array of (minx, miny, maxx, maxy) boxes, the children of node k of a level are
+    the nodes k*capacity to (k+1)*capacity-1 of the level below it, the bottom level is the items.
+    """
+    __slots__ = ("capacity", "items", "levels")
+
+    def __init__(self, boxes, capacity=NODE_CAPACITY):
+        """
+        :param boxes: (n, 4) array of minx, miny, maxx, maxy
+        """
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        self.capacity = capacity
+        self.items = self._pack(boxes, capacity)
+        leaves = boxes[self.items]
+        self.levels = [leaves]
+        while len(self.levels[0]) > capacity:
+            self.levels.insert(0, self._parents(self.levels[0], capacity))
+
+    @staticmethod
+    def _pack(boxes, capacity):
+        """
+        The Sort-Tile-Recursive order of the boxes: sorted by x centre into vertical slices,
+        then by y centre within each slice.
+        """
+        n = len(boxes)
+        if n == 0:
+            return np.zeros(0, dtype=np.int64)
+        node_count = math.ceil(n / capacity)
+        slice_size = math.ceil(math.sqrt(node_count)) * capacity
+        cx = boxes[:, 0] + boxes[:, 2]
+        cy = boxes[:, 1] + boxes[:, 3]
+        by_x = np.argsort(cx, kind='stable')
+        order = []
+        for start in range(0, n, slice_size):
+            tile = by_x[start:start + slice_size]
+            order.append(tile[np.argsort(cy[tile], kind='stable')])
+        return np.concatenate(order)
+
+    @staticmethod
+    def _parents(boxes, capacity):
+        starts = np.arange(0, len(boxes), capacity)
+        return np.stack([np.minimum.reduceat(boxes[:, 0], starts), np.minimum.reduceat(boxes[:, 1], starts),
+                         np.maximum.reduceat(boxes[:, 2], starts), np.maximum.reduceat(boxes[:, 3], starts)], axis=1)
+
+    def __len__(self):
+        return len(self.items)
+
+    def query(self, x, y):
+        """
+        :return: the numbers of the boxes containing the point (x, y)
+        :rtype: np.ndarray
+        """
+        if len(self.items) == 0:
+            return self.items
+        nodes = np.arange(len(self.levels[0]))
+        for depth, level in enumerate(self.levels):
+            if depth > 0:
+                # expand the matching nodes of the level above into their children
+                nodes = (nodes[:, None] * self.capacity + np.arange(self.capacity)).ravel()
+                nodes = nodes[nodes < len(level)]
+            boxes = level[nodes]
+            nodes = nodes[(boxes[:, 0] <= x) & (boxes[:, 1] <= y) & (x <= boxes[:, 2]) & (y <= boxes[:, 3])]
+            if len(nodes) == 0:
+                break
+        return self.items[nodes]
+
+
+class DatasetIndex(object):
+    """
+    The polygons of one dataset. Every polygon (one per Polygon, one per part of a MultiPolygon) is stored as
+    the edges of all its rings, holes included, so the even-odd rule over them is the polygon with its holes.
+    """
+    __slots__ = ("name", "features", "polygon_features", "edge_offsets", "x1", "y1", "x2", "y2", "tree")
+
+    def __init__(self, name, features, polygons):
+        """
+        :param name: the dataset name
+        :param features: the (uri, id) of each feature
+        :param polygons: (feature number, list of rings as (m, 2) coordinate arrays) of each polygon
+        """
+        self.name = name
+        self.features = features
+        self.polygon_features = np.array([f for f, rings in polygons], dtype=np.int64)
+        rings = [ring for f, polygon_rings in polygons for ring in polygon_rings]
+        edge_counts = [sum(len(ring) - 1 for ring in polygon_rings) for f, polygon_rings in polygons]
+        self.edge_offsets = np.zeros(len(polygons) + 1, dtype=np.int64)
+        np.cumsum(edge_counts, out=self.edge_offsets[1:])
+        vertices = np.concatenate(rings) if rings else np.zeros((0, 2))
+        # every ring is closed, so the edges are all consecutive vertex pairs except those from one ring to the next
+        ring_ends = np.cumsum([len(ring) for ring in rings]) - 1
+        edge_starts = np.delete(np.arange(len(vertices) - 1), ring_ends[:-1]) if len(vertices) else np.zeros(0, dtype=np.int64)
+        self.x1, self.y1 = vertices[edge_starts, 0], vertices[edge_starts, 1]
+        self.x2, self.y2 = vertices[edge_starts + 1, 0], vertices[edge_starts + 1, 1]
+        if len(polygons):
+            # the start points of a polygon's edges are all of its vertices
+            first_edges = self.edge_offsets[:-1]
+            boxes = np.stack([np.minimum.reduceat(self.x1, first_edges), np.minimum.reduceat(self.y1, first_edges),
+                              np.maximum.reduceat(self.x1, first_edges), np.maximum.reduceat(self.y1, first_edges)], axis=1)
+        else:
+            boxes = np.zeros((0, 4))
+        self.tree = STRTree(boxes)
+
+    @classmethod
+    def from_geojson(cls, name, collection):
+        features = []
+        polygons = []
+        for feature in collection.get('features', []):
+            geometry = feature.get('geometry', None) or {}
+            if geometry.get('type', None) == 'Polygon':
+                parts = [geometry['coordinates']]
+            elif geometry.get('type', None) == 'MultiPolygon':
+                parts = geometry['coordinates']
+            else:
+                continue
+            properties = feature.get('properties', None) or {}
+            uri = properties.get('uri', feature.get('id', None))
+            if uri is None:
+                continue
+            uri = str(uri)
+            feature_id = str(properties.get('id', uri.rstrip('/').rsplit('/', 1)[-1]))
+            for part in parts:
+                rings = [_closed_ring(ring) for ring in part if len(ring) >= 3]
+                if rings:
+                    polygons.append((len(features), rings))
+            features.append((uri, feature_id))
+        return cls(name, features, polygons)
+
+    def __len__(self):
+        return len(self.features)
+
+    def find(self, x, y):
+        """
+        :return: the numbers of the features containing the point (x, y), in feature order
+        :rtype: list
+        """
+        candidates = self.tree.query(x, y)
+        if len(candidates) == 0:
+            return []
+        # the edges of all the candidate polygons at once, with the start of each polygon's edges
+        starts = self.edge_offsets[candidates]
+        counts = self.edge_offsets[candidates + 1] - starts
+        edges = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        x1, y1, x2, y2 = self.x1[edges], self.y1[edges], self.x2[edges], self.y2[edges]
+        straddles = (y1 > y) != (y2 > y)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            crossings = straddles & (x < (x2 - x1) * (y - y1) / (y2 - y1) + x1)
+        segment_starts = np.cumsum(counts) - counts
+        inside = np.add.reduceat(crossings.astype(np.int64), segment_starts) % 2 == 1
+        return sorted(set(self.polygon_features[candidates[inside]].tolist()))
+
+    def search(self, lon, lat):
+        """
+        :return: the features containing the point, shaped like a Geometry Data Service /search/latlng response
+        :rtype: dict
+        """
+        res = []
+        for f in self.find(lon, lat):
+            uri, feature_id = self.features[f]
+            res.append({'dataset': self.name, 'id': feature_id, 'feature': uri})
+        return {'count': len(res), 'res': res}
+
+
+def _closed_ring(ring):
+    ring = np.asarray(ring, dtype=np.float64)[:, :2]
+    if ring[0, 0] != ring[-1, 0] or ring[0, 1] != ring[-1, 1]:
+        ring = np.vstack([ring, ring[:1]])
+    return ring
+
+
+class PointIndex(object):
+    """
+    The local point-in-polygon datasets, by dataset name.
+    """
+    __slots__ = ("datasets",)
+
+    def __init__(self, datasets):
+        self.datasets = datasets
+
+    @classmethod
+    def load(cls, paths):
+        """
+        :param paths: mapping of dataset name to GeoJSON file path
+        """
+        datasets = {}
+        for name, path in paths.items():
+            with open(path) as f:
+                datasets[name] = DatasetIndex.from_geojson(name, json.load(f))
+            logging.info("Loaded {} features of dataset {} into the point index".format(len(datasets[name]), name))
+        return cls(datasets)
+
+    def covers(self, dataset, crs=4326):
+        return crs == 4326 and dataset in self.datasets
+
+    def search(self, dataset, lon, lat):
+        return self.datasets[dataset].search(lon, lat)
+
+
+def parse_datasets(setting):
+    """
+    Parse a POINT_INDEX_DATASETS setting, "name=path;name=path"
+    :rtype: dict
+    """
+    paths = {}
+    for pair in (setting or '').split(';'):
+        if pair.strip() == '':
+            continue
+        name, _, path = pair.partition('=')
+        paths[name.strip()] = path.strip()
+    return paths
+
+
+point_index = None
+
+
+def get_point_index():
+    """
+    :return: the local point index, or None if it is not configured or not loaded yet
+    :rtype: PointIndex
+    """
+    return point_index
+
+
+async def load_point_index(app, loop):
+    global point_index
+    paths = parse_datasets(POINT_INDEX_DATASETS)
+    if not paths:
+        return
+    try:
+        # parsing and indexing the geometries takes a while, do it off the event loop
+        point_index = await loop.run_in_executor(None, PointIndex.load, paths)
+    except (OSError, ValueError, KeyError, IndexError, TypeError) as e:
+        logging.warning("Could not load the point index, using the geometry data service instead: {}".format(str(e)))
+
+
+def setup_point_index(app):
+    """
+    Load the local point index, if one is configured, when the server starts.
+    """
+    app.register_listener(load_point_index, 'before_server_start')
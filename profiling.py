@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+#
+"""
+Opt-in per-request profiling of upstream calls.
+Send _profile=true (or the X-LOCI-Profile: true header) with any API request to get a breakdown of every upstream
+call made while handling it, in a "profile" member of JSON responses and in a Server-Timing header.
+
+The calls are collected by a recorder held in a context variable, so it follows the request into every task it
+spawns without being passed through function signatures.
+"""
+import time
+from collections import OrderedDict
+from contextvars import ContextVar
+from codec import loads, dumps
+
+PROFILE_HEADER = "X-LOCI-Profile"
+
+# Longest query text or url recorded for a call
+TARGET_MAX_LENGTH = 300
+
+_profile = ContextVar("loci_profile", default=None)
+
+
+class Profile(object):
+    """
+    The upstream calls made while handling one request.
+    """
+    __slots__ = ("started", "calls")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.calls = []
+
+    def add(self, call):
+        self.calls.append(call)
+
+    def summary(self):
+        by_kind = OrderedDict()
+        for call in self.calls:
+            kind = by_kind.setdefault(call.kind, {'count': 0, 'seconds': 0.0, 'bytes': 0, 'rows': 0,
+                                                  'cacheHits': 0})
+            kind['count'] += 1
+            kind['seconds'] += call.seconds
+            kind['bytes'] += call.nbytes or 0
+            kind['rows'] += call.rows or 0
+            kind['cacheHits'] += 1 if call.cache == 'hit' else 0
+        return {
+            'seconds': time.perf_counter() - self.started,
+            'upstreamCalls': len(self.calls),
+            'byKind': by_kind,
+            'calls': [call.as_dict() for call in self.calls],
+        }
+
+    def server_timing(self):
+        """
+        :return: the Server-Timing header value, the total duration of the calls of each kind
+        :rtype: str
+        """
+        parts = []
+        for kind, s in self.summary()['byKind'].items():
+            parts.append('{};dur={:.1f};desc="{} calls"'.format(kind, s['seconds'] * 1000, s['count']))
+        parts.append('total;dur={:.1f}'.format((time.perf_counter() - self.started) * 1000))
+        return ", ".join(parts)
+
+
+class ProfiledCall(object):
+    """
+    One upstream call, as a context manager timing it. Set rows, nbytes and cache before it exits.
+    """
+    __slots__ = ("profile", "kind", "target", "started", "seconds", "rows", "nbytes", "cache", "error")
+
+    def __init__(self, profile, kind, target):
+        self.profile = profile
+        self.kind = kind
+        self.target = target
+        self.started = None
+        self.seconds = 0.0
+        self.rows = None
+        self.nbytes = None
+        self.cache = None
+        self.error = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.seconds = time.perf_counter() - self.started
+        if exc_type is not None:
+            self.error = exc_type.__name__
+        self.profile.add(self)
+        return False
+
+    def as_dict(self):
+        d = OrderedDict([('kind', self.kind), ('target', self.target),
+                         ('startMs', round((self.started - self.profile.started) * 1000, 3)),
+                         ('durationMs', round(self.seconds * 1000, 3))])
+        for key, value in (('rows', self.rows), ('bytes', self.nbytes), ('cache', self.cache), ('error', self.error)):
+            if value is not None:
+                d[key] = value
+        return d
+
+
+class _NotProfiled(object):
+    """
+    Stands in for a ProfiledCall when the request is not being profiled.
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def __setattr__(self, name, value):
+        pass
+
+
+_not_profiled = _NotProfiled()
+
+
+def profile_call(kind, target=None):
+    """
+    Record an upstream call in the current request's profile, if it is being profiled, eg
+        with profile_call('graphdb', sparql) as call:
+            ...
+            call.rows = len(bindings)
+    """
+    profile = _profile.get()
+    if profile is None:
+        return _not_profiled
+    if target is not None:
+        target = " ".join(str(target).split())[:TARGET_MAX_LENGTH]
+    return ProfiledCall(profile, kind, target)
+
+
+def wants_profile(request):
+    if request.headers.get(PROFILE_HEADER, '').lower() in ('true', '1', 'yes'):
+        return True
+    return str(next(iter(request.args.getlist('_profile', ['false'])))).lower() in ('true', '1', 'yes')
+
+
+async def start_profile(request):
+    if wants_profile(request):
+        request.ctx.profile = Profile()
+        # the handler runs in this same context, and the tasks it creates inherit it
+        _profile.set(request.ctx.profile)
+
+
+async def attach_profile(request, response):
+    profile = getattr(request.ctx, 'profile', None)
+    if profile is None:
+        return
+    response.headers['Server-Timing'] = profile.server_timing()
+    body = getattr(response, 'body', None)
+    if body and response.content_type is not None and response.content_type.startswith("application/json"):
+        content = loads(body)
+        if isinstance(content, dict):
+            content['profile'] = profile.summary()
+            response.body = dumps(content)
+
+
+def setup_profiling(app):
+    """
+    Profile the requests that ask for it.
+    """
+    app.register_middleware(start_profile, 'request')
+    app.register_middleware(attach_profile, 'response')
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+#
+"""
+Coalescing of identical concurrent upstream requests.
+"""
+import asyncio
+
+
+class _Call(object):
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight(object):
+    """
+    Runs at most one call per key at a time. Callers asking for a key that is already in flight
+    wait for the result of that call instead of starting their own.
+    The shared call is only cancelled when every caller waiting on it has been cancelled.
+    """
+    __slots__ = ("_calls",)
+
+    def __init__(self):
+        self._calls = {}
+
+    def __len__(self):
+        return len(self._calls)
+
+    def __contains__(self, key):
+        return key in self._calls
+
+    async def do(self, key, fn, *args, **kwargs):
+        """
+        Await fn(*args, **kwargs), or the call already in flight for key.
+        The result is shared between all the callers, they must not modify it.
+        """
+        call = self._calls.get(key, None)
+        if call is None:
+            call = _Call(asyncio.ensure_future(fn(*args, **kwargs)))
+            self._calls[key] = call
+            call.task.add_done_callback(lambda _, key=key, call=call: self._forget(key, call))
+        call.waiters += 1
+        try:
+            # shield, so the cancellation of one caller does not cancel the call for the others
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if call.waiters < 1 and not call.task.done():
+                # every caller has gone away, new callers must not join a call being cancelled
+                self._forget(key, call)
+                call.task.cancel()
+
+    def _forget(self, key, call):
+        if self._calls.get(key, None) is call:
+            del self._calls[key]
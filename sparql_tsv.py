@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+#
+"""
+Parsing of SPARQL 1.1 query results in the tab-separated values format (text/tab-separated-values).
+
+Each result row becomes a plain tuple of the values of the variables asked for, in the order asked for,
+with None where a variable is unbound. A row of the JSON format is a dict of {'type':..., 'value':...} dicts,
+several times the size, and only the values were ever used.
+The rows are parsed as the response body arrives, a chunk at a time, so the whole body is never held at once.
+"""
+
+_ESCAPES = {'t': '\t', 'n': '\n', 'r': '\r', '"': '"', "'": "'", '\\': '\\'}
+
+
+def unescape(value):
+    """
+    Undo the backslash escapes of a literal.
+    """
+    if '\\' not in value:
+        return value
+    parts = []
+    i = 0
+    while True:
+        j = value.find('\\', i)
+        if j < 0 or j + 1 >= len(value):
+            parts.append(value[i:])
+            break
+        parts.append(value[i:j])
+        parts.append(_ESCAPES.get(value[j + 1], value[j:j + 2]))
+        i = j + 2
+    return "".join(parts)
+
+
+def parse_term(term):
+    """
+    The value of one RDF term of a TSV result, as the JSON format would give it:
+    the uri of an IRI, the lexical form of a literal (its datatype and language are dropped),
+    the label of a blank node, and None for an unbound variable.
+    :param term:
+    :type term: str
+    :rtype: str
+    """
+    if not term:
+        return None
+    first = term[0]
+    if first == '<':
+        return term[1:-1]
+    if first == '"':
+        # the closing quote is the last one, a datatype IRI or language tag can follow it
+        return unescape(term[1:term.rindex('"')])
+    if term.startswith('_:'):
+        return term[2:]
+    # numbers and booleans can be written bare
+    return term
+
+
+def parse_header(line, variables):
+    """
+    :param line: the first line of a TSV result, the ?names of its variables
+    :type line: str
+    :param variables: the names of the variables wanted, without the "?"
+    :return: the column of each of the variables wanted, None for a variable not in the result
+    :rtype: tuple
+    """
+    columns = [name.strip().lstrip('?$') for name in line.split('\t')]
+    return tuple(columns.index(v) if v in columns else None for v in variables)
+
+
+class TSVRowParser(object):
+    """
+    Incremental parser of a TSV result, fed the body a chunk of bytes at a time.
+    """
+    __slots__ = ("variables", "columns", "rows", "nbytes", "_rest")
+
+    def __init__(self, variables):
+        """
+        :param variables: the names of the variables to give the values of in each row, without the "?"
+        :type variables: tuple
+        """
+        self.variables = tuple(variables)
+        self.columns = None
+        self.rows = []
+        self.nbytes = 0
+        self._rest = b""
+
+    def feed(self, chunk):
+        """
+        Parse the complete lines of chunk, keeping any partial line at its end for the next chunk.
+        """
+        self.nbytes += len(chunk)
+        data = self._rest + chunk if self._rest else chunk
+        end = data.rfind(b"\n")
+        if end < 0:
+            self._rest = data
+            return
+        self._rest = data[end + 1:]
+        # a "\n" byte can not be part of a multi-byte utf-8 character, so complete lines decode on their own
+        self._parse_lines(data[:end].decode('utf-8').split('\n'))
+
+    def close(self):
+        """
+        Parse the last line, if the body did not end with a newline.
+        :return: the rows
+        :rtype: list
+        """
+        if self._rest:
+            self._parse_lines([self._rest.decode('utf-8')])
+            self._rest = b""
+        return self.rows
+
+    def _parse_lines(self, lines):
+        columns = self.columns
+        rows = self.rows
+        for line in lines:
+            if line.endswith('\r'):
+                line = line[:-1]
+            if columns is None:
+                columns = self.columns = parse_header(line, self.variables)
+                continue
+            if not line:
+                continue
+            terms = line.split('\t')
+            rows.append(tuple(None if c is None or c >= len(terms) else parse_term(terms[c]) for c in columns))
+
+
+def parse_tsv(body, variables):
+    """
+    Parse a whole TSV result.
+    :param body:
+    :type body: bytes
+    :param variables: the names of the variables wanted, without the "?"
+    :return: a tuple of the values of the variables for each row
+    :rtype: list
+    """
+    parser = TSVRowParser(variables)
+    parser.feed(body)
+    return parser.close()
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+#
+"""
+Streaming (newline delimited JSON) responses, for results too big to build and serialize in one go.
+"""
+from sanic.response import stream
+from codec import dumps
+
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+
+# Number of records fetched from upstream and written to the client at a time
+STREAM_PAGE_SIZE = 10000
+
+
+def wants_ndjson(request):
+    """
+    Whether the client asked for a newline delimited JSON stream, with
+    Accept: application/x-ndjson or with the _format=ndjson query parameter
+    """
+    if NDJSON_CONTENT_TYPE in request.headers.get('Accept', ''):
+        return True
+    return str(next(iter(request.args.getlist('_format', [''])))) == 'ndjson'
+
+
+def ndjson_response(pages, status=200, headers=None):
+    """
+    A streaming response writing one JSON record per line.
+    :param pages: async iterable of lists of records, each list is written to the client as one chunk
+    """
+    async def streaming_fn(response):
+        async for page in pages:
+            if len(page) > 0:
+                await response.write(b"".join([dumps(record) + b"\n" for record in page]))
+    return stream(streaming_fn, status=status, headers=headers, content_type=NDJSON_CONTENT_TYPE)
+
+
+async def iter_chunks(records, size=STREAM_PAGE_SIZE):
+    """
+    Page through an already computed list of records.
+    """
+    for i in range(0, len(records), size):
+        yield records[i:i + size]
+
+
+async def iter_batches(fn, items, size=STREAM_PAGE_SIZE):
+    """
+    Run a batch function over items one chunk at a time, for streaming its results.
+    :param fn: async function taking a list of items and returning a list of results
+    """
+    for i in range(0, len(items), size):
+        yield await fn(items[i:i + size])
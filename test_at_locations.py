@@ -0,0 +1,44 @@
+import asyncio
+from aiohttp.client_exceptions import ServerDisconnectedError
+import functions
+
+
+def run_batch(monkeypatch, points, fail=(), concurrency=3):
+    calls = []
+    in_flight = [0, 0]
+
+    async def get_at_location(lat, lon, loci_type="any", crs=4326, count=1000, offset=0):
+        calls.append((lon, lat))
+        in_flight[0] += 1
+        in_flight[1] = max(in_flight)
+        try:
+            # the later points come back first
+            await asyncio.sleep(0.001 * (10 - lon))
+            if (lon, lat) in fail:
+                raise ServerDisconnectedError()
+            return {'count': 1, 'offset': 0}, {'count': 1, 'res': [lon]}
+        finally:
+            in_flight[0] -= 1
+
+    monkeypatch.setattr(functions, 'get_at_location', get_at_location)
+
+    async def run():
+        return [page async for page in functions.iter_at_locations(points, concurrency=concurrency)]
+    pages = asyncio.run(run())
+    return [result for page in pages for result in page], calls, in_flight[1]
+
+
+def test_at_locations_in_order_and_looked_up_once(monkeypatch):
+    points = [(1.0, 0.0), (2.0, 0.0), (1.0, 0.0), (3.0, 0.0), (4.0, 0.0), (2.0, 0.0)]
+    results, calls, most_in_flight = run_batch(monkeypatch, points, concurrency=2)
+    assert [locations['res'][0] for meta, locations in results] == [p[0] for p in points]
+    assert sorted(calls) == [(1.0, 0.0), (2.0, 0.0), (3.0, 0.0), (4.0, 0.0)]
+    assert most_in_flight == 2
+
+
+def test_at_locations_failed_point_gets_error(monkeypatch):
+    points = [(float(n), 0.0) for n in range(6)]
+    results, calls, most_in_flight = run_batch(monkeypatch, points, fail={(3.0, 0.0)})
+    assert len(results) == 6
+    assert results[3]['ok'] is False and "ServerDisconnectedError" in results[3]['errorMessage']
+    assert all(isinstance(r, tuple) for n, r in enumerate(results) if n != 3)
@@ -0,0 +1,71 @@
+import time
+from cache import LRUCache
+
+
+def test_lru_eviction_by_entries():
+    c = LRUCache(max_entries=2)
+    c.set('a', 'A')
+    c.set('b', 'B')
+    assert c.get('a') == 'A'
+    c.set('c', 'C')
+    # b was the least recently used
+    assert 'b' not in c
+    assert c.get('a') == 'A'
+    assert c.get('c') == 'C'
+    assert c.evictions == 1
+
+
+def test_lru_eviction_by_bytes():
+    c = LRUCache(max_entries=None, max_bytes=10)
+    c.set('a', '12345')
+    c.set('b', '12345')
+    c.set('c', '1')
+    assert len(c) == 2
+    assert c.total_bytes == 6
+    assert c.get('a') is None
+    # too big to store at all
+    assert not c.set('d', '12345678901')
+    assert 'd' not in c
+
+
+def test_ttl_expiry():
+    c = LRUCache(ttl=0.01)
+    c.set('a', 'A')
+    assert c.get('a') == 'A'
+    time.sleep(0.02)
+    assert c.get('a') is None
+    assert c.expirations == 1
+    stats = c.stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 1
+
+
+def test_lru_on_evict():
+    evicted = []
+    c = LRUCache(max_entries=1, on_evict=lambda key, value: evicted.append((key, value)))
+    c.set('a', 'A')
+    c.set('b', 'B')
+    c.pop('b')
+    assert evicted == [('a', 'A')]
+
+
+def test_geometry_cache_tiers(tmp_path):
+    import asyncio
+    from geometry_cache import GeometryCache
+
+    async def run():
+        body = '{"type": "Polygon", "coordinates": [' + ', '.join(['[1.0, 2.0]'] * 20000) + ']}'
+        cache = GeometryCache(max_bytes=len(body), directory=str(tmp_path))
+        key = ('http://example.org/geometry/1', 'geometryview', 'application/json')
+        assert await cache.get(key) is None
+        await cache.set(key, body)
+        # stored compressed
+        assert cache.memory.total_bytes < len(body) / 10
+        assert await cache.get(key) == body
+        # evicted from memory, read back from disk
+        cache.memory.clear()
+        assert await cache.get(key) == body
+        # a new cache finds the files of the previous one
+        assert await GeometryCache(max_bytes=len(body), directory=str(tmp_path)).get(key) == body
+        assert await cache.get(('http://example.org/geometry/1', 'centroid', 'application/json')) is None
+    asyncio.run(run())
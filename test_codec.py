@@ -0,0 +1,11 @@
+from collections import OrderedDict
+from decimal import Decimal
+from codec import loads, dumps
+
+
+def test_codec_round_trip():
+    body = OrderedDict([("uri", "http://example.org/a"), ("area", Decimal("10.5")), ("ok", True)])
+    data = dumps(body)
+    assert isinstance(data, bytes)
+    assert loads(data) == {"uri": "http://example.org/a", "area": 10.5, "ok": True}
+    assert loads(data.decode('utf-8')) == loads(data)
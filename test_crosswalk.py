@@ -0,0 +1,69 @@
+import math
+from crosswalk import CrosswalkAccumulator
+
+
+def test_crosswalk_accumulator_sums_and_proportions():
+    acc = CrosswalkAccumulator()
+    c1 = acc.add_contribution(100.0, "50")
+    acc.add("cc1", c1, "400.0")
+    acc.add("rr1", c1, "1000.0")
+    c2 = acc.add_contribution(300.0, 25.0)
+    acc.add("cc2", c2, "75.0")
+    acc.add("rr1", c2)
+    results = acc.results("400.0", True, True)
+    assert [r["uri"] for r in results] == ["cc1", "rr1", "cc2"]
+    assert results[0] == {"uri": "cc1", "intersectionArea": "50.0", "featureArea": "400.0",
+                          "forwardPercentage": "12.5", "reversePercentage": "12.5"}
+    assert results[1]["intersectionArea"] == "125.0"
+    # proportions are capped at 100
+    assert results[2]["reversePercentage"] == "100"
+
+
+def test_crosswalk_accumulator_unknown_and_records():
+    acc = CrosswalkAccumulator()
+    c = acc.add_contribution(10.0, math.nan)
+    acc.add("cc1", c, "5.0")
+    acc.set_unknown("rr1")
+    acc.set_record("sa2", {"uri": "sa2", "featureArea": "20.0", "forwardPercentage": "10.00000000",
+                           "reversePercentage": "50.00000000", "intersectionArea": "2.00000000"})
+    results = acc.results("20.0", False, True, uris={"cc1", "rr1", "sa2"})
+    assert results[0] == {"uri": "cc1", "forwardPercentage": "nan", "reversePercentage": "nan"}
+    assert results[1] == {"uri": "rr1", "forwardPercentage": "nan", "reversePercentage": "nan"}
+    assert results[2] == {"uri": "sa2", "forwardPercentage": "10.00000000", "reversePercentage": "50.00000000"}
+    assert [r["uri"] for r in acc.results("20.0", True, False, uris={"sa2"})] == ["sa2"]
+
+
+def test_crosswalk_accumulator_formats_float_feature_areas():
+    acc = CrosswalkAccumulator()
+    c = acc.add_contribution(10.0, 100.0)
+    acc.add("cc1", c, 40.0)
+    acc.add("rr1", c, math.nan)
+    results = acc.results(10.0, True, False)
+    assert results[0]["featureArea"] == "40.00000000"
+    assert results[1]["featureArea"] == "NaN"
+
+
+def test_crosswalk_accumulator_merge_matches_serial():
+    def part_one(acc):
+        c = acc.add_contribution(123.456, 33.3)
+        acc.add("cc1", c, 400.0)
+        acc.add("rr1", c, 1000.0)
+        acc.set_unknown("rr2")
+
+    def part_two(acc):
+        acc.set_record("rr2", {"uri": "rr2", "featureArea": "7.0", "intersectionArea": "1.0"})
+        c = acc.add_contribution(0.1, 70.7)
+        acc.add("cc2", c, 75.0)
+        acc.add("rr1", c, 999.0)
+        acc.add("cc1", c)
+
+    serial = CrosswalkAccumulator()
+    part_one(serial)
+    part_two(serial)
+    merged = CrosswalkAccumulator()
+    for part in (part_one, part_two):
+        acc = CrosswalkAccumulator()
+        part(acc)
+        merged.merge(acc)
+    assert merged.results(500.0, True, True) == serial.results(500.0, True, True)
+    assert merged.uris() == ["cc1", "rr1", "rr2", "cc2"]
@@ -0,0 +1,65 @@
+import asyncio
+import random
+import pytest
+import functions
+
+SA1 = "http://linked.data.gov.au/dataset/asgs2016/statisticalarealevel1/20001"
+MESHBLOCK = "http://linked.data.gov.au/dataset/asgs2016/meshblock/{}"
+
+
+def fake_upstream(monkeypatch, meshblocks=40, fail=None):
+    state = {'in_flight': 0, 'most_in_flight': 0, 'closed': False}
+    rng = random.Random(7)
+    delays = [rng.uniform(0, 0.004) for _ in range(meshblocks)]
+
+    async def iter_overlap_pages(*args, **kwargs):
+        try:
+            contained = [{"uri": MESHBLOCK.format(n), "forwardPercentage": 100.0 / meshblocks,
+                          "reversePercentage": 100.0, "intersectionArea": 1.0} for n in range(meshblocks)]
+            # a feature that is not a base unit, in the middle of them
+            contained.insert(meshblocks // 2, {"uri": SA1 + "0", "forwardPercentage": 50.0,
+                                               "reversePercentage": 50.0, "intersectionArea": 2.0})
+            for page in (contained[:15], contained[15:]):
+                yield {'count': len(page), 'featureArea': 1000.0}, page
+        finally:
+            state['closed'] = True
+
+    async def get_location_overlaps_crosswalk_base_uri(part, area_incoming, percentage, from_base_uri, linksets_filter=None, output_featuretype_uri=None):
+        n = int(from_base_uri.rsplit('/', 1)[1])
+        state['in_flight'] += 1
+        state['most_in_flight'] = max(state['most_in_flight'], state['in_flight'])
+        try:
+            await asyncio.sleep(delays[n])
+            if n == fail:
+                raise ValueError("upstream failed")
+        finally:
+            state['in_flight'] -= 1
+        c = part.add_contribution(area_incoming, 30.0 + n)
+        part.add("http://linked.data.gov.au/dataset/geofabric/contractedcatchment/{}".format(n % 3), c, 500.0 + n)
+        part.add("http://linked.data.gov.au/dataset/geofabric/riverregion/1", c, 9000.0)
+
+    monkeypatch.setattr(functions, 'iter_overlap_pages', iter_overlap_pages)
+    monkeypatch.setattr(functions, 'get_location_overlaps_crosswalk_base_uri', get_location_overlaps_crosswalk_base_uri)
+    return state
+
+
+def crosswalk():
+    return asyncio.run(functions.get_location_overlaps_crosswalk(SA1, None, True, True, True, True))
+
+
+def test_crosswalk_fanout_matches_serial(monkeypatch):
+    fake_upstream(monkeypatch)
+    monkeypatch.setattr(functions, 'CROSSWALK_CONCURRENCY', 1)
+    serial = crosswalk()
+    state = fake_upstream(monkeypatch)
+    monkeypatch.setattr(functions, 'CROSSWALK_CONCURRENCY', 4)
+    assert crosswalk() == serial
+    assert state['most_in_flight'] == 4
+
+
+def test_crosswalk_fanout_failure_closes_pages(monkeypatch):
+    state = fake_upstream(monkeypatch, fail=3)
+    monkeypatch.setattr(functions, 'CROSSWALK_CONCURRENCY', 4)
+    with pytest.raises(ValueError):
+        crosswalk()
+    assert state['closed'] and state['in_flight'] == 0
@@ -0,0 +1,38 @@
+from cursors import ResultStore
+
+
+def test_result_store_pages_through_result():
+    store = ResultStore(max_entries=10, max_bytes=1024 * 1024, ttl=60)
+    results = [{"uri": "http://example.org/{}".format(i)} for i in range(5)]
+    meta, page = store.start({"count": 5, "offset": 0, "featureArea": "1.0"}, results, 2)
+    seen = list(page)
+    assert meta["total"] == 5 and meta["featureArea"] == "1.0"
+    while "nextCursor" in meta:
+        meta, page = store.page(meta["nextCursor"], 2)
+        seen.extend(page)
+    assert seen == results
+    assert meta["offset"] == 4 and meta["count"] == 1
+    assert store.page("not a cursor", 2) is None
+
+
+def test_result_store_gives_result_too_big_to_keep_at_once():
+    store = ResultStore(max_entries=10, max_bytes=10, ttl=60)
+    results = [{"uri": "http://example.org/{}".format(i)} for i in range(5)]
+    meta, page = store.start({"count": 5, "offset": 0}, results, 2)
+    assert page == results and "nextCursor" not in meta
+
+
+def test_result_store_rejects_bad_page_sizes_and_offsets():
+    import base64
+    import pytest
+    from cursors import estimate_size
+    from codec import dumps
+    store = ResultStore(max_entries=10, max_bytes=1024 * 1024, ttl=60)
+    results = [{"uri": "http://example.org/{}".format(i)} for i in range(500)]
+    with pytest.raises(ValueError):
+        store.start({"count": 500, "offset": 0}, results, 0)
+    meta, page = store.start({"count": 500, "offset": 0}, results, 100)
+    result_id = base64.urlsafe_b64decode(meta["nextCursor"] + "==").decode('ascii').split(':')[0]
+    negative = base64.urlsafe_b64encode("{}:-5".format(result_id).encode('ascii')).decode('ascii').rstrip('=')
+    assert store.page(negative, 100) is None
+    assert abs(estimate_size(results) - len(dumps(results))) < len(dumps(results)) * 0.05
@@ -0,0 +1,116 @@
+import asyncio
+import math
+import re
+import functions
+from hierarchy_index import HierarchyIndex, build_index, write_index, format_area
+
+
+def test_hierarchy_index_closures(tmp_path):
+    write_index(str(tmp_path),
+                {'within': [('mb1', 'sa1'), ('mb2', 'sa1'), ('sa1', 'sa2'), ('sa2', 'sa3'), ('mb1', 'sa1')],
+                 'contains': [('sa2', 'sa1'), ('sa1', 'mb2')],
+                 'linkset_within': [('mb1', 'cc1')],
+                 'linkset_contains': [('cc1', 'mb1')]},
+                {'mb1': 10.5, 'sa1': 100.0})
+    index = HierarchyIndex.load(str(tmp_path))
+    assert len(index) == 6
+    assert 'mb2' in index
+    assert 'mb3' not in index
+    # hierarchy edges are followed transitively, linkset edges only one hop, each edge set on its own
+    assert index.within('mb1') == ['cc1', 'sa1', 'sa2', 'sa3']
+    assert index.within('mb2') == ['sa1', 'sa2', 'sa3']
+    assert index.contains('sa2') == ['mb2', 'sa1']
+    assert index.contains('cc1') == ['mb1']
+    assert index.contains('mb1') == []
+    assert index.area('sa1') == 100.0
+    assert math.isnan(index.area('sa3'))
+    assert math.isnan(index.area('mb3'))
+
+
+# sfWithin and sfContains statements that do not mirror each other, reified linkset statements and a cycle
+TRIPLES = [
+    ('mb1', 'geo:sfWithin', 'sa1'), ('mb2', 'geo:sfWithin', 'sa1'), ('sa1', 'geo:sfWithin', 'sa2'),
+    ('sa2', 'geo:sfContains', 'sa1'), ('sa3', 'geo:sfContains', 'sa2'), ('sa2', 'geo:sfContains', 'mb3'),
+    ('x', 'geo:sfWithin', 'y'), ('y', 'geo:sfWithin', 'x'),
+    ('st1', 'rdf:subject', 'mb1'), ('st1', 'rdf:predicate', 'geo:sfWithin'), ('st1', 'rdf:object', 'cc1'),
+    ('st2', 'rdf:subject', 'cc2'), ('st2', 'rdf:predicate', 'geo:sfContains'), ('st2', 'rdf:object', 'mb2'),
+]
+FEATURES = sorted({t[0] for t in TRIPLES if not t[0].startswith('st')} | {t[2] for t in TRIPLES if t[1].startswith('geo')})
+
+
+def direct(predicate):
+    return sorted((s, o) for s, p, o in TRIPLES if p == predicate)
+
+
+def reified(predicate):
+    statements = {}
+    for s, p, o in TRIPLES:
+        statements.setdefault(s, {})[p] = o
+    return sorted((st['rdf:subject'], st['rdf:object']) for st in statements.values()
+                  if st.get('rdf:predicate') == predicate)
+
+
+def fake_triplestore(monkeypatch):
+    """
+    Answer the index export queries and the within / contains fallback queries from TRIPLES,
+    following the predicates named in each query.
+    """
+    async def query_graphdb_endpoint(sparql, infer=True, same_as=True, limit=1000, offset=0):
+        assert 'ORDER BY' in sparql
+        reified_predicate = re.search(r"rdf:predicate (geo:\w+)", sparql)
+        direct_predicate = re.search(r"\?s (geo:\w+) \?o", sparql)
+        if reified_predicate is not None:
+            pairs = reified(reified_predicate.group(1))
+        elif direct_predicate is not None:
+            pairs = direct(direct_predicate.group(1))
+        else:
+            return {'results': {'bindings': []}}
+        return {'results': {'bindings': [{'s': {'value': s}, 'o': {'value': o}}
+                                         for s, o in pairs[offset:offset + limit]]}}
+
+    async def query_graphdb_rows(sparql, variables, infer=True, same_as=True, limit=1000, offset=0):
+        uri = re.search(r"rdf:subject <([^>]*)>", sparql).group(1)
+        reified_predicate = re.search(r"rdf:predicate (geo:\w+)", sparql).group(1)
+        path_predicate = re.search(r"<[^>]*> (geo:\w+)\+ \?l", sparql).group(1)
+        edges = direct(path_predicate)
+        found = set(o for s, o in reified(reified_predicate) if s == uri)
+        frontier = {uri}
+        reached = set()
+        while frontier:
+            frontier = set(o for s, o in edges if s in frontier) - reached
+            reached |= frontier
+        found |= reached
+        assert 'ORDER BY ?l' in sparql
+        return [(l,) for l in sorted(found)[offset:offset + limit]]
+
+    monkeypatch.setattr(functions, 'query_graphdb_endpoint', query_graphdb_endpoint)
+    monkeypatch.setattr(functions, 'query_graphdb_rows', query_graphdb_rows)
+
+
+def test_hierarchy_index_matches_sparql_fallback(tmp_path, monkeypatch):
+    fake_triplestore(monkeypatch)
+    asyncio.run(build_index(str(tmp_path), page_size=2))
+    index = HierarchyIndex.load(str(tmp_path))
+
+    async def lookups(count, offset):
+        results = []
+        for uri in FEATURES:
+            results.append(await functions.get_location_is_within(uri, count, offset))
+            results.append(await functions.get_location_contains(uri, count, offset))
+        return results
+
+    for count, offset in ((1000, 0), (2, 1)):
+        monkeypatch.setattr(functions, 'get_hierarchy_index', lambda: index)
+        from_index = asyncio.run(lookups(count, offset))
+        monkeypatch.setattr(functions, 'get_hierarchy_index', lambda: None)
+        from_sparql = asyncio.run(lookups(count, offset))
+        assert from_index == from_sparql
+    # sa3 contains sa2, but sa2 is not within sa3 without an sfWithin triple saying so
+    assert index.contains('sa3') == ['mb3', 'sa1', 'sa2']
+    assert index.within('sa2') == []
+    assert index.within('x') == ['x', 'y']
+
+
+def test_format_area():
+    assert format_area(10.5) == '10.50000000'
+    assert format_area(math.nan) == 'NaN'
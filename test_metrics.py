@@ -0,0 +1,26 @@
+from cache import LRUCache
+from metrics import Metrics
+
+
+def test_render_prometheus_text():
+    m = Metrics()
+    m.observe_request("/api/v1/locations", "GET", 200, 0.02)
+    m.observe_request("/api/v1/locations", "GET", 200, 3.0)
+    m.observe_upstream("graphdb", 0.5, nbytes=1000)
+    m.observe_upstream("gds", 0.1, error=True)
+    m.observe_sparql_rows(42)
+    cache = LRUCache()
+    cache.set("a", "A")
+    cache.get("a")
+    cache.get("b")
+    m.register_cache("sparql", cache.stats)
+    lines = m.render().splitlines()
+    assert 'loci_http_requests_total{route="/api/v1/locations",method="GET",status="200"} 2' in lines
+    assert 'loci_http_request_duration_seconds_bucket{route="/api/v1/locations",method="GET",le="0.025"} 1' in lines
+    assert 'loci_http_request_duration_seconds_bucket{route="/api/v1/locations",method="GET",le="+Inf"} 2' in lines
+    assert 'loci_http_request_duration_seconds_count{route="/api/v1/locations",method="GET"} 2' in lines
+    assert 'loci_upstream_requests_total{upstream="graphdb",outcome="ok"} 1' in lines
+    assert 'loci_upstream_requests_total{upstream="gds",outcome="error"} 1' in lines
+    assert 'loci_upstream_response_bytes_bucket{upstream="graphdb",le="1024"} 1' in lines
+    assert 'loci_sparql_result_rows_bucket{le="100"} 1' in lines
+    assert 'loci_cache_hit_ratio{cache="sparql"} 0.5' in lines
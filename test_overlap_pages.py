@@ -0,0 +1,54 @@
+import asyncio
+import pytest
+import functions
+
+
+def test_overlap_pages_prefetched_in_order(monkeypatch):
+    total = 23
+    offsets = []
+
+    async def get_location_overlaps(*args, count=1000, offset=0, **kwargs):
+        offsets.append(offset)
+        # the later pages come back first
+        await asyncio.sleep(0.001 * (total - offset) / count)
+        overlaps = [{"uri": str(i)} for i in range(offset, min(offset + count, total))]
+        return {'count': len(overlaps), 'offset': offset, 'featureArea': 10.0}, overlaps
+
+    monkeypatch.setattr(functions, 'get_location_overlaps', get_location_overlaps)
+
+    async def run():
+        pages = [overlaps async for meta, overlaps in functions.iter_overlap_pages("u", None, None, page_size=5, prefetch=3)]
+        return pages, await functions.get_all_overlaps("u", None, None)
+
+    pages, (my_area, all_overlaps) = asyncio.run(run())
+    assert [o["uri"] for page in pages for o in page] == [str(i) for i in range(total)]
+    assert [len(page) for page in pages] == [5, 5, 5, 5, 3]
+    # fetched up to 3 pages ahead, the ones past the end are not yielded
+    assert sorted(offsets[:7]) == [0, 5, 10, 15, 20, 25, 30]
+    assert my_area == 10.0 and len(all_overlaps) == total
+
+
+def test_overlap_pages_fetched_ahead_cancelled_when_closed(monkeypatch):
+    cancelled = []
+
+    async def get_location_overlaps(*args, count=1000, offset=0, **kwargs):
+        try:
+            await asyncio.sleep(0 if offset == 0 else 1)
+        except asyncio.CancelledError:
+            cancelled.append(offset)
+            raise
+        return {'count': count, 'offset': offset}, [{"uri": str(offset)}] * count
+
+    monkeypatch.setattr(functions, 'get_location_overlaps', get_location_overlaps)
+
+    async def run():
+        with pytest.raises(RuntimeError):
+            async with functions.aclosing(functions.iter_overlap_pages("u", None, None, page_size=2, prefetch=2)) as pages:
+                async for meta, overlaps in pages:
+                    # let the pages fetched ahead start
+                    await asyncio.sleep(0.01)
+                    raise RuntimeError("stop early")
+        # closing the iterator cancelled them, without waiting for the iterator to be finalized
+        return list(cancelled)
+
+    assert asyncio.run(run()) == [2, 4]
@@ -0,0 +1,24 @@
+import asyncio
+import functions
+
+
+def test_parents_looked_up_once_across_requests(monkeypatch):
+    lookups = []
+
+    async def get_location_parents(target_uri, include_areas=True):
+        lookups.append((target_uri, include_areas))
+        return 5.0, [{"uri": "http://example.org/parent", "isWithin": True, "featureArea": 10.0}]
+
+    monkeypatch.setattr(functions, 'get_location_parents', get_location_parents)
+    functions.parent_cache.clear()
+
+    async def run():
+        first = await functions.get_cached_location_parents("http://example.org/mb", True)
+        second = await functions.get_cached_location_parents("http://example.org/mb", True)
+        await functions.get_cached_location_parents("http://example.org/mb", False)
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first is second
+    assert lookups == [("http://example.org/mb", True), ("http://example.org/mb", False)]
+    assert functions.parent_cache.stats()['hits'] >= 1
@@ -0,0 +1,50 @@
+import numpy as np
+from point_index import STRTree, DatasetIndex, parse_datasets
+
+
+def square(x, y, size):
+    return [[x, y], [x + size, y], [x + size, y + size], [x, y + size], [x, y]]
+
+
+def feature(uri, geometry_type, coordinates):
+    return {"type": "Feature", "properties": {"uri": uri},
+            "geometry": {"type": geometry_type, "coordinates": coordinates}}
+
+
+def test_strtree_matches_brute_force():
+    rng = np.random.RandomState(1)
+    mins = rng.uniform(0, 100, size=(500, 2))
+    boxes = np.hstack([mins, mins + rng.uniform(0.1, 10, size=(500, 2))])
+    tree = STRTree(boxes, capacity=4)
+    for x, y in rng.uniform(0, 110, size=(200, 2)):
+        expected = np.nonzero((boxes[:, 0] <= x) & (boxes[:, 1] <= y) & (x <= boxes[:, 2]) & (y <= boxes[:, 3]))[0]
+        assert sorted(tree.query(x, y).tolist()) == expected.tolist()
+    assert len(STRTree(np.zeros((0, 4))).query(0, 0)) == 0
+
+
+def test_dataset_index_polygons_holes_and_multipolygons():
+    collection = {"type": "FeatureCollection", "features": [
+        # a square with a square hole
+        feature("http://example.org/f/a", "Polygon", [square(0, 0, 10), square(4, 4, 2)]),
+        # two squares, the second is in the hole of a, unclosed rings are closed
+        feature("http://example.org/f/b", "MultiPolygon", [[square(20, 0, 5)], [square(4, 4, 2)[:-1]]]),
+        # a triangle overlapping a
+        feature("http://example.org/f/c", "Polygon", [[[5, 5], [15, 5], [5, 15], [5, 5]]]),
+        {"type": "Feature", "properties": {}, "geometry": {"type": "Point", "coordinates": [1, 1]}},
+    ]}
+    index = DatasetIndex.from_geojson("test", collection)
+    assert len(index) == 3
+    assert index.find(1, 1) == [0]
+    assert index.find(4.5, 5) == [1]
+    assert index.find(7, 6) == [0, 2]
+    assert index.find(22, 2) == [1]
+    assert index.find(30, 30) == []
+    assert index.search(7, 6) == {"count": 2, "res": [
+        {"dataset": "test", "id": "a", "feature": "http://example.org/f/a"},
+        {"dataset": "test", "id": "c", "feature": "http://example.org/f/c"}]}
+
+
+def test_parse_datasets():
+    assert parse_datasets("mb=/data/mb.geojson; cc = /data/cc.geojson;") == \
+        {"mb": "/data/mb.geojson", "cc": "/data/cc.geojson"}
+    assert parse_datasets("") == {}
@@ -0,0 +1,32 @@
+import asyncio
+from profiling import Profile, profile_call, _profile
+
+
+def test_profile_call_is_a_no_op_when_not_profiling():
+    with profile_call('graphdb', 'SELECT * WHERE { ?s ?p ?o }') as call:
+        call.rows = 10
+    assert _profile.get() is None
+
+
+def test_profile_collects_calls_from_spawned_tasks():
+    async def query(n):
+        with profile_call('graphdb', 'SELECT\n  {}'.format(n)) as call:
+            await asyncio.sleep(0)
+            call.rows = n
+            call.cache = 'hit' if n == 2 else 'miss'
+
+    async def handler():
+        profile = Profile()
+        _profile.set(profile)
+        await asyncio.gather(query(1), query(2))
+        with profile_call('gds', 'http://example.org/search') as call:
+            call.nbytes = 100
+        return profile
+
+    summary = asyncio.run(handler()).summary()
+    assert summary['upstreamCalls'] == 3
+    assert summary['byKind']['graphdb']['count'] == 2
+    assert summary['byKind']['graphdb']['rows'] == 3
+    assert summary['byKind']['graphdb']['cacheHits'] == 1
+    assert summary['byKind']['gds']['bytes'] == 100
+    assert sorted(c['target'] for c in summary['calls'])[:2] == ['SELECT 1', 'SELECT 2']
@@ -0,0 +1,92 @@
+import asyncio
+import pytest
+from singleflight import SingleFlight
+
+
+def test_singleflight_runs_identical_calls_once():
+    calls = []
+
+    async def fetch(key):
+        calls.append(key)
+        await asyncio.sleep(0.01)
+        return [key]
+
+    async def run():
+        flight = SingleFlight()
+        results = await asyncio.gather(*[flight.do("a", fetch, "a") for _ in range(5)], flight.do("b", fetch, "b"))
+        return flight, results
+
+    flight, results = asyncio.run(run())
+    assert sorted(calls) == ["a", "b"]
+    assert results[:5] == [["a"]] * 5 and results[5] == ["b"]
+    assert "a" not in flight and len(flight) == 0
+
+
+def test_singleflight_cancelling_one_waiter_keeps_the_call():
+    async def fetch():
+        await asyncio.sleep(0.02)
+        return "done"
+
+    async def run():
+        flight = SingleFlight()
+        first = asyncio.ensure_future(flight.do("k", fetch))
+        second = asyncio.ensure_future(flight.do("k", fetch))
+        await asyncio.sleep(0.005)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(run()) == "done"
+
+
+def test_singleflight_cancelling_every_waiter_cancels_the_call():
+    started = []
+    cancelled = []
+
+    async def fetch():
+        started.append(1)
+        try:
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            cancelled.append(1)
+            raise
+        return "late"
+
+    async def quick():
+        started.append(2)
+        return "fresh"
+
+    async def run():
+        flight = SingleFlight()
+        waiters = [asyncio.ensure_future(flight.do("k", fetch)) for _ in range(3)]
+        await asyncio.sleep(0.005)
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+        # the key is forgotten at once, a new caller starts a fresh call
+        assert "k" not in flight
+        result = await flight.do("k", quick)
+        await asyncio.sleep(0)
+        return result
+
+    assert asyncio.run(run()) == "fresh"
+    assert started == [1, 2] and cancelled == [1]
+
+
+def test_singleflight_error_reaches_every_waiter():
+    calls = []
+
+    async def fail():
+        calls.append(1)
+        await asyncio.sleep(0.005)
+        raise ValueError("upstream failed")
+
+    async def run():
+        flight = SingleFlight()
+        return await asyncio.gather(*[flight.do("k", fail) for _ in range(3)], return_exceptions=True), flight
+
+    results, flight = asyncio.run(run())
+    assert calls == [1]
+    assert all(isinstance(r, ValueError) for r in results) and len(results) == 3
+    assert len(flight) == 0
@@ -0,0 +1,22 @@
+from sparql_tsv import TSVRowParser, parse_term
+
+
+def test_parse_term():
+    assert parse_term('<http://example.org/a>') == "http://example.org/a"
+    assert parse_term('"a \\"b\\"\\tc"@en') == 'a "b"\tc'
+    assert parse_term('"10.5"^^<http://www.w3.org/2001/XMLSchema#double>') == "10.5"
+    assert parse_term('1234.5') == "1234.5"
+    assert parse_term('_:b0') == "b0"
+    assert parse_term('') is None
+
+
+def test_rows_parsed_across_chunks():
+    body = "?o\t?w\t?uarea\n<http://example.org/a>\ttrue\t1.5\n<http://example.org/é>\t\t2\n".encode('utf-8')
+    parser = TSVRowParser(('o', 'uarea', 'w', 'c'))
+    # split inside a row and inside a multi-byte character
+    split = body.index(b"\xc3") + 1
+    for chunk in (body[:20], body[20:split], body[split:]):
+        parser.feed(chunk)
+    assert parser.close() == [("http://example.org/a", "1.5", "true", None),
+                              ("http://example.org/é", "2", None, None)]
+    assert parser.nbytes == len(body)
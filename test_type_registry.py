@@ -0,0 +1,46 @@
+import copy
+import json
+from type_registry import TypeRegistry, LOCAL_LOCI_DATATYPES_JSON
+
+
+def old_common_base(types, input_featuretype_uri, output_featuretype_uri):
+    """
+    The common base lookup Overlaps.get made before the registry, on a fresh copy of the types as on a first request
+    """
+    base_dataset_types = [t for t in copy.deepcopy(types) if t.get('baseType', False) == True]
+    output_is_base_type = False
+    input_is_base_type = False
+    for dataset_type in base_dataset_types:
+        base_dataset_type_uri = dataset_type['uri']
+        if output_featuretype_uri == base_dataset_type_uri:
+            output_is_base_type = True
+        if input_featuretype_uri == base_dataset_type_uri:
+            input_is_base_type = True
+        found_input = False
+        found_output = False
+        dataset_type['withinTypes'].append(base_dataset_type_uri)
+        for withinType in dataset_type['withinTypes']:
+            if withinType == input_featuretype_uri:
+                found_input = True
+            if withinType == output_featuretype_uri:
+                found_output = True
+        if found_input and found_output:
+            return base_dataset_type_uri, input_is_base_type, output_is_base_type
+    return None
+
+
+def test_common_base_matches_old_lookup_for_every_pair():
+    with open(LOCAL_LOCI_DATATYPES_JSON) as f:
+        types = json.load(f)
+    registry = TypeRegistry(types)
+    uris = set(t['uri'] for t in types)
+    for t in types:
+        uris.update(t.get('withinTypes', ()))
+    uris = sorted(uris)
+    found = 0
+    for input_uri in uris:
+        for output_uri in uris:
+            expected = old_common_base(types, input_uri, output_uri)
+            assert registry.common_base(input_uri, output_uri) == expected, (input_uri, output_uri)
+            found += expected is not None
+    assert found > 0
@@ -0,0 +1,31 @@
+import asyncio
+from aiohttp import web
+from upstream import UpstreamPool
+
+
+def test_upstream_pool_queues_requests_past_its_limit():
+    async def slow(request):
+        await asyncio.sleep(0.2)
+        return web.Response(text="ok")
+
+    async def run():
+        app = web.Application()
+        app.router.add_get("/", slow)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        # the second request waits longer than the connect timeout for the one connection of the pool
+        pool = UpstreamPool("test", limit=1, connect_timeout=0.05, read_timeout=5)
+
+        async def get():
+            async with pool.session().get("http://127.0.0.1:{}/".format(port)) as resp:
+                return resp.status, await resp.text()
+        try:
+            return await asyncio.gather(get(), get())
+        finally:
+            await pool.close()
+            await runner.cleanup()
+
+    assert asyncio.run(run()) == [(200, "ok"), (200, "ok")]
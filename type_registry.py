@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+#
+"""
+The registry of LOCI dataset types (loci-types.json), loaded once and indexed in memory.
+"""
+import asyncio
+import logging
+import os
+from collections import OrderedDict
+from json import loads
+from types import MappingProxyType
+from aiohttp.client_exceptions import ClientConnectorError
+from config import LOCI_DATATYPES_STATIC_JSON, USE_LOCAL_LOCI_DATATYPES_STATIC_JSON, LOCI_DATATYPES_REFRESH_INTERVAL
+from upstream import get_session
+from metrics import time_upstream
+from profiling import profile_call
+
+HERE_DIR = os.path.dirname(__file__)
+LOCAL_LOCI_DATATYPES_JSON = os.path.join(HERE_DIR, "loci-types.json")
+
+
+class TypeRegistryError(Exception):
+    pass
+
+
+def _index(entries, key):
+    index = OrderedDict()
+    for e in entries:
+        value = e.get(key, None)
+        if value is not None:
+            index.setdefault(value, []).append(e)
+    return MappingProxyType({k: tuple(v) for k, v in index.items()})
+
+
+class TypeRegistry(object):
+    """
+    Immutable, indexed view of the LOCI dataset types.
+    Entries are read-only mappings, with withinTypes as a tuple.
+    """
+    __slots__ = ("types", "by_uri", "by_dataset_uri", "by_prefix", "base_types", "by_within_type", "_common_base")
+
+    def __init__(self, types):
+        self.types = tuple(
+            MappingProxyType(dict(t, withinTypes=tuple(t['withinTypes'])) if 'withinTypes' in t else dict(t))
+            for t in types)
+        self.by_uri = _index(self.types, 'uri')
+        self.by_dataset_uri = _index(self.types, 'datasetUri')
+        self.by_prefix = _index(self.types, 'prefix')
+        self.base_types = tuple(t for t in self.types if t.get('baseType', False) == True)
+        by_within_type = OrderedDict()
+        for t in self.types:
+            for within_type in t.get('withinTypes', ()):
+                by_within_type.setdefault(within_type, []).append(t)
+        self.by_within_type = MappingProxyType({k: tuple(v) for k, v in by_within_type.items()})
+        self._common_base = self._build_common_base()
+
+    def _build_common_base(self):
+        """
+        Precompute, for every (input type, output type) pair that shares a base type,
+        the first base type whose hierarchy (its withinTypes and itself) holds both,
+        and whether the input and output are themselves base types.
+        Base types are considered in registry order.
+        """
+        common_base = {}
+        seen_base_uris = set()
+        for base_type in self.base_types:
+            base_uri = base_type['uri']
+            seen_base_uris.add(base_uri)
+            hierarchy = tuple(base_type.get('withinTypes', ())) + (base_uri,)
+            for input_type in hierarchy:
+                for output_type in hierarchy:
+                    if (input_type, output_type) not in common_base:
+                        common_base[(input_type, output_type)] = \
+                            (base_uri, input_type in seen_base_uris, output_type in seen_base_uris)
+        return MappingProxyType(common_base)
+
+    def __len__(self):
+        return len(self.types)
+
+    def find(self, dataset_uri=None, type_uri=None, base_type=False):
+        """
+        :return: the types matching all of the given filters, in registry order
+        :rtype: tuple
+        """
+        candidates = self.types
+        if type_uri is not None:
+            candidates = self.by_uri.get(type_uri, ())
+        if dataset_uri is not None:
+            candidates = tuple(t for t in candidates if t.get('datasetUri', None) == dataset_uri)
+        if base_type == True:
+            candidates = tuple(t for t in candidates if t.get('baseType', False) == True)
+        return candidates
+
+    def common_base(self, input_type_uri, output_type_uri):
+        """
+        :return: (common base type uri, input is a base type, output is a base type),
+                 or None when the two types do not share a base type
+        :rtype: tuple
+        """
+        return self._common_base.get((input_type_uri, output_type_uri), None)
+
+
+async def fetch_types():
+    """
+    Read the LOCI dataset types, from the local loci-types.json or from LOCI_DATATYPES_STATIC_JSON.
+    :rtype: list
+    """
+    if USE_LOCAL_LOCI_DATATYPES_STATIC_JSON == True:
+        try:
+            with open(LOCAL_LOCI_DATATYPES_JSON) as f:
+                return loads(f.read())
+        except (OSError, ValueError):
+            raise TypeRegistryError("File error: Could not find file {} to load Loc-I Types with."
+                                    .format(LOCAL_LOCI_DATATYPES_JSON))
+    http_ok = [200]
+    try:
+        with time_upstream('loci') as call, profile_call('loci', LOCI_DATATYPES_STATIC_JSON) as profiled:
+            resp = await get_session('loci').request('GET', LOCI_DATATYPES_STATIC_JSON)
+            resp_content = await resp.text()
+            call.nbytes = profiled.nbytes = len(resp_content)
+    except ClientConnectorError:
+        raise TypeRegistryError("Could not connect to retrieve datatypes at loci.cat. Connection error thrown.")
+    except asyncio.TimeoutError:
+        raise TypeRegistryError("Timed out retrieving datatypes at loci.cat.")
+    if resp.status not in http_ok:
+        raise TypeRegistryError("Could not retrieve datatypes at loci.cat. Error code {}".format(resp.status))
+    return loads(resp_content)
+
+
+registry = None
+
+
+async def get_type_registry():
+    """
+    Get the type registry, loading it if that has not been done at startup.
+    :rtype: TypeRegistry
+    """
+    global registry
+    if registry is None:
+        registry = TypeRegistry(await fetch_types())
+    return registry
+
+
+async def refresh_type_registry(interval):
+    global registry
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            registry = TypeRegistry(await fetch_types())
+        except TypeRegistryError as e:
+            # keep serving the types we already have
+            logging.warning("Could not refresh the LOCI type registry: {}".format(str(e)))
+
+
+async def load_type_registry(app, loop):
+    try:
+        await get_type_registry()
+    except TypeRegistryError as e:
+        # get_type_registry will try again on first use
+        logging.warning("Could not load the LOCI type registry at startup: {}".format(str(e)))
+    if LOCI_DATATYPES_REFRESH_INTERVAL:
+        load_type_registry.refresh_task = loop.create_task(refresh_type_registry(LOCI_DATATYPES_REFRESH_INTERVAL))
+load_type_registry.refresh_task = None
+
+
+async def stop_type_registry_refresh(app, loop):
+    if load_type_registry.refresh_task is not None:
+        load_type_registry.refresh_task.cancel()
+        load_type_registry.refresh_task = None
+
+
+def setup_type_registry(app):
+    """
+    Load the type registry when the server starts, and refresh it periodically if configured to.
+    """
+    app.register_listener(load_type_registry, 'before_server_start')
+    app.register_listener(stop_type_registry_refresh, 'before_server_stop')
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+#
+"""
+Shared HTTP client sessions for the upstream services the API talks to.
+There is one connection pool per upstream (see UPSTREAM_POOLS in config),
+each with its own connection limits, DNS cache and timeouts.
+"""
+import asyncio
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+from config import UPSTREAM_POOLS, UPSTREAM_DNS_CACHE_TTL, UPSTREAM_KEEPALIVE_TIMEOUT
+
+
+class UpstreamPool(object):
+    """
+    A connection pool to one upstream service.
+    The aiohttp session is created lazily, because it must be bound to a running event loop.
+    """
+    __slots__ = ("name", "limit", "limit_per_host", "timeout", "_sessions")
+
+    def __init__(self, name, limit=100, limit_per_host=0, connect_timeout=None, read_timeout=None):
+        self.name = name
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        # sock_connect rather than connect, which would also count the time spent waiting for a free
+        # connection of the pool, and fail requests queued behind a full pool instead of letting them wait
+        self.timeout = ClientTimeout(total=None, sock_connect=connect_timeout, sock_read=read_timeout)
+        # One session per event loop, the test runner creates a new loop for each app
+        self._sessions = {}
+
+    def session(self):
+        """
+        :return: the session for this pool on the current event loop
+        :rtype: ClientSession
+        """
+        loop = asyncio.get_event_loop()
+        session = self._sessions.get(loop, None)
+        if session is None or session.closed:
+            connector = TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host,
+                                     use_dns_cache=True, ttl_dns_cache=UPSTREAM_DNS_CACHE_TTL,
+                                     keepalive_timeout=UPSTREAM_KEEPALIVE_TIMEOUT)
+            session = ClientSession(connector=connector, timeout=self.timeout, loop=loop)
+            self._sessions[loop] = session
+        return session
+
+    async def close(self):
+        """
+        Close the session on the current event loop, and forget sessions of loops that are gone.
+        """
+        loop = asyncio.get_event_loop()
+        session = self._sessions.pop(loop, None)
+        if session is not None and not session.closed:
+            await session.close()
+        for other_loop in list(self._sessions.keys()):
+            if other_loop.is_closed():
+                self._sessions.pop(other_loop)
+
+
+class UpstreamClients(object):
+    """
+    The set of upstream connection pools, by name.
+    """
+    __slots__ = ("pools",)
+
+    def __init__(self, pools):
+        self.pools = pools
+
+    @classmethod
+    def from_config(cls, pool_config=None):
+        if pool_config is None:
+            pool_config = UPSTREAM_POOLS
+        return cls({name: UpstreamPool(name, **settings) for name, settings in pool_config.items()})
+
+    def session(self, name):
+        return self.pools[name].session()
+
+    async def close(self):
+        await asyncio.gather(*[p.close() for p in self.pools.values()])
+
+
+# The pools in use by this process, replaced by setup_upstreams when an app is created.
+upstreams = UpstreamClients.from_config()
+
+
+def get_session(name):
+    """
+    Get the client session of the named upstream pool, eg 'graphdb', 'gds', 'es', 'geometry' or 'loci'
+    :param name:
+    :type name: str
+    :return:
+    :rtype: ClientSession
+    """
+    return upstreams.session(name)
+
+
+async def close_upstreams(app, loop):
+    await upstreams.close()
+
+
+def setup_upstreams(app):
+    """
+    Create the upstream pools for this app, and close them cleanly when the server stops.
+    """
+    global upstreams
+    upstreams = UpstreamClients.from_config()
+    app.register_listener(close_upstreams, 'after_server_stop')
+    return upstreams